@@ -1,16 +1,15 @@
 from ConfigParser import SafeConfigParser
-from flask.helpers import find_package
 from rfk.exc.base import NoConfigException
 import os
-import pygeoip
 
 
 CONFIG = SafeConfigParser()
 
-geoip = None
+geoip = None # loaded on first use, see rfk.helper.get_geoip
 
 def init():
-    global geoip
+    # imported here, rfk.handlerclient loads this package without flask
+    from flask.helpers import find_package
     prefix, package_path = find_package(__name__)
     config_locations = []
     if prefix is not None:
@@ -22,4 +21,3 @@ def init():
     succ_read = CONFIG.read(config_locations)
     if len(succ_read) == 0:
         raise NoConfigException()
-    geoip = pygeoip.GeoIP(CONFIG.get('site', 'geoipdb'), pygeoip.MEMORY_CACHE)
@@ -45,10 +45,10 @@ def listenerdata(start,stop):
             c = 0
         ret['data'][str(stream.mount)].append((int(to_user_timezone(start).strftime("%s"))*1000,int(c)))
     
-    #fill in the actual datapoints
+    #fill in the actual datapoints, long ranges come from the rollups
     streams = Stream.query.all()
     for stream in streams:
-        stats = stream.statistic.get(start=start, stop=stop)
+        stats = stream.statistic.get(start=start, stop=stop, points=1000)
         for stat in stats:
             ret['data'][str(stream.mount)].append((int(to_user_timezone(stat.timestamp).strftime("%s"))*1000,int(stat.value)))
     
@@ -19,6 +19,21 @@ from datetime import datetime, timedelta
 from sqlalchemy import func, and_, or_, between
 
 
+def listener_stats(show):
+    """listener-minutes, peak and clients of show in total and per stream code, None if not counted"""
+    data = None
+    streams = {}
+    for stats in show.listener_stats:
+        entry = {'listener_minutes': int(stats.listener_minutes), 'peak': stats.peak, 'clients': stats.clients}
+        if stats.stream is None:
+            data = entry
+        else:
+            streams[stats.stream.code] = entry
+    if data is not None:
+        data['streams'] = streams
+    return data
+
+
 def wrapper(data, ecode=0, emessage=None):
     return {'pyrfk': {'version': '0.1', 'codename': 'Weltklang'}, 'status': {'code': ecode, 'message': emessage}, 'data': data}
 
@@ -185,6 +200,7 @@ def current_show():
                 'show_connected': connected,
                 'show_begin': begin,
                 'show_end': end,
+                'show_listeners': listener_stats(show),
                 'dj': dj
             }
     else:
@@ -287,6 +303,7 @@ def last_shows():
                 'show_flags': show.flags,
                 'show_begin': begin,
                 'show_end': end,
+                'show_listeners': listener_stats(show),
                 'dj': dj
             })
     else:
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+'''
+Created on Oct 17, 2013
+
+Benchmarks for the latency sensitive parts of PyRfK.
+
+    rfk-benchmark handler --runs 50 --budget 150
+    rfk-benchmark icecast --listeners 5000 --budget 50
+    rfk-benchmark replay var/log/traffic.log --speed 10
+
+Every benchmark exits with 1 if one of its latency budgets was exceeded
+so it can be used to catch regressions.
+'''
+import argparse
+import os
+import sys
+
+
+def percentile(values, p):
+    """returns the p-th percentile (0-100) of values, nearest rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(p / 100. * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def summarize(values):
+    """returns a dict with count, mean and the usual percentiles of values"""
+    if not values:
+        return {'count': 0}
+    return {'count': len(values),
+            'mean': sum(values) / len(values),
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'max': max(values)}
+
+
+def format_summary(name, summary, scale=1000., unit='ms'):
+    if summary['count'] == 0:
+        return '%-32s %8s' % (name, 'n/a')
+    return '%-32s %6d %9.2f %9.2f %9.2f %9.2f %9.2f %s' % (name, summary['count'],
+                                                        summary['mean'] * scale,
+                                                        summary['p50'] * scale,
+                                                        summary['p95'] * scale,
+                                                        summary['p99'] * scale,
+                                                        summary['max'] * scale,
+                                                        unit)
+
+
+def format_header(name='name'):
+    return '%-32s %6s %9s %9s %9s %9s %9s' % (name, 'n', 'mean', 'p50', 'p95', 'p99', 'max')
+
+
+def parse_budget(budget):
+    """parses 'auth=50,meta=100,200' into {'auth': 50., 'meta': 100., None: 200.}
+       (values in milliseconds, None is the default for everything else)"""
+    budgets = {}
+    if not budget:
+        return budgets
+    for part in budget.split(','):
+        part = part.strip()
+        if '=' in part:
+            name, value = part.split('=', 1)
+            budgets[name.strip()] = float(value)
+        elif part:
+            budgets[None] = float(part)
+    return budgets
+
+
+def check_budget(budgets, name, value_ms):
+    """returns the budget name exceeds or None"""
+    limit = budgets.get(name, budgets.get(None))
+    if limit is not None and value_ms > limit:
+        return limit
+    return None
+
+
+def child_env():
+    """environment for a benchmark child process that imports this rfk"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))] +
+                                        [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyRfK benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', help='benchmark to run')
+    from rfk.benchmark import handler
+    handler.add_arguments(subparsers.add_parser('handler',
+                                                help='latency of every rfk-liquidsoaphandler subcommand'))
+    from rfk.benchmark import icecast
+    icecast.add_arguments(subparsers.add_parser('icecast',
+                                                help='throughput of the icecast callbacks of the backend'))
+    from rfk.benchmark import replay
+    replay.add_arguments(subparsers.add_parser('replay',
+                                               help='replays recorded streaming traffic'))
+    args = parser.parse_args()
+    if args.benchmark == 'replay':
+        return replay.run(args)
+    if args.benchmark == 'handler':
+        return handler.run(args)
+    if args.benchmark == 'icecast':
+        return icecast.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,5 @@
+import sys
+
+from rfk.benchmark import main
+
+sys.exit(main())
@@ -0,0 +1,240 @@
+'''
+Created on Oct 17, 2013
+
+Measures how long liquidsoap waits for rfk-liquidsoaphandler.
+
+Every subcommand is executed in a fresh interpreter against a seeded
+SQLite database, once running everything in-process (cold) and once
+through the handler daemon (daemon). For each call the import time per
+module, rfk.init(), init_db() and the handler itself are recorded. The
+child starts from BOOTSTRAP, nothing of rfk is imported before its clock runs.
+A daemon call is a complete rfk.handlerclient.main() run, including the
+config lookup and whatever the client imports on its way.
+'''
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+from rfk.benchmark import summarize, format_summary, format_header, parse_budget, check_budget, child_env
+
+# modules imported by an in-process handler run, in import order
+LOCAL_MODULES = ['flask', 'sqlalchemy', 'passlib.hash', 'pygeoip', 'rfk', 'rfk.helper',
+                 'rfk.database', 'rfk.database.base', 'rfk.database.streaming',
+                 'rfk.liquidsoap', 'rfk.liquidsoaphandler']
+# modules imported by the daemon client
+CLIENT_MODULES = ['rfk', 'rfk.handlerclient']
+
+# run with python -c, argv: modules, then the arguments of child()
+BOOTSTRAP = '''
+import sys
+import time
+start = time.time()
+imports = []
+for module in sys.argv[1].split(','):
+    t = time.time()
+    __import__(module)
+    imports.append((module, time.time() - t))
+t = time.time()
+from rfk.benchmark.handler import child
+child(start + time.time() - t, imports, *sys.argv[2:])
+'''
+
+MODES = ('cold', 'daemon')
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+
+
+def add_arguments(parser):
+    parser.add_argument('--runs', type=int, default=20, help='iterations over all subcommands')
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help='cold (process per call) and/or daemon (default: both)')
+    parser.add_argument('--listeners', type=int, default=200, help='open listener rows to seed')
+    parser.add_argument('--budget', default='',
+                        help='p95 wall time budget in ms, e.g. "250" or "auth=100,meta=150,300"')
+
+
+def commands(userid, run):
+    auth = base64.b64encode('%s:%s' % (USERNAME, PASSWORD))
+    return [('auth', [USERNAME, PASSWORD]),
+            ('connect', [json.dumps({'Authorization': 'Basic %s' % (auth,),
+                                     'ice-name': 'Benchmark',
+                                     'ice-genre': 'Noise',
+                                     'User-Agent': 'rfk-benchmark'})]),
+            ('meta', [json.dumps({'userid': str(userid),
+                                  'artist': 'Benchmark Artist',
+                                  'title': 'Benchmark Title %d' % (run,)})]),
+            ('disconnect', [json.dumps(str(userid))]),
+            ('playlist', []),
+            ('listenercount', [])]
+
+
+def seed(db_uri, loopdir, listeners):
+    """creates the benchmark database, returns the id of the streaming user"""
+    import rfk.database
+    from rfk.install import setup_settings
+    from rfk.database.base import User, Loop
+    from rfk.database.streaming import Stream, Relay, StreamRelay, Listener
+    from rfk.helper import now
+
+    rfk.database.init_db(db_uri, migrate_schema=True)
+    setup_settings()
+    user = User.add_user(USERNAME, PASSWORD)
+    open(os.path.join(loopdir, 'loop.ogg'), 'w').close()
+    rfk.database.session.add(Loop(begin=0, end=2400, filename='loop.ogg'))
+    stream = Stream.add_stream('bench', 'Benchmark', '/bench.ogg', Stream.TYPES.OGG, 4)
+    relay = Relay.add_relay('127.0.0.1', 8000, 1000, 'admin', 'admin', 'source', 'source',
+                            'relay', 'relay', Relay.TYPE.MASTER)
+    stream_relay = StreamRelay(relay=relay, stream=stream)
+    rfk.database.session.add(stream_relay)
+    rfk.database.session.flush()
+    for client in xrange(listeners):
+        rfk.database.session.add(Listener(client=client, connect=now(), useragent='rfk-benchmark',
+                                          stream_relay=stream_relay))
+    rfk.database.session.commit()
+    userid = user.user
+    rfk.database.session.remove()
+    return userid
+
+
+def configure(workdir):
+    """points everything that lives on disk into workdir"""
+    import rfk
+    rfk.CONFIG.set('liquidsoap', 'looppath', os.path.join(workdir, 'loops'))
+    if rfk.CONFIG.has_option('liquidsoap-handler', 'spool'):
+        rfk.CONFIG.set('liquidsoap-handler', 'spool', os.path.join(workdir, 'spool', 'journal'))
+    if rfk.CONFIG.has_option('icecast', 'counters'):
+        rfk.CONFIG.set('icecast', 'counters', os.path.join(workdir, 'counters'))
+
+
+def child(start, imports, mode, db_uri, workdir, command, args):
+    """runs a single subcommand after BOOTSTRAP imported the modules, prints the timings as json"""
+    args = json.loads(args)
+    timings = {'imports': imports}
+    if mode == 'daemon':
+        import rfk.handlerclient
+        timings['init'] = 0.
+        timings['init_db'] = 0.
+        t = time.time()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            rfk.handlerclient.main(['--socket', os.path.join(workdir, 'handler.sock'), command] + args)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        timings['handler'] = time.time() - t
+    else:
+        import rfk
+        t = time.time()
+        rfk.init()
+        timings['init'] = time.time() - t
+        import rfk.database
+        import rfk.liquidsoaphandler
+        configure(workdir)
+        t = time.time()
+        rfk.database.init_db(db_uri)
+        timings['init_db'] = time.time() - t
+        t = time.time()
+        output = rfk.liquidsoaphandler.handle(command, args)
+        timings['handler'] = time.time() - t
+    timings['total'] = time.time() - start
+    timings['output'] = output
+    # top level packages the call loaded, an in-process fallback shows up here
+    timings['packages'] = sorted(set(name.split('.')[0] for name, module in sys.modules.items()
+                                     if module is not None))
+    sys.stdout.write('\n' + json.dumps(timings) + '\n')
+
+
+def start_daemon(db_uri, workdir):
+    import rfk
+    import rfk.database
+    from rfk.liquidsoap.handlerdaemon import HandlerDaemon
+    configure(workdir)
+    rfk.database.init_db(db_uri)
+    daemon = HandlerDaemon(os.path.join(workdir, 'handler.sock'))
+    thread = threading.Thread(target=daemon.run)
+    thread.daemon = True
+    thread.start()
+    return daemon, thread
+
+
+def run_child(mode, db_uri, workdir, command, args):
+    start = time.time()
+    modules = CLIENT_MODULES if mode == 'daemon' else LOCAL_MODULES
+    process = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', BOOTSTRAP, ','.join(modules),
+                                mode, db_uri, workdir, command, json.dumps(args)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=child_env())
+    stdout, stderr = process.communicate()
+    wall = time.time() - start
+    if process.returncode != 0:
+        raise RuntimeError('%s %s failed:\n%s' % (mode, command, stderr))
+    timings = json.loads(stdout.strip().splitlines()[-1])
+    timings['wall'] = wall
+    return timings
+
+
+def run(args):
+    import rfk
+    rfk.init()
+    workdir = tempfile.mkdtemp(prefix='rfk-benchmark-')
+    loopdir = os.path.join(workdir, 'loops')
+    os.mkdir(loopdir)
+    db_uri = 'sqlite:///%s' % (os.path.join(workdir, 'benchmark.db'),)
+    modes = args.mode or list(MODES)
+    budgets = parse_budget(args.budget)
+    failed = []
+    try:
+        userid = seed(db_uri, loopdir, args.listeners)
+        for mode in modes:
+            daemon = None
+            if mode == 'daemon':
+                daemon, thread = start_daemon(db_uri, workdir)
+            results = {}
+            for i in xrange(args.runs):
+                for command, cmdargs in commands(userid, i):
+                    results.setdefault(command, []).append(run_child(mode, db_uri, workdir, command, cmdargs))
+            if daemon is not None:
+                daemon.quit = True
+                thread.join()
+            failed.extend(report(mode, results, budgets))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        print
+        for mode, command, value, limit in failed:
+            print 'BUDGET EXCEEDED: %s %s p95 %.2f ms > %.2f ms' % (mode, command, value, limit)
+        return 1
+    return 0
+
+
+def report(mode, results, budgets):
+    """prints the results of one mode, returns the exceeded budgets"""
+    failed = []
+    print
+    print '== %s ==' % (mode,)
+    all_runs = [timings for runs in results.values() for timings in runs]
+    print format_header('import')
+    for index, module in enumerate(all_runs[0]['imports']):
+        print format_summary(module[0], summarize([timings['imports'][index][1] for timings in all_runs]))
+    print format_header('phase')
+    for phase in ('init', 'init_db'):
+        print format_summary(phase, summarize([timings[phase] for timings in all_runs]))
+    print format_header('subcommand')
+    for command in (c for c, a in commands(0, 0)):
+        if command not in results:
+            continue
+        for phase in ('handler', 'total', 'wall'):
+            summary = summarize([timings[phase] for timings in results[command]])
+            print format_summary('%s %s' % (command, phase), summary)
+            if phase == 'wall':
+                limit = check_budget(budgets, command, summary['p95'] * 1000.)
+                if limit is not None:
+                    failed.append((mode, command, summary['p95'] * 1000., limit))
+    return failed
@@ -0,0 +1,386 @@
+'''
+Created on Oct 17, 2013
+
+Replays traffic recorded by rfk.helper.recorder against a scratch database.
+
+The relays, streams and users the recording refers to are created first,
+a replay password stands in for the credentials that were not recorded and
+recorded userids are mapped to the replayed ones by their connects.
+Icecast callbacks are posted through the Flask test client of rfk.site by
+a pool of threads, handler commands run through rfk.liquidsoaphandler.handle
+in a thread of their own, one after the other like the handler daemon
+runs them. Records are dispatched at the recorded pace, a multiple of it
+or as fast as possible (--speed 0).
+
+Reported are throughput, latency per callback and command next to the
+recorded one, SQL statements, answers that differ from the recorded ones
+and the end state: the open listeners per mount compared to what the
+recording implies, and everything compared to a state saved by an earlier
+replay, e.g. before a change.
+
+    rfk-benchmark replay var/log/traffic.log --speed 10 --save-state before.json
+    rfk-benchmark replay var/log/traffic.log --speed 10 --compare-state before.json
+'''
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from Queue import Queue
+
+from rfk.benchmark import summarize, format_summary, format_header, parse_budget, check_budget
+from rfk.benchmark.icecast import StatementCounter, drain
+
+PASSWORD = 'replay'
+SOURCE_USERNAME = 'source'
+
+
+def add_arguments(parser):
+    parser.add_argument('recordings', nargs='+', help='files written by [icecast]/[liquidsoap-handler] record')
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='multiple of the recorded pace, 0 replays as fast as possible')
+    parser.add_argument('--db', help='empty scratch database uri (default: a temporary SQLite file)')
+    parser.add_argument('--concurrency', type=int, default=4, help='threads posting icecast callbacks')
+    parser.add_argument('--save-state', metavar='FILE', help='writes end state and latencies to FILE')
+    parser.add_argument('--compare-state', metavar='FILE', help='compares with a state saved by --save-state')
+    parser.add_argument('--budget', default='',
+                        help='p95 latency budget in ms, e.g. "50" or "listener_add=5,connect=300,50"')
+
+
+def get_name(record):
+    """listener_add, mount_remove, ... for icecast callbacks, the command for handler commands"""
+    if record['k'] == 'icecast':
+        return record['f'].get('action') or record['p']
+    return record['c']
+
+
+def get_recorded_setup(records):
+    """returns the usernames, {(server, port): source username} and the mounts records refer to"""
+    users = set()
+    relays = {}
+    mounts = set()
+    for record in records:
+        if record['k'] == 'handler':
+            if record.get('u'):
+                users.add(record['u'])
+            continue
+        form = record['f']
+        if 'server' in form and 'port' in form:
+            relay = (form['server'], int(form['port']))
+            relays.setdefault(relay, SOURCE_USERNAME)
+            if form.get('action') == 'stream_auth' and form.get('user'):
+                relays[relay] = form['user']
+        if form.get('mount'):
+            mounts.add(form['mount'])
+    return users, relays, mounts
+
+
+def get_expected_listeners(records):
+    """returns {mount: listeners} that should be open after records"""
+    listeners = set()
+    for record in records:
+        if record['k'] != 'icecast' or record['s'] != 200:
+            continue
+        form = record['f']
+        action = form.get('action')
+        if action == 'listener_add':
+            listeners.add((form['server'], form['port'], form['mount'], form['client']))
+        elif action == 'listener_remove':
+            listeners.discard((form['server'], form['port'], form['mount'], form['client']))
+        elif action == 'mount_remove':
+            listeners = set(listener for listener in listeners
+                            if listener[:3] != (form['server'], form['port'], form['mount']))
+    expected = {}
+    for server, port, mount, client in listeners:
+        expected[mount] = expected.get(mount, 0) + 1
+    return expected
+
+
+def prepare(records, workdir):
+    """creates what records refer to in the (empty) database"""
+    import rfk.database
+    from rfk.install import setup_settings
+    from rfk.database.base import User, Loop
+    from rfk.database.streaming import Stream, Relay
+
+    if Relay.query.count() or User.query.count():
+        raise RuntimeError('the database is not empty, use a scratch database')
+    setup_settings()
+    users, relays, mounts = get_recorded_setup(records)
+    for username in sorted(users):
+        User.add_user(username, PASSWORD)
+    for (server, port), username in sorted(relays.iteritems()):
+        Relay.add_relay(server, port, 100000, 'admin', 'admin', username, PASSWORD,
+                        'relay', 'relay', Relay.TYPE.MASTER)
+    for index, mount in enumerate(sorted(mounts)):
+        Stream.add_stream('replay%d' % (index,), mount[:25], mount, Stream.TYPES.UNKNOWN, 4)
+    loopdir = os.path.join(workdir, 'loops')
+    os.mkdir(loopdir)
+    open(os.path.join(loopdir, 'loop.ogg'), 'w').close()
+    rfk.database.session.add(Loop(begin=0, end=2400, filename='loop.ogg'))
+    rfk.database.session.commit()
+    rfk.database.session.remove()
+
+
+def get_handler_args(record, userids):
+    """returns the arguments to replay a handler command with, None if it can't be replayed"""
+    command = record['c']
+    args = record['a']
+    if command == 'auth':
+        return [record['u'], PASSWORD] if record.get('u') else None
+    if command == 'connect':
+        if not record.get('u') or not args:
+            return None
+        data = json.loads(args[0])
+        data['Authorization'] = 'Basic %s' % (base64.b64encode('%s:%s' % (record['u'], PASSWORD)),)
+        return [json.dumps(data)]
+    if command == 'meta':
+        data = json.loads(args[0])
+        if 'userid' in data:
+            data['userid'] = userids.get(str(data['userid']), data['userid'])
+        return [json.dumps(data)]
+    if command == 'disconnect':
+        userid = json.loads(args[0])
+        return [json.dumps(userids.get(str(userid), userid))]
+    return args
+
+
+def is_same_answer(record, answer):
+    """compares what a replayed handler command printed with the recording, where that is stable"""
+    if record['c'] == 'connect':
+        return answer.strip().isdigit() == record['o'].strip().isdigit()
+    if record['c'] == 'auth':
+        return answer == record['o']
+    return True
+
+
+class Replay(object):
+
+    def __init__(self, records, speed, concurrency, counter):
+        self.records = records
+        self.speed = speed
+        self.concurrency = max(concurrency, 1)
+        self.counter = counter
+        self.userids = {}
+        self.results = {}
+        self.lock = threading.Lock()
+        self.lag = 0.
+
+    def _result(self, name):
+        return self.results.setdefault(name, {'latency': [], 'recorded': [], 'statements': [],
+                                              'errors': 0, 'mismatches': 0, 'skipped': 0})
+
+    def _run_icecast(self, client, record):
+        form = dict(record['f'])
+        if form.get('pass') is None and 'pass' in form:
+            form['pass'] = PASSWORD
+        statements = self.counter.current()
+        t = time.time()
+        response = client.post(record['p'], data=form)
+        latency = time.time() - t
+        with self.lock:
+            result = self._result(get_name(record))
+            result['latency'].append(latency)
+            result['recorded'].append(record['d'])
+            result['statements'].append(self.counter.current() - statements)
+            if response.status_code != record['s']:
+                result['mismatches'] += 1
+
+    def _run_handler(self, record):
+        import rfk.liquidsoaphandler
+        args = get_handler_args(record, self.userids)
+        if args is None:
+            with self.lock:
+                self._result(get_name(record))['skipped'] += 1
+            return
+        statements = self.counter.current()
+        t = time.time()
+        error = False
+        try:
+            answer = rfk.liquidsoaphandler.handle(record['c'], args)
+        except Exception:
+            answer = ''
+            error = True
+        latency = time.time() - t
+        if record['c'] == 'connect' and record['o'].strip().isdigit() and answer.strip().isdigit():
+            self.userids[record['o'].strip()] = int(answer.strip())
+        with self.lock:
+            result = self._result(get_name(record))
+            result['latency'].append(latency)
+            result['recorded'].append(record['d'])
+            result['statements'].append(self.counter.current() - statements)
+            if error:
+                result['errors'] += 1
+            elif error != record['e'] or not is_same_answer(record, answer):
+                result['mismatches'] += 1
+
+    def _work(self, queue, run):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            record, due = item
+            lag = time.time() - due
+            if lag > self.lag:
+                self.lag = lag
+            run(record)
+
+    def run(self, app):
+        """replays all records, returns the seconds it took"""
+        icecast = Queue(maxsize=1000)
+        handler = Queue(maxsize=1000)
+        threads = [threading.Thread(target=self._work, args=(handler, self._run_handler))]
+        for i in xrange(self.concurrency):
+            client = app.test_client()
+            threads.append(threading.Thread(target=self._work,
+                                            args=(icecast, lambda record, client=client:
+                                                  self._run_icecast(client, record))))
+        for thread in threads:
+            thread.start()
+        start = time.time()
+        first = self.records[0]['t'] if self.records else 0
+        for record in self.records:
+            due = time.time()
+            if self.speed > 0:
+                due = start + (record['t'] - first) / self.speed
+                if due > time.time():
+                    time.sleep(due - time.time())
+            (icecast if record['k'] == 'icecast' else handler).put((record, due))
+        for i in xrange(self.concurrency):
+            icecast.put(None)
+        handler.put(None)
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+
+def get_state():
+    """what the replay left in the database"""
+    import rfk.database
+    from sqlalchemy import func
+    from rfk.database.show import Show
+    from rfk.database.track import Track
+    from rfk.database.streaming import Stream, StreamRelay, Listener
+
+    session = rfk.database.session
+    state = {'open_listeners': dict(session.query(Stream.mount, func.count(Listener.listener))
+                                           .join(StreamRelay, StreamRelay.stream_id == Stream.stream)
+                                           .join(Listener, Listener.stream_relay_id == StreamRelay.stream_relay)
+                                           .filter(Listener.disconnect == None)
+                                           .group_by(Stream.mount).all()),
+             'listeners': Listener.query.count(),
+             'shows': Show.query.count(),
+             'tracks': Track.query.count()}
+    session.remove()
+    return state
+
+
+def run(args):
+    import rfk
+    import rfk.database
+    from sqlalchemy import event
+    from rfk.helper.recorder import read_records
+    from rfk.benchmark.handler import configure
+
+    records = read_records(args.recordings)
+    if not records:
+        print 'nothing recorded'
+        return 1
+    workdir = tempfile.mkdtemp(prefix='rfk-replay-')
+    try:
+        rfk.init()
+        configure(workdir)
+        # recording while replaying would append to the recording
+        for section in ('icecast', 'liquidsoap-handler'):
+            if rfk.CONFIG.has_option(section, 'record'):
+                rfk.CONFIG.remove_option(section, 'record')
+        db_uri = args.db or 'sqlite:///%s' % (os.path.join(workdir, 'replay.db'),)
+        rfk.database.init_db(db_uri, migrate_schema=True)
+        prepare(records, workdir)
+        # imported late, they take the session and the listener queue on import
+        import rfk.site
+        from rfk.site import backend
+
+        counter = StatementCounter()
+        event.listen(rfk.database.engine, 'before_cursor_execute', counter)
+        replay = Replay(records, args.speed, args.concurrency, counter)
+        elapsed = replay.run(rfk.site.app)
+        t = time.time()
+        drain(backend.listener_queue)
+        drained = time.time() - t
+        state = get_state()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    summary = dict((name, summarize(result['latency'])) for name, result in replay.results.iteritems())
+    report(records, replay, elapsed, drained, summary, state, get_expected_listeners(records))
+    if args.compare_state:
+        with open(args.compare_state) as f:
+            compare(json.load(f), summary, state)
+    if args.save_state:
+        with open(args.save_state, 'w') as f:
+            json.dump({'summary': summary, 'state': state}, f, indent=1, sort_keys=True)
+    budgets = parse_budget(args.budget)
+    failed = []
+    for name, values in sorted(summary.iteritems()):
+        if values['count']:
+            limit = check_budget(budgets, name, values['p95'] * 1000.)
+            if limit is not None:
+                failed.append((name, values['p95'] * 1000., limit))
+    if failed:
+        print
+        for name, value, limit in failed:
+            print 'BUDGET EXCEEDED: %s p95 %.2f ms > %.2f ms' % (name, value, limit)
+        return 1
+    return 0
+
+
+def report(records, replay, elapsed, drained, summary, state, expected):
+    span = records[-1]['t'] - records[0]['t']
+    print '%d records (%.0f s recorded) replayed in %.2f s, %.1f records/s' % (
+        len(records), span, elapsed, len(records) / max(elapsed, 1e-9))
+    if replay.speed > 0:
+        print 'dispatched up to %.0f ms late at %gx' % (replay.lag * 1000., replay.speed)
+    print 'write-behind drained %.2f s later' % (drained,)
+    print format_header('replayed')
+    for name in sorted(summary):
+        print format_summary(name, summary[name])
+    print format_header('recorded')
+    for name in sorted(replay.results):
+        print format_summary(name, summarize(replay.results[name]['recorded']))
+    print format_header('statements')
+    for name in sorted(replay.results):
+        print format_summary(name, summarize(replay.results[name]['statements']), 1, '')
+    print '%-32s %8s %10s %8s' % ('answers', 'errors', 'different', 'skipped')
+    for name in sorted(replay.results):
+        result = replay.results[name]
+        print '%-32s %8d %10d %8d' % (name, result['errors'], result['mismatches'], result['skipped'])
+    print 'end state: %d listeners, %d shows, %d tracks' % (state['listeners'], state['shows'], state['tracks'])
+    print '%-32s %8s %8s' % ('open listeners', 'replayed', 'recorded')
+    for mount in sorted(set(expected) | set(state['open_listeners'])):
+        print '%-32s %8d %8d' % (mount, state['open_listeners'].get(mount, 0), expected.get(mount, 0))
+
+
+def compare(saved, summary, state):
+    """prints the differences to a state saved by an earlier replay"""
+    print
+    print 'compared to the saved replay:'
+    print '%-32s %10s %10s' % ('p95 latency (ms)', 'saved', 'now')
+    for name in sorted(set(saved['summary']) | set(summary)):
+        before = saved['summary'].get(name, {})
+        after = summary.get(name, {})
+        print '%-32s %10s %10s' % (name,
+                                   '%.2f' % (before['p95'] * 1000.,) if before.get('count') else 'n/a',
+                                   '%.2f' % (after['p95'] * 1000.,) if after.get('count') else 'n/a')
+    differences = []
+    for key in sorted(set(saved['state']) | set(state)):
+        if saved['state'].get(key) != state.get(key):
+            differences.append('%s: %s -> %s' % (key, json.dumps(saved['state'].get(key), sort_keys=True),
+                                                 json.dumps(state.get(key), sort_keys=True)))
+    if differences:
+        print 'end state differs:'
+        for difference in differences:
+            print '  ' + difference
+    else:
+        print 'end state is the same'
@@ -9,9 +9,10 @@ import urllib2
 import rfk
 import rfk.database
 from rfk.database import init_db
-from rfk.database.streaming import Relay
-from rfk.database.stats import RelayStatistic
+from rfk.database.streaming import Relay, archive_listeners
+from rfk.database.stats import RelayStatistic, rollup_statistics, prune_statistics
 from rfk.icecast import Icecast
+from rfk.icecast.reconcile import reconcile_listeners
 from rfk.helper import now, get_path
 
 rfk.init()
@@ -49,6 +50,11 @@ def main():
             rfk.database.session.commit()
         except urllib2.URLError:
             pass
+    reconcile_listeners()
+    rollup_statistics()
+    prune_statistics()
+    rfk.database.session.commit()
+    archive_listeners()
         
 if __name__ == '__main__':
     sys.exit(main())
@@ -2,12 +2,41 @@ from sqlalchemy import create_engine, types, text
 from sqlalchemy.orm import relationship, sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import *
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.exc import SQLAlchemyError
 import pytz
 
+from rfk.exc.base import SchemaOutdatedException
+
 Base = declarative_base()
 session = None
 engine = None
 
+# version of the database layout, bump this and register a migration
+# whenever tables change in a way create_all can't handle
+SCHEMA_VERSION = 7
+migrations = {}
+
+def migration(version):
+    """registers a function that upgrades the schema from version-1 to version
+    
+    the function is called with a connection inside a transaction
+    after create_all() added all missing tables
+    """
+    def register(func):
+        migrations[version] = func
+        return func
+    return register
+
+def add_column(conn, column):
+    """adds column to its table in a migration, unless create_all already created it with the table"""
+    table = column.table
+    if column.name in [existing['name'] for existing in inspect(conn).get_columns(table.name)]:
+        return
+    conn.execute('ALTER TABLE %s ADD COLUMN %s' % (conn.dialect.identifier_preparer.quote(table.name),
+                                                    CreateColumn(column).compile(dialect=conn.dialect)))
+
 class UTCDateTime(types.TypeDecorator):
 
     impl = types.DateTime
@@ -29,14 +58,51 @@ import streaming
 import track
 import stats
 
-def init_db(db_uri, debug=False):
+def init_db(db_uri, debug=False, migrate_schema=False, check_schema=True):
+    """connects to the database
+    
+    only the schema version is looked up, SchemaOutdatedException is raised
+    if it is not current. Run rfk-migrate on installs and upgrades, the tables
+    are only created/migrated here if migrate_schema is set (throwaway databases)
+    """
     global session, engine
     engine = create_engine(db_uri, echo=debug)
     session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=True,
                                          bind=engine))
-    Base.metadata.create_all(bind=engine)
     Base.query = session.query_property()
+    if migrate_schema:
+        if not schema_is_current():
+            migrate()
+    elif check_schema:
+        version = get_schema_version()
+        if version != SCHEMA_VERSION:
+            raise SchemaOutdatedException(version, SCHEMA_VERSION)
+
+def get_schema_version():
+    """returns the stamped schema version or None if the database is not stamped"""
+    try:
+        return engine.execute(select([func.max(base.SchemaVersion.version)])).scalar()
+    except SQLAlchemyError:
+        return None
+
+def schema_is_current():
+    return get_schema_version() == SCHEMA_VERSION
+
+def migrate():
+    """creates missing tables, runs pending migrations and stamps the schema version
+    
+    returns a tuple of (old version, new version)
+    """
+    old_version = get_schema_version()
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for version in range((old_version or 0) + 1, SCHEMA_VERSION + 1):
+            if version in migrations:
+                migrations[version](conn)
+        conn.execute(base.SchemaVersion.__table__.delete())
+        conn.execute(base.SchemaVersion.__table__.insert(), version=SCHEMA_VERSION)
+    return (old_version, SCHEMA_VERSION)
 
 def drop_all_tables_and_sequences():
     ''' 
@@ -1,9 +1,11 @@
 import time
 import re
 import os
+import threading
 from datetime import datetime, timedelta
 
 import hashlib
+import hmac
 from passlib.hash import bcrypt
 
 from sqlalchemy import *
@@ -51,6 +53,13 @@ class User(Base):
     register_date = Column(UTCDateTime, default=now)
     last_login = Column(UTCDateTime, default=None)
     
+    # cache of recently verified credentials: user -> (hmac of secret, password hash, expiry)
+    # the secret itself is never stored, the hmac key only lives in this process
+    _auth_cache = {}
+    _auth_cache_names = {}
+    _auth_cache_lock = threading.Lock()
+    _auth_cache_key = os.urandom(32)
+    
     def get_id(self):
         return unicode(self.user)
     
@@ -79,10 +88,82 @@ class User(Base):
         password -- unencrypted password
         """
         user = User.get_user(username=username)
+        if user._check_auth_cache(password):
+            return user
         if user.check_password(password):
+            user._add_to_auth_cache(password)
             return user
         else:
             raise rexc.base.InvalidPasswordException()
+    
+    @staticmethod
+    def get_auth_cache_ttl():
+        if CONFIG.has_option('site', 'auth-cache-ttl'):
+            return CONFIG.getint('site', 'auth-cache-ttl')
+        return 60
+    
+    @staticmethod
+    def clear_auth_cache(user=None):
+        """forgets verified credentials of user or of everyone"""
+        with User._auth_cache_lock:
+            if user is None:
+                User._auth_cache.clear()
+                User._auth_cache_names.clear()
+            else:
+                User._auth_cache.pop(user.user, None)
+                User._auth_cache_names.pop(user.username, None)
+    
+    @staticmethod
+    def get_cached_userid(username, password):
+        """returns the id of username if these credentials were verified within the cache ttl
+        
+        this does not touch the database, so a password changed in another
+        process is only noticed once the entry expired
+        """
+        with User._auth_cache_lock:
+            userid = User._auth_cache_names.get(username)
+            entry = User._auth_cache.get(userid)
+        if entry is None:
+            return None
+        digest, password_hash, expires = entry
+        if expires < time.time():
+            return None
+        if hmac.compare_digest(digest, User._make_auth_digest(userid, password)):
+            return userid
+        return None
+    
+    @staticmethod
+    def _make_auth_digest(userid, password):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hmac.new(User._auth_cache_key, "%s:%s" % (userid, password), hashlib.sha256).digest()
+    
+    def _auth_digest(self, password):
+        return User._make_auth_digest(self.user, password)
+    
+    def _check_auth_cache(self, password):
+        """returns True if this password was verified for this user within the cache ttl
+        
+        the entry is only valid as long as the stored password hash is unchanged
+        so a password change in any process invalidates it
+        """
+        with User._auth_cache_lock:
+            entry = User._auth_cache.get(self.user)
+        if entry is None:
+            return False
+        digest, password_hash, expires = entry
+        if expires < time.time() or password_hash != self.password:
+            User.clear_auth_cache(self)
+            return False
+        return hmac.compare_digest(digest, self._auth_digest(password))
+    
+    def _add_to_auth_cache(self, password):
+        ttl = User.get_auth_cache_ttl()
+        if ttl <= 0:
+            return
+        with User._auth_cache_lock:
+            User._auth_cache[self.user] = (self._auth_digest(password), self.password, time.time() + ttl)
+            User._auth_cache_names[self.username] = self.user
             
     
     @staticmethod
@@ -105,6 +186,7 @@ class User(Base):
     
     @staticmethod
     def make_password(password):
+        User.clear_auth_cache()
         return bcrypt.encrypt(password)
     
     @staticmethod
@@ -337,6 +419,13 @@ class ApiKey(Base):
         apikey.access = now()
         return apikey
     
+class SchemaVersion(Base):
+    """stamp of the database layout, see rfk.database.migrate"""
+    __tablename__ = 'schema_version'
+    version = Column(Integer(unsigned=True), primary_key=True, autoincrement=False)
+    applied = Column(UTCDateTime, default=now)
+
+
 class Log(Base):
     __tablename__ = 'log'
     log = Column(Integer(unsigned=True), primary_key=True, autoincrement=True)
@@ -373,25 +462,122 @@ class Loop(Base):
     def file_exists(self):
         if self.filename is None:
             return False
-        return os.path.exists(os.path.join(get_path(CONFIG.get('liquidsoap', 'looppath')), self.filename))
+        return loop_schedule.file_exists(self.filename)
+    
+    def contains_point(self, point):
+        """python counterpart of Loop.contains"""
+        return LoopSchedule.contains_point(self.begin, self.end, point)
         
     @staticmethod
     def get_current_loop():
         """
             returns the current loop to be scheduled
-            @todo maybe broken ;_;
         """
         n = now()
-        #try to find a loop that should be running
-        loops = Loop.query.filter(Loop.contains(int(n.hour*100+(n.minute/60.)*100))).order_by(Loop.length.asc()).all()
-        for loop in loops:
-            if loop.file_exists:
-                return loop;
-        # we found no loops
-        # just try to find the longest one
-        loops = Loop.query.order_by(Loop.length.asc()).all()
-        for loop in loops:
-            if loop.file_exists:
-                return loop;
-        #okay, now we have a problem, just retun none
-        return None
\ No newline at end of file
+        loop = loop_schedule.get_loop(n.hour * 60 + n.minute)
+        if loop is None:
+            return None
+        return Loop.query.get(loop)
+
+
+class LoopSchedule(object):
+    """per minute lookup table of the loop to play
+    
+    a loop containing the minute wins, the shortest one if there are several,
+    otherwise the shortest loop at all. only loops whose file exists count.
+    the table is rebuilt when the loops table changes (checked at most
+    every check_interval seconds) or when the mtime of the looppath
+    changes, which happens whenever a file appears or disappears
+    """
+    
+    check_interval = 10
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = None
+        self.signature = None
+        self.checked = 0
+        self.looppath_setting = None
+        self.looppath = None
+        self.mtime = None
+        self.files = {}
+        
+    @staticmethod
+    def minute_to_point(minute):
+        """converts minutes since midnight to the 0-2400 scale used by Loop.begin/end"""
+        return int((minute / 60) * 100 + ((minute % 60) / 60.) * 100)
+    
+    @staticmethod
+    def contains_point(begin, end, point):
+        if begin <= end:
+            return begin <= point <= end
+        return begin <= point or end >= point
+    
+    def _check_looppath(self):
+        setting = CONFIG.get('liquidsoap', 'looppath')
+        if setting != self.looppath_setting:
+            self.looppath_setting = setting
+            self.looppath = get_path(setting)
+            self.mtime = None
+        try:
+            mtime = os.stat(self.looppath).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is None or mtime != self.mtime:
+            self.mtime = mtime
+            self.files = {}
+            self.slots = None
+    
+    def _file_exists(self, filename):
+        if filename not in self.files:
+            self.files[filename] = os.path.exists(os.path.join(self.looppath, filename))
+        return self.files[filename]
+    
+    def file_exists(self, filename):
+        with self.lock:
+            self._check_looppath()
+            return self._file_exists(filename)
+    
+    def _check_loops(self):
+        if self.slots is not None and time.time() - self.checked < self.check_interval:
+            return
+        self.checked = time.time()
+        signature = tuple(rfk.database.session.query(func.count(Loop.loop), func.max(Loop.loop),
+                                                     func.sum(Loop.begin), func.sum(Loop.end)).one())
+        if signature != self.signature:
+            self.signature = signature
+            self.slots = None
+        
+    def _build(self):
+        loops = sorted((loop.length, loop.loop, loop.begin, loop.end)
+                       for loop in Loop.query.all()
+                       if loop.filename is not None and self._file_exists(loop.filename))
+        fallback = loops[0][1] if loops else None
+        slots = []
+        for minute in xrange(1440):
+            point = self.minute_to_point(minute)
+            for length, loop, begin, end in loops:
+                if self.contains_point(begin, end, point):
+                    slots.append(loop)
+                    break
+            else:
+                slots.append(fallback)
+        self.slots = slots
+        
+    def get_loop(self, minute):
+        """returns the id of the loop to play at minute (since midnight)"""
+        with self.lock:
+            self._check_looppath()
+            self._check_loops()
+            if self.slots is None:
+                self._build()
+            return self.slots[minute]
+    
+    def invalidate(self):
+        """forces a rebuild on the next lookup"""
+        with self.lock:
+            self.slots = None
+            self.signature = None
+            self.files = {}
+
+loop_schedule = LoopSchedule()
@@ -40,13 +40,16 @@ class Show(Base):
     def intersects(self, other):
         return self.contains(other.begin) | self.contains(other.end)
     
-    def end_show(self):
+    def end_show(self, flush=True):
         """ends the Show
            raises exception if the show is planned since it doesn't need to be ended"""
+        from rfk.database.streaming import ShowListenerStats
         if self.flags & Show.FLAGS.PLANNED:
             raise Exception
         self.end = now()
-        rfk.database.session.flush()
+        ShowListenerStats.finalize(self, self.end)
+        if flush:
+            rfk.database.session.flush()
         
     def add_tags(self, tags):
         """adds a list of Tags to the Show"""
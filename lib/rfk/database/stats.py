@@ -1,51 +1,135 @@
 from sqlalchemy import *
 from sqlalchemy.orm import relationship, backref, exc
+from sqlalchemy import inspect
 from sqlalchemy.dialects.mysql import INTEGER as Integer
+from datetime import timedelta
+import pytz
 
-from rfk.database import Base, UTCDateTime
+from rfk.database import Base, UTCDateTime, migration, add_column
 import rfk.database
+from rfk import CONFIG
 from rfk.helper import now
 from rfk.types import ENUM
 
+def get_statistic_resolution():
+    """seconds one data point of a statistic covers, 0 keeps every timestamp"""
+    if CONFIG.has_option('database', 'statistic-resolution'):
+        return CONFIG.getint('database', 'statistic-resolution')
+    return 0
+
+def get_statistic_retention(name):
+    """returns the days data points of resolution name (raw, minute, hour or day) are kept, 0 keeps them forever"""
+    option = 'statistic-retention-%s' % (name,)
+    if CONFIG.has_option('database', option):
+        return CONFIG.getint('database', option)
+    return 0
+
+def get_bucket(timestamp, resolution):
+    """returns the begin of the bucket timestamp falls into
+    
+    buckets are counted from midnight, so a resolution
+    that does not divide a day shortens the last one
+    """
+    if not resolution:
+        return timestamp
+    seconds = timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second
+    return timestamp.replace(microsecond=0) - timedelta(seconds=seconds % resolution)
+
+_upserts = {}
+
+def get_upsert(dialect):
+    """returns the statement that inserts or replaces one data point or None if the dialect has none"""
+    if dialect.name not in _upserts:
+        quote = dialect.identifier_preparer.quote
+        # a replaced value has to be rolled up again
+        insert = 'INSERT INTO %s (%s, %s, %s, %s) VALUES (:statistic, :timestamp, :value, :rolled)' %\
+                 tuple(quote(name) for name in ('statisticsdata', 'statistic', 'timestamp', 'value', 'rolled'))
+        conflict = ' ON CONFLICT (%s, %s) DO UPDATE SET %s = excluded.%s, %s = excluded.%s' %\
+                   tuple(quote(name) for name in ('statistic', 'timestamp', 'value', 'value', 'rolled', 'rolled'))
+        if dialect.name == 'mysql':
+            statement = insert + ' ON DUPLICATE KEY UPDATE %s = VALUES(%s), %s = VALUES(%s)' %\
+                        tuple(quote(name) for name in ('value', 'value', 'rolled', 'rolled'))
+        elif dialect.name == 'sqlite':
+            if dialect.dbapi.sqlite_version_info >= (3, 24, 0):
+                statement = insert + conflict
+            else:
+                statement = insert.replace('INSERT', 'INSERT OR REPLACE', 1)
+        elif dialect.name == 'postgresql' and dialect.server_version_info >= (9, 5):
+            statement = insert + conflict
+        else:
+            statement = None
+        if statement is not None:
+            statement = text(statement).bindparams(bindparam('timestamp', type_=UTCDateTime()),
+                                                   bindparam('rolled', type_=Boolean()))
+        _upserts[dialect.name] = statement
+    return _upserts[dialect.name]
+
 class Statistic(Base):
     __tablename__ = 'statistics'
     statistic = Column(Integer(unsigned=True), primary_key=True, autoincrement=True)
     name = Column(String(50), nullable=False)
     identifier = Column(String(50), unique=True,  nullable=False)
     
-    def set(self, timestamp, value):
-        try:
-            ls = StatsistcsData.query.filter(StatsistcsData.timestamp == timestamp,
-                                             StatsistcsData.statistic == self).one()
-            ls.value = value
-            rfk.database.session.flush()
-        except exc.NoResultFound:
-            ls = StatsistcsData(statistic=self, timestamp=timestamp, value=value)
-            rfk.database.session.add(ls)
+    def set(self, timestamp, value, resolution=None):
+        """stores value as the data point of the bucket timestamp falls into
+        
+        a later value within the same bucket replaces the earlier one.
+        resolution defaults to get_statistic_resolution()
+        """
+        if resolution is None:
+            resolution = get_statistic_resolution()
+        if self.statistic is None:
             rfk.database.session.flush()
+        timestamp = get_bucket(timestamp, resolution)
+        upsert = get_upsert(rfk.database.session.get_bind().dialect)
+        if upsert is not None:
+            rfk.database.session.execute(upsert, {'statistic': self.statistic,
+                                                  'timestamp': timestamp,
+                                                  'value': value,
+                                                  'rolled': False})
+            return
+        table = StatsistcsData.__table__
+        result = rfk.database.session.execute(table.update()
+                                                   .where(and_(table.c.statistic == self.statistic,
+                                                               table.c.timestamp == timestamp))
+                                                   .values(value=value, rolled=False))
+        if result.rowcount == 0:
+            rfk.database.session.execute(table.insert().values(statistic=self.statistic,
+                                                               timestamp=timestamp,
+                                                               value=value))
             
-    def get(self, start=None, stop=None, num=None, reverse=False):
-        clauses = []
+    def get(self, start=None, stop=None, num=None, reverse=False, points=None):
+        """returns the data points between start and stop
+        
+        reads raw points unless they were already pruned for the requested
+        range or there are more than points of them, then the finest rollup
+        that fits is used. rollup rows have a value (the average) as well
+        """
+        resolution = get_resolution(start, stop, points)
+        if resolution is None:
+            model = StatsistcsData
+            clauses = [StatsistcsData.statistic == self]
+        else:
+            model = StatisticsRollup
+            clauses = [StatisticsRollup.statistic == self,
+                       StatisticsRollup.resolution == resolution]
         if start is not None:
-            clauses.append(StatsistcsData.timestamp >= start)
+            clauses.append(model.timestamp >= start)
         if stop is not None:
-            clauses.append(StatsistcsData.timestamp <= stop)
-        clauses.append(StatsistcsData.statistic == self)
-        qry = StatsistcsData.query.filter(*clauses)
+            clauses.append(model.timestamp <= stop)
+        qry = model.query.filter(*clauses)
         if reverse:
-            qry = qry.order_by(StatsistcsData.timestamp.desc() )
+            qry = qry.order_by(model.timestamp.desc() )
         else:
-            qry = qry.order_by(StatsistcsData.timestamp.asc() )
+            qry = qry.order_by(model.timestamp.asc() )
         if num is not None:
             qry = qry.limit(num)
         return qry.yield_per(100)
         
     def current_value(self):
-        ret = self.get(stop=now(), num=1, reverse=True)
-        if len(ret) == 1:
-            return ret[0]
-        else:
-            return None
+        for data in self.get(stop=now(), num=1, reverse=True):
+            return data
+        return None
 
 
 class StatsistcsData(Base):
@@ -57,6 +141,265 @@ class StatsistcsData(Base):
     statistic = relationship("Statistic")
     timestamp = Column(UTCDateTime(), nullable=False)
     value = Column(Integer(unsigned=True), nullable=False)
+    # set once the point is part of its minute rollup
+    rolled = Column(Boolean, nullable=False, default=False, server_default=false())
+statisticsdata_idx = Index('statisticsdata_statistic_timestamp_idx', StatsistcsData.statistic_id,
+                           StatsistcsData.timestamp, unique=True)
+
+@migration(2)
+def add_statisticsdata_idx(conn):
+    """merges duplicate data points and adds the unique index Statistic.set relies on"""
+    if statisticsdata_idx.name in [index['name'] for index in inspect(conn).get_indexes('statisticsdata')]:
+        # the table was just created along with it
+        return
+    table = StatsistcsData.__table__
+    # the derived table keeps mysql from refusing to delete from a table it reads
+    newest = select([func.max(table.c.stat).label('stat')])\
+             .group_by(table.c.statistic, table.c.timestamp).alias('newest')
+    conn.execute(table.delete().where(~table.c.stat.in_(select([newest.c.stat]))))
+    statisticsdata_idx.create(conn)
+    
+statisticsdata_timestamp_idx = Index('statisticsdata_timestamp_idx', StatsistcsData.timestamp)
+
+@migration(3)
+def add_statisticsdata_timestamp_idx(conn):
+    """adds the index the rollup job and the pruning scan by"""
+    if statisticsdata_timestamp_idx.name not in [index['name'] for index in inspect(conn).get_indexes('statisticsdata')]:
+        statisticsdata_timestamp_idx.create(conn)
+
+
+class StatisticsRollup(Base):
+    """aggregate of the data points of a statistic within resolution seconds"""
+    __tablename__ = 'statisticsrollups'
+    rollup = Column(Integer(unsigned=True), primary_key=True, autoincrement=True)
+    statistic_id = Column("statistic", Integer(unsigned=True), ForeignKey('statistics.statistic',
+                                                                          onupdate="CASCADE",
+                                                                          ondelete="RESTRICT"))
+    statistic = relationship("Statistic")
+    resolution = Column(Integer(unsigned=True), nullable=False)
+    timestamp = Column(UTCDateTime(), nullable=False)
+    min = Column(Integer(unsigned=True), nullable=False)
+    max = Column(Integer(unsigned=True), nullable=False)
+    avg = Column(Float, nullable=False)
+    last = Column(Integer(unsigned=True), nullable=False)
+    count = Column(Integer(unsigned=True), nullable=False)
+    # set once the rollup is part of the next coarser one
+    rolled = Column(Boolean, nullable=False, default=False, server_default=false())
+    
+    @property
+    def value(self):
+        return self.avg
+Index('statisticsrollups_statistic_idx', StatisticsRollup.statistic_id, StatisticsRollup.resolution,
+      StatisticsRollup.timestamp, unique=True)
+Index('statisticsrollups_timestamp_idx', StatisticsRollup.resolution, StatisticsRollup.timestamp)
+statisticsdata_rolled_idx = Index('statisticsdata_rolled_idx', StatsistcsData.rolled, StatsistcsData.timestamp)
+statisticsrollups_rolled_idx = Index('statisticsrollups_rolled_idx', StatisticsRollup.resolution,
+                                     StatisticsRollup.rolled, StatisticsRollup.timestamp)
+
+# rollup resolutions from fine to coarse, each one is built from the one before
+ROLLUPS = (('minute', 60), ('hour', 3600), ('day', 86400))
+
+def get_resolution(start, stop, points=None):
+    """returns the resolution Statistic.get reads for start and stop, None for raw points"""
+    earliest = start if start is not None else stop
+    if earliest is None:
+        return None
+    if earliest.tzinfo is None:
+        earliest = pytz.utc.localize(earliest)
+    candidates = (('raw', None, get_statistic_resolution() or 1),) +\
+                 tuple((name, resolution, resolution) for name, resolution in ROLLUPS)
+    for name, resolution, seconds in candidates:
+        retention = get_statistic_retention(name)
+        if retention and earliest < now() - timedelta(days=retention):
+            continue
+        if points and start is not None and stop is not None and\
+           (stop - start).total_seconds() / seconds > points:
+            continue
+        return resolution
+    return ROLLUPS[-1][1]
+
+# source rows the rollup job reads to find pending buckets and marks at once
+ROLLUP_CHUNK = 1000
+
+@migration(6)
+def add_statistics_rolled(conn):
+    """adds the flag the rollup job tracks its progress with
+    
+    everything before the newest rollup of the next resolution was
+    rolled up by the former job, which only kept that watermark
+    """
+    rollups = StatisticsRollup.__table__
+    for table, index in ((StatsistcsData.__table__, statisticsdata_rolled_idx),
+                         (rollups, statisticsrollups_rolled_idx)):
+        add_column(conn, table.c.rolled)
+        if index.name not in [existing['name'] for existing in inspect(conn).get_indexes(table.name)]:
+            index.create(conn)
+    source = None
+    for name, resolution in ROLLUPS:
+        covered = conn.execute(select([func.max(rollups.c.timestamp)])
+                               .where(rollups.c.resolution == resolution)).scalar()
+        if covered is not None:
+            if source is None:
+                table = StatsistcsData.__table__
+                clauses = []
+            else:
+                table = rollups
+                clauses = [rollups.c.resolution == source]
+            conn.execute(table.update()
+                              .where(and_(table.c.timestamp < covered + timedelta(seconds=resolution), *clauses))
+                              .values(rolled=True))
+        source = resolution
+
+def _chunks(items, size=None):
+    items = list(items)
+    size = size or ROLLUP_CHUNK
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def _rollup(resolution, source, source_name, until):
+    """(re)aggregates the completed buckets of resolution that got new points from source (None for raw points)
+    
+    a bucket is rebuilt from all its source points, unless the source
+    retention may have pruned some of them already. Then its unrolled
+    points are added to the existing rollup instead, which keeps its last
+    value: the pruned points cannot tell whether a late point came after them.
+    returns the number of rollups written
+    """
+    rollups = StatisticsRollup.__table__
+    if source is None:
+        table = StatsistcsData.__table__
+        key = table.c.stat
+        columns = [table.c.statistic, table.c.timestamp, table.c.value.label('min'), table.c.value.label('max'),
+                   table.c.value.label('avg'), table.c.value.label('last'), literal(1).label('count'),
+                   table.c.rolled, key]
+        clauses = []
+    else:
+        table = rollups
+        key = table.c.rollup
+        columns = [table.c.statistic, table.c.timestamp,
+                   table.c.min, table.c.max, table.c.avg, table.c.last, table.c.count, table.c.rolled, key]
+        clauses = [table.c.resolution == source]
+    retention = get_statistic_retention(source_name)
+    pruned = now() - timedelta(days=retention) if retention else None
+    end = get_bucket(until, resolution)
+    written = 0
+    while True:
+        pending = rfk.database.session.execute(select([table.c.statistic, table.c.timestamp])
+                                               .where(and_(table.c.rolled == False,
+                                                           table.c.timestamp < end, *clauses))
+                                               .order_by(table.c.timestamp)
+                                               .limit(ROLLUP_CHUNK)).fetchall()
+        if not pending:
+            return written
+        keys = set((statistic, get_bucket(timestamp, resolution)) for statistic, timestamp in pending)
+        # adjacent buckets are read with one query
+        ranges = []
+        for bucket in sorted(set(bucket for statistic, bucket in keys)):
+            statistics = set(statistic for statistic, other in keys if other == bucket)
+            if ranges and ranges[-1][1] == bucket:
+                ranges[-1][1] = bucket + timedelta(seconds=resolution)
+                ranges[-1][2].update(statistics)
+            else:
+                ranges.append([bucket, bucket + timedelta(seconds=resolution), statistics])
+        buckets = {}
+        rolled = []
+        replaced = []
+        for start, stop, statistics in ranges:
+            for statistic, timestamp, min_, max_, avg, last, count, done, id in\
+                rfk.database.session.execute(select(columns)
+                                             .where(and_(table.c.statistic.in_(statistics),
+                                                         table.c.timestamp >= start,
+                                                         table.c.timestamp < stop, *clauses))
+                                             .order_by(table.c.timestamp)):
+                bucket_key = (statistic, get_bucket(timestamp, resolution))
+                if bucket_key not in keys:
+                    continue
+                if not done:
+                    rolled.append(id)
+                elif pruned is not None and bucket_key[1] < pruned:
+                    continue
+                if bucket_key not in buckets:
+                    buckets[bucket_key] = {'statistic': statistic, 'resolution': resolution,
+                                           'timestamp': bucket_key[1], 'min': min_, 'max': max_,
+                                           'sum': avg * count, 'last': last, 'count': count}
+                else:
+                    bucket = buckets[bucket_key]
+                    bucket['min'] = min(bucket['min'], min_)
+                    bucket['max'] = max(bucket['max'], max_)
+                    bucket['sum'] += avg * count
+                    bucket['last'] = last
+                    bucket['count'] += count
+            for id, statistic, timestamp, min_, max_, avg, last, count in\
+                rfk.database.session.execute(select([rollups.c.rollup, rollups.c.statistic, rollups.c.timestamp,
+                                                     rollups.c.min, rollups.c.max, rollups.c.avg,
+                                                     rollups.c.last, rollups.c.count])
+                                             .where(and_(rollups.c.resolution == resolution,
+                                                         rollups.c.statistic.in_(statistics),
+                                                         rollups.c.timestamp >= start,
+                                                         rollups.c.timestamp < stop))):
+                bucket_key = (statistic, timestamp)
+                if bucket_key not in buckets:
+                    continue
+                replaced.append(id)
+                if pruned is not None and timestamp < pruned:
+                    # only the unrolled points were read above
+                    bucket = buckets[bucket_key]
+                    bucket['min'] = min(bucket['min'], min_)
+                    bucket['max'] = max(bucket['max'], max_)
+                    bucket['sum'] += avg * count
+                    bucket['last'] = last
+                    bucket['count'] += count
+        for bucket in buckets.itervalues():
+            bucket['avg'] = float(bucket.pop('sum')) / bucket['count']
+        for ids in _chunks(replaced):
+            rfk.database.session.execute(rollups.delete().where(rollups.c.rollup.in_(ids)))
+        if buckets:
+            rfk.database.session.execute(rollups.insert(), buckets.values())
+        for ids in _chunks(rolled):
+            rfk.database.session.execute(table.update().where(key.in_(ids)).values(rolled=True))
+        written += len(buckets)
+
+def rollup_statistics(until=None):
+    """rolls up all buckets completed until until (now) that got new points since the last run
+    
+    returns the number of rollups written, the caller commits
+    """
+    if until is None:
+        until = now()
+    written = 0
+    source, source_name = None, 'raw'
+    for name, resolution in ROLLUPS:
+        written += _rollup(resolution, source, source_name, until)
+        source, source_name = resolution, name
+    return written
+
+def prune_statistics(until=None):
+    """deletes data points and rollups older than their retention
+    
+    points are only deleted once the next coarser resolution covers them.
+    returns the number of rows deleted, the caller commits
+    """
+    if until is None:
+        until = now()
+    rollups = StatisticsRollup.__table__
+    levels = (('raw', None),) + ROLLUPS
+    deleted = 0
+    for (name, resolution), coarser in zip(levels, [resolution for name, resolution in ROLLUPS] + [None]):
+        retention = get_statistic_retention(name)
+        if not retention:
+            continue
+        before = until - timedelta(days=retention)
+        if resolution is None:
+            table = StatsistcsData.__table__
+            clauses = []
+        else:
+            table = rollups
+            clauses = [rollups.c.resolution == resolution]
+        if coarser is not None:
+            clauses.append(table.c.rolled == True)
+        query = table.delete().where(and_(table.c.timestamp < before, *clauses))
+        deleted += rfk.database.session.execute(query).rowcount
+    return deleted
     
 
 class RelayStatistic(Base):
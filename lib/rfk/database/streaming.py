@@ -1,20 +1,137 @@
 from sqlalchemy import *
 from sqlalchemy.orm import relationship, backref, exc
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
 from sqlalchemy.dialects.mysql import INTEGER as Integer
-from datetime import datetime
+from datetime import datetime, timedelta
+import calendar
 import netaddr
 import pygeoip
 import re
+import time
+import threading
 
-from rfk.database import Base, UTCDateTime
+from rfk.database import Base, UTCDateTime, migration, add_column
 from rfk.database.stats import Statistic
 from rfk.types import ENUM, SET
 from rfk import CONFIG
-from rfk.helper import now, get_location
+from rfk.helper import now, get_location, get_path
+from rfk.helper.counters import SharedCounters
 import rfk.database
 import rfk.icecast
 from rfk.exc.streaming import *
 
+# kinds of the shared listener counters
+COUNTER_TOTAL = 1
+COUNTER_STREAM = 2
+COUNTER_RELAY = 3
+COUNTER_STREAM_RELAY = 4
+
+listener_counters = None # loaded on first use, see get_listener_counters
+_listener_counters_lock = threading.Lock()
+
+def get_listener_counters():
+    """returns the SharedCounters holding the number of connected listeners
+    or None if [icecast] counters is not configured"""
+    global listener_counters
+    if listener_counters is None and CONFIG.has_option('icecast', 'counters'):
+        with _listener_counters_lock:
+            if listener_counters is None:
+                listener_counters = SharedCounters(get_path(CONFIG.get('icecast', 'counters')))
+    return listener_counters
+
+def get_counters_reconcile_interval():
+    if CONFIG.has_option('icecast', 'counters-reconcile'):
+        return CONFIG.getint('icecast', 'counters-reconcile')
+    return 60
+
+def count_listeners(kind, id, count):
+    """returns a shared listener counter, count() is used without shared counters
+    
+    the counters are reconciled against the listeners table by whoever
+    reads them first after the reconcile interval passed
+    """
+    counters = get_listener_counters()
+    if counters is None:
+        return count()
+    if time.time() - counters.get_reconciled() >= get_counters_reconcile_interval():
+        reconcile_listener_counters(counters)
+    return counters.get(kind, id)
+
+def reconcile_listener_counters(counters, force=False):
+    """recounts all connected listeners"""
+    with counters.locked():
+        if not force and time.time() - counters.get_reconciled() < get_counters_reconcile_interval():
+            # somebody else was faster
+            return
+        listeners = Listener.__table__
+        stream_relays = StreamRelay.__table__
+        # a connection of its own, the current transaction may not see the latest commits.
+        # unless the pool hands every thread one connection (in-memory sqlite), closing
+        # it would roll back the transaction of the session
+        shared = isinstance(rfk.database.engine.pool, (SingletonThreadPool, StaticPool))
+        conn = rfk.database.session.connection() if shared else rfk.database.engine.connect()
+        try:
+            rows = conn.execute(select([stream_relays.c.stream_relay, stream_relays.c.stream, stream_relays.c.relay,
+                                        func.count(listeners.c.listener)])
+                                .select_from(stream_relays.outerjoin(listeners,
+                                                                     and_(listeners.c.stream_relay == stream_relays.c.stream_relay,
+                                                                          listeners.c.disconnect == None)))
+                                .group_by(stream_relays.c.stream_relay, stream_relays.c.stream, stream_relays.c.relay)).fetchall()
+            total = conn.execute(select([func.count(listeners.c.listener)])
+                                 .where(listeners.c.disconnect == None)).scalar()
+        finally:
+            if not shared:
+                conn.close()
+        values = {(COUNTER_TOTAL, 0): total}
+        for stream_relay, stream, relay, count in rows:
+            values[(COUNTER_STREAM_RELAY, stream_relay)] = count
+            values[(COUNTER_STREAM, stream)] = values.get((COUNTER_STREAM, stream), 0) + count
+            values[(COUNTER_RELAY, relay)] = values.get((COUNTER_RELAY, relay), 0) + count
+        counters.replace(values)
+
+def commit_listener_changes(deltas):
+    """commits the session and applies the changed number of listeners to the shared counters
+    
+    Keyword arguments:
+    deltas -- {stream_relay id: connected - disconnected listeners}
+    
+    """
+    counters = get_listener_counters()
+    deltas = dict((stream_relay, delta) for stream_relay, delta in deltas.iteritems() if delta)
+    if counters is None or not deltas:
+        rfk.database.session.commit()
+        return
+    rows = rfk.database.session.query(StreamRelay.stream_relay, StreamRelay.stream_id, StreamRelay.relay_id)\
+                               .filter(StreamRelay.stream_relay.in_(deltas.keys())).all()
+    # the commit runs without the lock, nobody waits on the database round trip
+    reconciled = counters.get_reconciled()
+    rfk.database.session.commit()
+    with counters.locked():
+        if counters.get_reconciled() != reconciled:
+            # a reconcile ran meanwhile and may have counted the commit already,
+            # let the next reader recount instead of guessing
+            counters.set_reconciled(0.)
+            return
+        for stream_relay, stream, relay in rows:
+            delta = deltas[stream_relay]
+            counters.add(COUNTER_STREAM_RELAY, stream_relay, delta)
+            counters.add(COUNTER_STREAM, stream, delta)
+            counters.add(COUNTER_RELAY, relay, delta)
+            counters.add(COUNTER_TOTAL, 0, delta)
+
+def get_changed_listeners(stat, delta, count):
+    """returns the number of listeners after a change of delta listeners
+    
+    the shared counters already know, without them the last value of stat
+    is adjusted instead of recounting, count() is only used if there is none
+    """
+    if delta is None or get_listener_counters() is not None:
+        return count()
+    last = stat.current_value()
+    if last is None:
+        return count()
+    return max(last.value + delta, 0)
+
 
 class Listener(Base):
     """database representation of a Listener"""
@@ -53,27 +170,48 @@ class Listener(Base):
         return listeners
     
     @staticmethod
-    def create(address, client, useragent, stream_relay):
-        """adds a new listener to the database"""
-        listener = Listener()
+    def get_address_column(address):
+        """returns the address of a listener as stored in the database, None unless icecast.log_ip is set"""
         if rfk.CONFIG.getboolean('icecast', 'log_ip'):
-            listener.address = int(netaddr.IPAddress(address))
-        listener.client = client
-        loc = get_location(address)
+            return int(netaddr.IPAddress(address))
+        return None
+    
+    @staticmethod
+    def get_location_columns(address):
+        """returns city and country of a listener as stored in the database"""
+        columns = {'city': None, 'country': None}
+        loc = get_location(address) or {}
         if 'city' in loc and loc['city'] is not None:
-            listener.city = loc['city'].decode('latin-1') #FICK DICH MAXMIND
+            columns['city'] = loc['city']
         if 'country_code' in loc and loc['country_code'] is not None:
-            listener.country = loc['country_code']
+            columns['country'] = loc['country_code']
+        return columns
+    
+    @staticmethod
+    def create(address, client, useragent, stream_relay):
+        """adds a new listener to the database, country and city are filled in the background"""
+        from rfk.icecast.enrichment import get_location_enricher
+        enricher = get_location_enricher()
+        listener = Listener()
+        listener.address = Listener.get_address_column(address)
+        if enricher is None:
+            columns = Listener.get_location_columns(address)
+            listener.city = columns['city']
+            listener.country = columns['country']
+        listener.client = client
         listener.useragent = useragent
         listener.connect = now()
         listener.stream_relay = stream_relay
         rfk.database.session.add(listener)
         rfk.database.session.flush()
+        if enricher is not None:
+            enricher.submit(listener.listener, address)
         return listener
     
     @staticmethod
     def get_total_listener():
-        return Listener.query.filter(Listener.disconnect == None).count()
+        return count_listeners(COUNTER_TOTAL, 0,
+                               lambda: Listener.query.filter(Listener.disconnect == None).count())
     
     def set_disconnected(self):
         """updates the listener to disconnected state"""
@@ -82,6 +220,73 @@ class Listener(Base):
 """Listener Indices"""
 Index('listeners_disconnect_idx', Listener.disconnect)
 
+
+class ListenerHistory(Base):
+    """closed listener sessions moved out of listeners by archive_listeners"""
+    __tablename__ = 'listener_history'
+    listener = Column(Integer(unsigned=True), primary_key=True, autoincrement=False)
+    connect = Column(UTCDateTime)
+    disconnect = Column(UTCDateTime)
+    country = Column(String(3))
+    city = Column(String(50))
+    address = Column(Integer(unsigned=True))
+    client = Column(Integer(unsigned=True))
+    useragent = Column(String(255))
+    stream_relay_id = Column("stream_relay",
+                             Integer(unsigned=True),
+                             ForeignKey('stream_relays.stream_relay',
+                                        onupdate="CASCADE",
+                                        ondelete="RESTRICT"))
+    stream_relay = relationship("StreamRelay")
+    show_id = Column("show",Integer(unsigned=True),
+                             ForeignKey('shows.show',
+                                        onupdate="CASCADE",
+                                        ondelete="RESTRICT"))
+    show = relationship("Show")
+
+# ListenerHistory Indices
+Index('listener_history_connect_idx', ListenerHistory.connect)
+Index('listener_history_disconnect_idx', ListenerHistory.disconnect)
+
+
+def get_listener_archive_age():
+    """seconds a listener has to be disconnected before it is archived"""
+    if CONFIG.has_option('icecast', 'archive-after'):
+        return CONFIG.getint('icecast', 'archive-after')
+    return 3600
+
+def archive_listeners(before=None, batch_size=1000, limit=None):
+    """moves listeners disconnected before before into listener_history
+    
+    every batch is moved in a transaction of its own, so the hot
+    table is never locked for long. returns the number of listeners moved
+    """
+    if before is None:
+        before = now() - timedelta(seconds=get_listener_archive_age())
+    listeners = Listener.__table__
+    history = ListenerHistory.__table__
+    names = [column.name for column in listeners.c]
+    # the newest row always stays, some databases derive the next id from the highest one left
+    newest = rfk.database.session.execute(select([func.max(listeners.c.listener)])).scalar()
+    moved = 0
+    while limit is None or moved < limit:
+        size = batch_size if limit is None else min(batch_size, limit - moved)
+        ids = [row[0] for row in rfk.database.session.execute(select([listeners.c.listener])
+                                                              .where(and_(listeners.c.disconnect != None,
+                                                                          listeners.c.disconnect < before,
+                                                                          listeners.c.listener < newest))
+                                                              .order_by(listeners.c.listener)
+                                                              .limit(size))]
+        if not ids:
+            break
+        rfk.database.session.execute(history.insert().from_select(names,
+                                                                  select([listeners.c[name] for name in names])
+                                                                  .where(listeners.c.listener.in_(ids))))
+        rfk.database.session.execute(listeners.delete().where(listeners.c.listener.in_(ids)))
+        rfk.database.session.commit()
+        moved += len(ids)
+    return moved
+
 class Stream(Base):
     """database representation of an outputStream"""
     __tablename__ = 'streams'
@@ -147,11 +352,14 @@ class Stream(Base):
         return self.statistic
     
     def get_current_listeners(self):
-        return Listener.query.join(StreamRelay).filter(StreamRelay.stream == self, Listener.disconnect == None).count()
+        return count_listeners(COUNTER_STREAM, self.stream,
+                               lambda: Listener.query.join(StreamRelay).filter(StreamRelay.stream == self,
+                                                                               Listener.disconnect == None).count())
     
-    def update_statistic(self):
+    def update_statistic(self, delta=None):
+        """stores the current number of listeners, delta is the change since the last call if known"""
         stat = self.get_statistic()
-        stat.set(now(), self.get_current_listeners())
+        stat.set(now(), get_changed_listeners(stat, delta, self.get_current_listeners))
     
     
 class Relay(Base):
@@ -265,11 +473,14 @@ class Relay(Base):
         return self.statistic
     
     def get_current_listeners(self):
-        return Listener.query.join(StreamRelay).filter(StreamRelay.relay == self, Listener.disconnect == None).count()
+        return count_listeners(COUNTER_RELAY, self.relay,
+                               lambda: Listener.query.join(StreamRelay).filter(StreamRelay.relay == self,
+                                                                               Listener.disconnect == None).count())
     
-    def update_statistic(self):
+    def update_statistic(self, delta=None):
+        """stores the current number of listeners, delta is the change since the last call if known"""
         stat = self.get_statistic()
-        stat.set(now(), self.get_current_listeners())
+        stat.set(now(), get_changed_listeners(stat, delta, self.get_current_listeners))
             
 class StreamRelay(Base):
     __tablename__ = 'stream_relays'
@@ -296,12 +507,13 @@ class StreamRelay(Base):
         self.stream = stream
         
     def set_offline(self):
-        """sets this combination of stream and relay to offline"""
+        """sets this combination of stream and relay to offline
+           returns the number of listeners that were disconnected"""
         self.status = StreamRelay.STATUS.OFFLINE
-        connected_listeners = Listener.query.filter(Listener.stream_relay == self,
-                                                    Listener.disconnect == None).all()
-        for listener in connected_listeners:
-            listener.disconnect = now()
+        # one UPDATE, the listeners are not loaded
+        return Listener.query.filter(Listener.stream_relay_id == self.stream_relay,
+                                     Listener.disconnect == None)\
+                             .update({Listener.disconnect: now()}, synchronize_session=False)
             
     def get_statistic(self):
         if self.statistic is None:
@@ -312,8 +524,287 @@ class StreamRelay(Base):
         return self.statistic
     
     def get_current_listeners(self):
-        return Listener.query.filter(Listener.stream_relay == self, Listener.disconnect == None).count()
+        return count_listeners(COUNTER_STREAM_RELAY, self.stream_relay,
+                               lambda: Listener.query.filter(Listener.stream_relay == self,
+                                                             Listener.disconnect == None).count())
     
-    def update_statistic(self):
+    def update_statistic(self, delta=None):
+        """stores the current number of listeners, delta is the change since the last call if known"""
         stat = self.get_statistic()
-        stat.set(now(), self.get_current_listeners())
\ No newline at end of file
+        stat.set(now(), get_changed_listeners(stat, delta, self.get_current_listeners))
+
+
+def _epoch(timestamp):
+    return calendar.timegm(timestamp.utctimetuple())
+
+class ShowListenerStats(Base):
+    """listeners of a show, maintained while the show runs
+    
+    one row per stream and one with stream None for all streams together.
+    while running the listener-seconds are listeners * now - moment (moment
+    sums the epoch seconds of the connects minus the ones of the disconnects),
+    so every listener change is a plain increment. finalize() stores them.
+    clients counts the listener sessions that were part of the show.
+    changes stored late count from started on, the listeners were already
+    there when the show (re)started.
+    """
+    __tablename__ = 'show_listener_stats'
+    show_listener_stat = Column(Integer(unsigned=True), primary_key=True, autoincrement=True)
+    show_id = Column("show", Integer(unsigned=True),
+                             ForeignKey('shows.show',
+                                        onupdate="CASCADE",
+                                        ondelete="RESTRICT"), nullable=False)
+    show = relationship("Show", backref=backref('listener_stats'))
+    stream_id = Column("stream", Integer(unsigned=True),
+                                 ForeignKey('streams.stream',
+                                            onupdate="CASCADE",
+                                            ondelete="RESTRICT"))
+    stream = relationship("Stream")
+    running = Column(Boolean, nullable=False, default=True)
+    listeners = Column(Integer, nullable=False, default=0)
+    moment = Column(BigInteger, nullable=False, default=0)
+    listener_seconds = Column(BigInteger, nullable=False, default=0)
+    peak = Column(Integer, nullable=False, default=0)
+    clients = Column(Integer, nullable=False, default=0)
+    # when counting (re)started and when it stopped last
+    started = Column(UTCDateTime())
+    stopped = Column(UTCDateTime())
+    
+    def get_listener_seconds(self, timestamp=None):
+        if not self.running:
+            return self.listener_seconds
+        return self.listeners * _epoch(timestamp or now()) - self.moment
+    
+    @property
+    def listener_minutes(self):
+        return self.get_listener_seconds() / 60.
+    
+    @staticmethod
+    def get(show, stream=None):
+        """returns the stats of show (for a stream or for all streams) or None"""
+        try:
+            return ShowListenerStats.query.filter(ShowListenerStats.show_id == show.show,
+                                                  ShowListenerStats.stream_id == stream).one()
+        except exc.NoResultFound:
+            return None
+    
+    @staticmethod
+    def start(show, timestamp=None):
+        """starts (or resumes) counting the listeners of show, the connected ones are its first"""
+        timestamp = timestamp or now()
+        t = _epoch(timestamp)
+        rows = dict((row.stream_id, row) for row in
+                    ShowListenerStats.query.filter(ShowListenerStats.show_id == show.show).all())
+        current = [(stream, stream.get_current_listeners()) for stream in Stream.query.all()]
+        current.append((None, Listener.get_total_listener()))
+        rejoined = {}
+        for stream, listeners in current:
+            stream_id = stream.stream if stream is not None else None
+            row = rows.get(stream_id)
+            if row is None:
+                row = ShowListenerStats(show=show, stream_id=stream_id, listener_seconds=0, peak=0,
+                                        clients=listeners, listeners=0)
+                rfk.database.session.add(row)
+            elif row.running:
+                continue
+            elif row.stopped is not None:
+                # on a resume the ones still there from before were already counted
+                if row.stopped not in rejoined:
+                    rejoined[row.stopped] = ShowListenerStats._count_connected_since(row.stopped)
+                row.clients += min(rejoined[row.stopped].get(stream_id, 0), listeners)
+            else:
+                row.clients += max(listeners - row.listeners, 0)
+            row.running = True
+            row.started = timestamp
+            row.listeners = listeners
+            row.moment = listeners * t - row.listener_seconds
+            row.peak = max(row.peak, listeners)
+        rfk.database.session.flush()
+    
+    @staticmethod
+    def _count_connected_since(timestamp):
+        """returns {stream id (None for all): connected listeners that connected after timestamp}"""
+        counts = dict(rfk.database.session.query(StreamRelay.stream_id, func.count(Listener.listener))
+                                          .join(Listener, Listener.stream_relay_id == StreamRelay.stream_relay)
+                                          .filter(Listener.disconnect == None, Listener.connect >= timestamp)
+                                          .group_by(StreamRelay.stream_id).all())
+        counts[None] = sum(counts.values())
+        return counts
+    
+    @staticmethod
+    def finalize(show, timestamp=None):
+        """stops counting the listeners of show"""
+        timestamp = timestamp or now()
+        table = ShowListenerStats.__table__
+        rfk.database.session.execute(table.update()
+                                          .where(and_(table.c.show == show.show, table.c.running == True))
+                                          .values(listener_seconds=table.c.listeners * _epoch(timestamp)
+                                                                   - table.c.moment,
+                                                  running=False, stopped=timestamp))
+    
+    @staticmethod
+    def record(changes):
+        """applies changed listeners to the stats of the running shows
+        
+        Keyword arguments:
+        changes -- [(stream_relay id, timestamp, connected - disconnected listeners[, new clients])],
+                   new clients defaults to the connected listeners
+        
+        """
+        changes = [change for change in changes if change[2]]
+        if not changes:
+            return
+        table = ShowListenerStats.__table__
+        rows = rfk.database.session.execute(select([table.c.show_listener_stat, table.c.stream, table.c.started])
+                                            .where(table.c.running == True)).fetchall()
+        if not rows:
+            return
+        streams = dict(rfk.database.session.query(StreamRelay.stream_relay, StreamRelay.stream_id)
+                                           .filter(StreamRelay.stream_relay.in_(set(change[0] for change in changes)))
+                                           .all())
+        changes = sorted(changes, key=lambda entry: entry[1])
+        for row, stream, started in rows:
+            # delta, highest delta within the changes, moment, clients
+            delta, rise, moment, clients = 0, 0, 0, 0
+            for entry in changes:
+                stream_relay, timestamp, change = entry[:3]
+                if stream is not None and streams.get(stream_relay) != stream:
+                    continue
+                delta += change
+                rise = max(rise, delta)
+                if started is not None:
+                    timestamp = max(timestamp, started)
+                moment += change * _epoch(timestamp)
+                clients += entry[3] if len(entry) > 3 else max(change, 0)
+            if not (delta or rise or moment or clients):
+                continue
+            clauses = [table.c.running == True, table.c.show_listener_stat == row]
+            if rise > 0:
+                rfk.database.session.execute(table.update()
+                                                  .where(and_(table.c.listeners + rise > table.c.peak, *clauses))
+                                                  .values(peak=table.c.listeners + rise))
+            rfk.database.session.execute(table.update()
+                                              .where(and_(*clauses))
+                                              .values(listeners=table.c.listeners + delta,
+                                                      moment=table.c.moment + moment,
+                                                      clients=table.c.clients + clients))
+
+# ShowListenerStats Indices
+Index('show_listener_stats_show_idx', ShowListenerStats.show_id, ShowListenerStats.stream_id)
+Index('show_listener_stats_running_idx', ShowListenerStats.running)
+
+@migration(7)
+def add_show_listener_stats_started(conn):
+    """adds when the stats of a show started and stopped counting, running ones count from now on"""
+    table = ShowListenerStats.__table__
+    add_column(conn, table.c.started)
+    add_column(conn, table.c.stopped)
+    conn.execute(table.update().where(table.c.running == True).values(started=now()))
+
+
+class Topology(object):
+    """process local lookup table of relays, streams and their combinations
+    
+    maps (address, port, mount) as sent by icecast to the ids of the Relay,
+    Stream and StreamRelay and keeps the auth credentials of every relay, so
+    the backend callbacks do not have to query for them.
+    the table is rebuilt after invalidate() or when the number or the
+    highest id of relays, streams or stream_relays changed (checked at most
+    every check_interval seconds, which covers changes in other processes).
+    a miss checks right away, another process may just have added it
+    """
+    
+    check_interval = 30
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.relays = None
+        self.mounts = None
+        self.stream_relays = None
+        self.signature = None
+        self.checked = 0
+        
+    def _check(self, force=False):
+        if self.relays is not None and not force and time.time() - self.checked < self.check_interval:
+            return
+        self.checked = time.time()
+        signature = tuple(rfk.database.session.query(func.count(Relay.relay), func.max(Relay.relay)).one()) +\
+                    tuple(rfk.database.session.query(func.count(Stream.stream), func.max(Stream.stream)).one()) +\
+                    tuple(rfk.database.session.query(func.count(StreamRelay.stream_relay),
+                                                     func.max(StreamRelay.stream_relay)).one())
+        if signature != self.signature:
+            self.signature = signature
+            self.relays = None
+            
+    def _build(self):
+        self.relays = {}
+        for relay, address, port, auth_username, auth_password in \
+                rfk.database.session.query(Relay.relay, Relay.address, Relay.port,
+                                           Relay.auth_username, Relay.auth_password).all():
+            self.relays[(address, int(port))] = {'relay': relay,
+                                                 'auth_username': auth_username,
+                                                 'auth_password': auth_password}
+        self.mounts = dict(rfk.database.session.query(Stream.mount, Stream.stream).all())
+        self.stream_relays = dict(((relay, stream), stream_relay) for stream_relay, relay, stream in
+                                  rfk.database.session.query(StreamRelay.stream_relay, StreamRelay.relay_id,
+                                                             StreamRelay.stream_id).all())
+        
+    def _load(self, force=False):
+        self._check(force)
+        if self.relays is None:
+            self._build()
+            
+    def get_relay(self, address, port):
+        """returns {'relay', 'auth_username', 'auth_password'} of the relay at address:port or None"""
+        with self.lock:
+            self._load()
+            relay = self.relays.get((address, int(port)))
+            if relay is None:
+                self._load(force=True)
+                relay = self.relays.get((address, int(port)))
+            return relay
+        
+    def _find(self, address, port, mount):
+        relay = self.relays.get((address, int(port)))
+        relay = relay['relay'] if relay is not None else None
+        stream = self.mounts.get(mount)
+        return relay, stream, self.stream_relays.get((relay, stream))
+        
+    def lookup(self, address, port, mount):
+        """returns the ids (relay, stream, stream_relay), each of them may be None"""
+        with self.lock:
+            self._load()
+            ids = self._find(address, port, mount)
+            if None in ids:
+                self._load(force=True)
+                ids = self._find(address, port, mount)
+            return ids
+        
+    def resolve(self, address, port, mount):
+        """like lookup, but asks the database before reporting a stream_relay as unknown
+        
+        the signature can miss changes that keep the counts and highest ids,
+        a stream_relay found that way rebuilds the table on the next lookup
+        """
+        ids = self.lookup(address, port, mount)
+        if ids[2] is not None:
+            return ids
+        row = rfk.database.session.query(Relay.relay, Stream.stream, StreamRelay.stream_relay)\
+                                  .select_from(Relay)\
+                                  .join(Stream, Stream.mount == mount)\
+                                  .outerjoin(StreamRelay, and_(StreamRelay.relay_id == Relay.relay,
+                                                               StreamRelay.stream_id == Stream.stream))\
+                                  .filter(Relay.address == address, Relay.port == int(port)).first()
+        if row is None:
+            return ids
+        if row[2] is not None:
+            self.invalidate()
+        return tuple(row)
+        
+    def invalidate(self):
+        """forces a rebuild on the next lookup"""
+        with self.lock:
+            self.relays = None
+            self.signature = None
+
+topology = Topology()
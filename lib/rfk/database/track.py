@@ -1,13 +1,16 @@
 from sqlalchemy import *
-from sqlalchemy.orm import relationship, backref, exc
+from sqlalchemy import event
+from sqlalchemy.orm import relationship, backref, exc, Session
 from sqlalchemy.dialects.mysql import INTEGER as Integer
 
 from rfk.database import Base, UTCDateTime
 from rfk.helper import now
+from rfk.types import LRUCache
 import rfk.database
 
 from datetime import datetime
 import pytz
+import unicodedata
 
 class Track(Base):
     """Database representation of a Track played in a show"""
@@ -50,12 +53,13 @@ class Track(Base):
             current_track = Track.current_track()
             if current_track:
                 current_track.end_track()
-        title = Title.add_title(artist, title)
+        title_id = Title.get_title_id(artist, title)
         if begin is None:
             begin = now()
-        track = Track(title=title, begin=begin, show=show)
+        track = Track(title_id=title_id, begin=begin, show=show)
         rfk.database.session.add(track)
         rfk.database.session.flush()
+        return track
 
 """Track Indices"""
 Index('curr_track_idx', Track.end)
@@ -83,28 +87,84 @@ class Title(Base):
     @staticmethod
     def add_title(artist, title, length=None):
         """adds and returns a new track to the database, or returns a track if it's already exsisting"""
-        try:
-            t = Title.query.join(MetaTitle).\
-                            join(Artist).\
-                            join(MetaArtist).\
-                            filter(MetaTitle.name == title,
-                                   MetaArtist.name == artist).one()
-        except exc.NoResultFound:
+        t, m = Title._add_title(artist, title)
+        if length is not None:
+            m.update_length(length)
+        return t
+    
+    @staticmethod
+    def _add_title(artist, title):
+        """returns the Title and MetaTitle for artist and title, creating them if needed"""
+        t = Title.query.join(MetaTitle).\
+                        join(Artist).\
+                        join(MetaArtist).\
+                        filter(MetaTitle.name == title,
+                               MetaArtist.name == artist).\
+                        order_by(Title.title).first()
+        if t is None:
             a = Artist.get_artist(artist)
             t = Title(artist=a, name=title)
             rfk.database.session.add(t)
             rfk.database.session.flush()
         
-        try:
-            m = MetaTitle.query.filter(MetaTitle.title == t, MetaTitle.name == title).one()
-        except exc.NoResultFound:
+        m = MetaTitle.query.filter(MetaTitle.title == t, MetaTitle.name == title).\
+                            order_by(MetaTitle.metatitle).first()
+        if m is None:
             m = MetaTitle(name=title, title=t)
             rfk.database.session.add(m)
             rfk.database.session.flush()
-        
-        if length is not None:
-            m.update_length(length)
-        return t
+        _remember_title(rfk.database.session(), _title_key(artist, title), (t.title, m.metatitle))
+        return (t, m)
+    
+    @staticmethod
+    def get_title_id(artist, title):
+        """returns the id of the Title for artist and title
+        repeated lookups are answered from title_cache without touching the database"""
+        ids = title_cache.get(_title_key(artist, title))
+        if ids is not None:
+            return ids[0]
+        t, m = Title._add_title(artist, title)
+        return t.title
+    
+    @staticmethod
+    def warm_cache(limit=500):
+        """fills title_cache with the most recently played titles"""
+        qry = rfk.database.session.query(MetaArtist.name, MetaTitle.name, Title.title, MetaTitle.metatitle).\
+                                   select_from(Track).\
+                                   join(Title, Track.title_id == Title.title).\
+                                   join(MetaTitle, MetaTitle.title_id == Title.title).\
+                                   join(Artist, Title.artist_id == Artist.artist).\
+                                   join(MetaArtist, MetaArtist.artist_id == Artist.artist).\
+                                   order_by(Track.begin.desc()).limit(limit)
+        # oldest first, so the most recent ones end up as most recently used
+        for artist, title, title_id, metatitle_id in reversed(qry.all()):
+            title_cache.put(_title_key(artist, title), (title_id, metatitle_id))
+
+
+# (artist, title) -> (title id, metatitle id) of known titles
+title_cache = LRUCache(2048)
+
+def _title_key(artist, title):
+    if isinstance(artist, str):
+        artist = artist.decode('utf-8')
+    if isinstance(title, str):
+        title = title.decode('utf-8')
+    return (unicodedata.normalize('NFC', artist or u''),
+            unicodedata.normalize('NFC', title or u''))
+
+def _remember_title(session, key, ids):
+    """rows created in this transaction may still be rolled back,
+       so they only go into the cache once the session commits"""
+    session.info.setdefault('rfk.title_cache', {})[key] = ids
+
+@event.listens_for(Session, 'after_commit')
+def _title_cache_commit(session):
+    for key, ids in session.info.pop('rfk.title_cache', {}).iteritems():
+        title_cache.put(key, ids)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _title_cache_rollback(session, previous_transaction):
+    session.info.pop('rfk.title_cache', None)
 
 
 class MetaTitle(Base):
@@ -11,6 +11,14 @@ class UserNameTakenException(Exception):
 class InvalidPasswordException(Exception):
     pass
 
+class SchemaOutdatedException(Exception):
+    
+    def __init__(self, version, expected):
+        Exception.__init__(self, 'database schema is at version %s, this code needs %d, run rfk-migrate'
+                                 % (version, expected))
+        self.version = version
+        self.expected = expected
+
 class InvalidSettingException(Exception):
     
     def __init__(self, reason):
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''
+Created on Oct 17, 2013
+
+Lightweight client for the liquidsoaphandler daemon.
+
+This is what liquidsoap calls for every harbor event, so it must stay cheap:
+no database, no GeoIP, no flask, just the config and a unix socket.
+The config is located like rfk.init() does, without importing flask for it.
+If no daemon is listening, or it goes away before answering, the command is
+executed in-process instead.
+'''
+
+import argparse
+import json
+import os
+import socket
+import sys
+from ConfigParser import SafeConfigParser
+
+buffer_size = 1024
+
+
+def write(_socket, data):
+    f = _socket.makefile('wb', buffer_size)
+    f.write(json.dumps(data))
+    f.write('\n')
+    f.close()
+
+
+def read(_socket):
+    f = _socket.makefile('rb', buffer_size)
+    line = f.readline()
+    f.close()
+    if not line:
+        raise EOFError
+    return json.loads(line)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='PyRfK Interface for liquidsoap',
+                                     epilog='Anyways this should normally not called manually')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--local', action='store_true',
+                        help='do not use the handler daemon, run the command in this process')
+    parser.add_argument('--socket', help='path of the handler daemon socket, defaults to the config')
+    subparsers = parser.add_subparsers(dest='command', help='sub-command help')
+
+    authparser = subparsers.add_parser('auth', help='a help')
+    authparser.add_argument('username')
+    authparser.add_argument('password')
+
+    metadataparser = subparsers.add_parser('meta', help='a help')
+    metadataparser.add_argument('data', metavar='data', help='mostly some json encoded string from liquidsoap')
+    connectparser = subparsers.add_parser('connect', help='a help')
+    connectparser.add_argument('data', metavar='data', help='mostly some json encoded string from liquidsoap')
+    disconnectparser = subparsers.add_parser('disconnect', help='a help')
+    disconnectparser.add_argument('data', metavar='data', help='mostly some json encoded string from liquidsoap')
+    playlistparser = subparsers.add_parser('playlist', help='a help')
+    listenerparser = subparsers.add_parser('listenercount', help='prints total listenercount')
+    statusparser = subparsers.add_parser('status', help='prints the backlogs of the handler daemon')
+    return parser
+
+
+def find_prefix():
+    """returns (prefix, package_path) of the rfk package like flask.helpers.find_package"""
+    package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    site_parent, site_folder = os.path.split(package_path)
+    py_prefix = os.path.abspath(sys.prefix)
+    if package_path.startswith(py_prefix):
+        return py_prefix, package_path
+    elif site_folder.lower() == 'site-packages':
+        parent, folder = os.path.split(site_parent)
+        if folder.lower() == 'lib':
+            return parent, package_path
+        elif os.path.basename(parent).lower() == 'lib':
+            return os.path.dirname(parent), package_path
+        return site_parent, package_path
+    return None, package_path
+
+
+def get_socket_path():
+    """returns the path of the daemon socket from the config or None"""
+    prefix, package_path = find_prefix()
+    config_locations = []
+    if prefix is not None:
+        config_locations.append(os.path.join(prefix, 'local', 'etc', 'rfk-config.cfg'))
+        config_locations.append(os.path.join(prefix, 'etc', 'rfk-config.cfg'))
+        config_locations.append(os.path.join(prefix, 'rfk-config.cfg'))
+    config_locations.append(os.path.join(package_path, 'rfk', 'rfk-config.cfg'))
+    config = SafeConfigParser()
+    config.read(config_locations)
+    if not config.has_option('liquidsoap-handler', 'socket'):
+        return None
+    path = config.get('liquidsoap-handler', 'socket')
+    # same as rfk.helper.get_path
+    if os.path.isabs(path):
+        return path
+    return os.path.join(prefix if prefix is not None else package_path, path)
+
+
+def get_command_args(args):
+    """returns the positional arguments of a parsed command as list"""
+    if args.command == 'auth':
+        return [args.username, args.password]
+    elif args.command in ('meta', 'connect', 'disconnect'):
+        return [args.data]
+    return []
+
+
+class HandlerClient(object):
+
+    timeout = 30
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def connect(self):
+        self.sock.connect(self.path)
+        self.sock.settimeout(self.timeout)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+
+    def execute(self, command, args):
+        """sends a command to the daemon and returns (output, error)"""
+        write(self.sock, {'command': command, 'args': args})
+        response = read(self.sock)
+        return (response.get('output', ''), response.get('error'))
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    path = None if args.local else (args.socket or get_socket_path())
+    if path is not None:
+        client = HandlerClient(path)
+        try:
+            client.connect()
+        except socket.error:
+            client.close()
+        else:
+            try:
+                output, error = client.execute(args.command, get_command_args(args))
+            except (EOFError, ValueError, socket.error):
+                # died or stalled mid-request (socket.timeout is a socket.error)
+                output = None
+            finally:
+                client.close()
+            if output is not None:
+                sys.stdout.write(output)
+                if error is not None:
+                    sys.stderr.write(error)
+                    return 1
+                return 0
+    import rfk.liquidsoaphandler
+    return rfk.liquidsoaphandler.main(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
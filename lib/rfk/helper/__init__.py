@@ -1,50 +1,189 @@
-import pytz
-import datetime
-import rfk
-import os
-from flask.ext.babel import lazy_gettext
-from flask import url_for
-from flask.helpers import find_package
-from posixpath import dirname
-
-
-def now():
-    return pytz.utc.localize(datetime.datetime.utcnow())
-
-def get_location(address):
-    return rfk.geoip.record_by_addr(address)
-
-def get_path(path='', internal=False):
-    if os.path.isabs(path):
-        return path
-
-    prefix, package_path = find_package(__name__)
-    if prefix is not None and not internal:
-        return os.path.join(prefix, path)
-    elif package_path is not None:
-        return os.path.join(package_path, path)
-    raise ValueError
-
-def natural_join(lst):
-    l = len(lst);
-    if l <= 2:
-        return lazy_gettext(' and ').join(lst)
-    elif l > 2:
-        first =  ', '.join(lst[0:-1])
-        return "%s %s %s" % (first, lazy_gettext('and'), lst[-1])
-    
-def make_user_link(user):
-    return '<a href="%s" title="%s">%s</a>' % (url_for('user.info',user=user.username),user.username,user.username);
-
-def iso_country_to_countryball(isocode):
-    """returns the countryball for given isocode
-    omsk if file not found"""
-    if isocode is None:
-        return 'unknown.png'
-    isocode = isocode.lower()
-    #rather dirty hack to get the path
-    basepath = os.path.join(dirname(dirname(__file__)), 'static', 'img', 'cb')
-    if os.path.exists(os.path.join(basepath,'{}.png'.format(isocode))):
-        return '{}.png'.format(isocode)
-    else:
+import pytz
+import datetime
+import time
+import threading
+import rfk
+import os
+import resource
+import pygeoip
+from flask.ext.babel import lazy_gettext
+from flask import url_for
+from flask.helpers import find_package
+from posixpath import dirname
+from rfk.types import LRUCache
+
+
+def now():
+    return pytz.utc.localize(datetime.datetime.utcnow())
+
+geoip_modes = {'memory': pygeoip.MEMORY_CACHE,
+               'mmap': pygeoip.MMAP_CACHE,
+               'standard': pygeoip.STANDARD}
+geoip_stats = {}
+_geoip_lock = threading.Lock()
+
+def get_resident_size():
+    """returns the resident set size of this process in bytes, None without /proc"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return None
+
+def load_geoip(mode=None):
+    """opens the GeoIP database and records how long that took, the size of
+    the file and how much the resident set of this process grew meanwhile
+    (None where that can't be measured, pages of mmap only count once read)
+    
+    Keyword arguments:
+    mode -- memory (whole file in process memory), mmap (shared between
+            processes through the page cache) or standard (file reads),
+            defaults to site.geoipmode
+    """
+    if mode is None:
+        if rfk.CONFIG.has_option('site', 'geoipmode'):
+            mode = rfk.CONFIG.get('site', 'geoipmode')
+        else:
+            mode = 'mmap'
+    path = rfk.CONFIG.get('site', 'geoipdb')
+    resident_before = get_resident_size()
+    start = time.time()
+    geoip = pygeoip.GeoIP(path, geoip_modes[mode])
+    load_time = time.time() - start
+    resident_after = get_resident_size()
+    resident_growth = None
+    if resident_before is not None and resident_after is not None:
+        resident_growth = resident_after - resident_before
+    geoip_stats.update(mode=mode,
+                       load_time=load_time,
+                       file_size=os.path.getsize(path),
+                       resident_growth=resident_growth)
+    return geoip
+
+def get_geoip():
+    """returns the GeoIP database, it is only loaded when it is needed the first time"""
+    if rfk.geoip is None:
+        with _geoip_lock:
+            if rfk.geoip is None:
+                rfk.geoip = load_geoip()
+    return rfk.geoip
+
+class LocationCache(object):
+    """
+    remembers GeoIP records per address and optionally per /24,
+    reconnect storms come from the same addresses and networks.
+    addresses only ever live in process memory, nothing is written anywhere
+    """
+    
+    _missing = object()
+    
+    def __init__(self, size, prefix_size=0):
+        self.addresses = LRUCache(size)
+        self.prefixes = LRUCache(prefix_size) if prefix_size else None
+        self.lookups = 0
+    
+    @staticmethod
+    def get_prefix(address):
+        """returns the /24 of an IPv4 address, None for everything else"""
+        parts = address.split('.')
+        if len(parts) != 4:
+            return None
+        return '.'.join(parts[:3])
+    
+    def get(self, address, lookup):
+        """returns the record of address, calls lookup(address) if it is not cached"""
+        record = self.addresses.get(address, self._missing)
+        if record is not self._missing:
+            return record
+        prefix = self.get_prefix(address) if self.prefixes is not None else None
+        if prefix is not None:
+            record = self.prefixes.get(prefix, self._missing)
+            if record is not self._missing:
+                self.addresses.put(address, record)
+                return record
+        self.lookups += 1
+        record = lookup(address)
+        self.addresses.put(address, record)
+        if prefix is not None:
+            self.prefixes.put(prefix, record)
+        return record
+    
+    def stats(self):
+        prefix_hits = self.prefixes.hits if self.prefixes is not None else 0
+        return {'hits': self.addresses.hits + prefix_hits,
+                'prefix_hits': prefix_hits,
+                'misses': self.lookups,
+                'size': len(self.addresses)}
+    
+    def clear(self):
+        self.addresses.clear()
+        if self.prefixes is not None:
+            self.prefixes.clear()
+
+location_cache = None
+
+def get_location_cache():
+    """returns the LocationCache configured by site.geoip-cache, None if it is disabled"""
+    global location_cache
+    if location_cache is None:
+        size = 10000
+        prefix_size = 0
+        if rfk.CONFIG.has_option('site', 'geoip-cache'):
+            size = rfk.CONFIG.getint('site', 'geoip-cache')
+        if rfk.CONFIG.has_option('site', 'geoip-cache-prefix'):
+            prefix_size = rfk.CONFIG.getint('site', 'geoip-cache-prefix')
+        if size <= 0:
+            return None
+        with _geoip_lock:
+            if location_cache is None:
+                location_cache = LocationCache(size, prefix_size)
+    return location_cache
+
+def lookup_location(address):
+    """returns the GeoIP record of address with the city decoded"""
+    record = get_geoip().record_by_addr(address)
+    if record and isinstance(record.get('city'), str):
+        record = dict(record)
+        record['city'] = record['city'].decode('latin-1') #FICK DICH MAXMIND
+    return record
+
+def get_location(address):
+    cache = get_location_cache()
+    if cache is None:
+        return lookup_location(address)
+    return cache.get(address, lookup_location)
+
+def get_path(path='', internal=False):
+    if os.path.isabs(path):
+        return path
+
+    prefix, package_path = find_package(__name__)
+    if prefix is not None and not internal:
+        return os.path.join(prefix, path)
+    elif package_path is not None:
+        return os.path.join(package_path, path)
+    raise ValueError
+
+def natural_join(lst):
+    l = len(lst);
+    if l <= 2:
+        return lazy_gettext(' and ').join(lst)
+    elif l > 2:
+        first =  ', '.join(lst[0:-1])
+        return "%s %s %s" % (first, lazy_gettext('and'), lst[-1])
+    
+def make_user_link(user):
+    return '<a href="%s" title="%s">%s</a>' % (url_for('user.info',user=user.username),user.username,user.username);
+
+def iso_country_to_countryball(isocode):
+    """returns the countryball for given isocode
+    omsk if file not found"""
+    if isocode is None:
+        return 'unknown.png'
+    isocode = isocode.lower()
+    #rather dirty hack to get the path
+    basepath = os.path.join(dirname(dirname(__file__)), 'static', 'img', 'cb')
+    if os.path.exists(os.path.join(basepath,'{}.png'.format(isocode))):
+        return '{}.png'.format(isocode)
+    else:
         return 'unknown.png'
\ No newline at end of file
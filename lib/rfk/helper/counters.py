@@ -0,0 +1,129 @@
+'''
+Created on Oct 17, 2013
+
+Integer counters in a shared memory segment.
+
+The segment is a memory mapped file (put it on a tmpfs like /dev/shm), so
+every process mapping it sees the same values: all uwsgi workers and the
+liquidsoap handler. Counters are addressed by (kind, id) and kept in a
+small open addressing hash table. Writers serialize through an exclusive
+flock(), readers take a shared one so they never see a table halfway
+through replace().
+'''
+import os
+import mmap
+import time
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+
+
+class SharedCounters(object):
+
+    magic = 'RFKCNT01'
+    header = struct.Struct('<8sdI')
+    slot = struct.Struct('<IIq')
+
+    def __init__(self, path, slots=4096):
+        self.path = path
+        self.lock = threading.RLock()
+        # how deep the thread holding lock is within locked()
+        self.depth = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o640)
+        size = self.header.size + self.slot.size * slots
+        with self._flock():
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+            self.map = mmap.mmap(self.fd, size)
+            magic, reconciled, stored_slots = self.header.unpack_from(self.map, 0)
+            if magic != self.magic or stored_slots != slots:
+                self.map[:] = '\0' * size
+                self.header.pack_into(self.map, 0, self.magic, 0., slots)
+        self.slots = slots
+
+    @contextmanager
+    def _flock(self, operation=fcntl.LOCK_EX):
+        fcntl.flock(self.fd, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def locked(self):
+        """excludes readers and writers in this and all other processes"""
+        with self.lock:
+            if self.depth:
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+                return
+            with self._flock():
+                self.depth = 1
+                try:
+                    yield
+                finally:
+                    self.depth = 0
+
+    @contextmanager
+    def _reading(self):
+        # the flock belongs to the file descriptor, shared by all threads: a
+        # thread within locked() must not downgrade (or release) its own lock
+        with self.lock:
+            if self.depth:
+                yield
+            else:
+                with self._flock(fcntl.LOCK_SH):
+                    yield
+
+    def _offset(self, kind, id):
+        """returns the offset of the slot for (kind, id) and whether it is in use"""
+        index = (kind * 1000003 + id) % self.slots
+        for probe in xrange(self.slots):
+            offset = self.header.size + self.slot.size * ((index + probe) % self.slots)
+            skind, sid, value = self.slot.unpack_from(self.map, offset)
+            if skind == 0:
+                return offset, False
+            if skind == kind and sid == id:
+                return offset, True
+        return None, False
+
+    def get(self, kind, id=0):
+        with self._reading():
+            offset, used = self._offset(kind, id)
+            if not used:
+                return 0
+            return self.slot.unpack_from(self.map, offset)[2]
+
+    def add(self, kind, id, delta):
+        """changes a counter, only call this within locked()"""
+        offset, used = self._offset(kind, id)
+        if offset is None:
+            # full, nothing is trustworthy until the next reconcile
+            self.set_reconciled(0.)
+            return False
+        value = self.slot.unpack_from(self.map, offset)[2] if used else 0
+        self.slot.pack_into(self.map, offset, kind, id, value + delta)
+        return True
+
+    def replace(self, values):
+        """replaces all counters with values {(kind, id): value}, only call this within locked()"""
+        self.map[self.header.size:] = '\0' * (self.slot.size * self.slots)
+        complete = True
+        for (kind, id), value in values.iteritems():
+            complete = self.add(kind, id, value) and complete
+        self.set_reconciled(time.time() if complete else 0.)
+
+    def get_reconciled(self):
+        with self._reading():
+            return self.header.unpack_from(self.map, 0)[1]
+
+    def set_reconciled(self, timestamp):
+        self.header.pack_into(self.map, 0, self.magic, timestamp, self.slots)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
@@ -0,0 +1,90 @@
+'''
+Created on Oct 17, 2013
+
+Recording of the streaming traffic for rfk-benchmark replay.
+
+Every icecast callback of the backend and every rfk-liquidsoaphandler
+command is appended to a file as one compact JSON object per line, with
+its arrival time, how long it took and what it answered. Each record is
+written with a single O_APPEND write, so any number of processes can share
+the file.
+
+Passwords are never written. Unless icecast.log_ip is set listener
+addresses are replaced by pseudonyms in 10.0.0.0/8, the first three
+octets are derived from the /24 of the address so they still group alike.
+Pseudonyms are keyed per process, the same address seen by two workers
+gets two of them.
+'''
+import os
+import hmac
+import json
+import hashlib
+import threading
+
+import rfk
+from rfk.helper import get_path
+
+
+class TrafficRecorder(object):
+
+    def __init__(self, path, pseudonymize=True):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        self.key = os.urandom(16) if pseudonymize else None
+
+    def pseudonym(self, address):
+        if self.key is None or not address:
+            return address
+        separator = '.' if '.' in address else ':'
+        network = hmac.new(self.key, address.rsplit(separator, 1)[0], hashlib.sha1).digest()
+        host = hmac.new(self.key, address, hashlib.sha1).digest()
+        return '10.%d.%d.%d' % (ord(network[0]), ord(network[1]), ord(host[0]))
+
+    def write(self, record):
+        os.write(self.fd, json.dumps(record, separators=(',', ':')) + '\n')
+
+    def record_icecast(self, timestamp, duration, path, form, status):
+        """records a backend callback, form is the posted form as a dict"""
+        form = dict(form)
+        if 'pass' in form:
+            form['pass'] = None
+        if 'ip' in form:
+            form['ip'] = self.pseudonym(form['ip'])
+        self.write({'t': round(timestamp, 4), 'd': round(duration, 5), 'k': 'icecast',
+                    'p': path, 'f': form, 's': status})
+
+    def record_handler(self, timestamp, duration, command, args, username, output, error):
+        """records a handler command, args have to be stripped of credentials already"""
+        self.write({'t': round(timestamp, 4), 'd': round(duration, 5), 'k': 'handler',
+                    'c': command, 'a': args, 'u': username, 'o': output, 'e': error})
+
+    def close(self):
+        os.close(self.fd)
+
+
+recorders = {}
+_recorders_lock = threading.Lock()
+
+def get_recorder(section):
+    """returns the TrafficRecorder configured by [section] record or None"""
+    if not rfk.CONFIG.has_option(section, 'record') or not rfk.CONFIG.get(section, 'record'):
+        return None
+    path = get_path(rfk.CONFIG.get(section, 'record'))
+    with _recorders_lock:
+        if path not in recorders:
+            recorders[path] = TrafficRecorder(path, not rfk.CONFIG.getboolean('icecast', 'log_ip'))
+        return recorders[path]
+
+
+def read_records(paths):
+    """returns the records of all paths ordered by time, incomplete lines are skipped"""
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    records.sort(key=lambda record: record['t'])
+    return records
@@ -1,5 +1,6 @@
 from xml.dom.minidom import Document
 import xml.etree.ElementTree as ET
+import urllib
 import urllib2
 import base64
 class Icecast(object):
@@ -11,15 +12,23 @@ class Icecast(object):
         self.password = password
         self.status_xml = None
         
+    def _get_admin_xml(self, path, timeout=None):
+        request = urllib2.Request("http://%s:%s/admin/%s" % (self.host, self.port, path))
+        base64string = base64.encodestring('%s:%s' % (self.username, self.password)).replace('\n', '')
+        request.add_header("Authorization", "Basic %s" % base64string)   
+        if timeout is None:
+            result = urllib2.urlopen(request)
+        else:
+            result = urllib2.urlopen(request, timeout=timeout)
+        try:
+            return ET.parse(result)
+        finally:
+            result.close()
+        
     def _get_status(self, reload=False):
         if self.status_xml is not None and not reload:
             return
-        request = urllib2.Request("http://%s:%s/admin/status.xml" % (self.host, self.port))
-        base64string = base64.encodestring('%s:%s' % (self.username, self.password)).replace('\n', '')
-        request.add_header("Authorization", "Basic %s" % base64string)   
-        result = urllib2.urlopen(request)
-        self.status_xml = ET.parse(result)
-        result.close()
+        self.status_xml = self._get_admin_xml('status.xml')
         
     def get_traffic(self, reload=False):
         self._get_status(reload)
@@ -36,6 +45,22 @@ class Icecast(object):
     def get_version(self):
         self._get_status()
         return self.status_xml.find('server_id').text
+    
+    def get_clients(self, mount, timeout=10):
+        """returns the clients connected to mount as a list of dicts
+           with id, ip, useragent and connected (seconds)"""
+        tree = self._get_admin_xml('listclients?mount=%s' % (urllib.quote(mount),), timeout)
+        return self.parse_clients(tree.getroot())
+    
+    @staticmethod
+    def parse_clients(root):
+        clients = []
+        for listener in root.iter('listener'):
+            clients.append({'id': int(listener.findtext('ID')),
+                            'ip': listener.findtext('IP'),
+                            'useragent': listener.findtext('UserAgent'),
+                            'connected': int(listener.findtext('Connected') or 0)})
+        return clients
 
 class IcecastConfig(object):
     
@@ -0,0 +1,159 @@
+'''
+Created on Oct 17, 2013
+
+Background GeoIP enrichment of listener rows.
+
+Listeners are stored without country and city, their id and address are
+queued here and a worker thread looks them up and fills both columns with
+one batched UPDATE. The address is only kept in memory until then, it is
+written to the database only if icecast.log_ip says so.
+
+An UPDATE can come before the transaction that inserted the listener was
+committed, listeners that were not found are retried a few times.
+'''
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+from sqlalchemy import bindparam, select, and_, or_
+from sqlalchemy.exc import SQLAlchemyError
+
+import rfk
+import rfk.database
+from rfk.database.streaming import Listener
+
+
+class LocationEnricher(object):
+
+    # how many flushes a listener is retried if its row is not visible yet
+    retries = 5
+
+    def __init__(self, interval=1., batch_size=500):
+        """
+        Keyword arguments:
+        interval -- seconds between flushes
+        batch_size -- number of queued listeners that triggers a flush before the interval is over
+        """
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = deque()
+        self.retry = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.logger = logging.getLogger('LocationEnricher')
+        self.stats = {'flushes': 0, 'enriched': 0, 'dropped': 0}
+
+    def put(self, listener, address):
+        with self.condition:
+            self.pending.append({'listener': listener, 'address': address, 'retries': 0})
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def submit(self, listener, address):
+        """queues the listener with the given id for enrichment"""
+        self.put(listener, address)
+        self._ensure_thread()
+
+    def backlog(self):
+        return len(self.pending) + len(self.retry)
+
+    def _ensure_thread(self):
+        # started lazily so every (forked) worker process gets its own thread
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.condition:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='LocationEnricher')
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if len(self.pending) < self.batch_size:
+                    self.condition.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('could not enrich listeners, retrying')
+                time.sleep(self.interval)
+
+    def flush(self):
+        """enriches all queued listeners, returns the number of listeners processed"""
+        with self.condition:
+            entries = self.retry + list(self.pending)
+            self.pending.clear()
+            self.retry = []
+        if not entries:
+            return 0
+        updates = []
+        for entry in entries:
+            try:
+                columns = Listener.get_location_columns(entry['address'])
+            except Exception:
+                self.logger.exception('could not look up %s' % (entry['address'],))
+                continue
+            if columns['city'] is None and columns['country'] is None:
+                continue
+            columns['_listener'] = entry['listener']
+            updates.append((entry, columns))
+        retry = []
+        try:
+            if updates:
+                table = Listener.__table__
+                rfk.database.session.execute(table.update()
+                                                  .where(table.c.listener == bindparam('_listener'))
+                                                  .values(city=bindparam('city'), country=bindparam('country')),
+                                             [columns for entry, columns in updates])
+                ids = [entry['listener'] for entry, columns in updates]
+                missing = set(ids) - set(row[0] for row in
+                                         rfk.database.session.execute(select([table.c.listener])
+                                                                      .where(and_(table.c.listener.in_(ids),
+                                                                                  or_(table.c.city != None,
+                                                                                      table.c.country != None)))))
+                rfk.database.session.commit()
+                for entry, columns in updates:
+                    if entry['listener'] not in missing:
+                        continue
+                    if entry['retries'] < self.retries:
+                        entry['retries'] += 1
+                        retry.append(entry)
+                    else:
+                        self.stats['dropped'] += 1
+                self.stats['enriched'] += len(updates) - len(missing)
+        except SQLAlchemyError:
+            rfk.database.session.rollback()
+            with self.condition:
+                self.pending.extendleft(reversed(entries))
+            raise
+        finally:
+            rfk.database.session.remove()
+        with self.condition:
+            self.retry = retry + self.retry
+            self.stats['flushes'] += 1
+        return len(entries)
+
+
+location_enricher = None
+_location_enricher_lock = threading.Lock()
+
+def get_location_enricher():
+    """returns the LocationEnricher of this process configured from [icecast]
+    
+    None if enrich-interval is 0, listeners are looked up right away then
+    """
+    global location_enricher
+    interval = 1.
+    if rfk.CONFIG.has_option('icecast', 'enrich-interval'):
+        interval = rfk.CONFIG.getint('icecast', 'enrich-interval') / 1000.
+    if interval <= 0:
+        return None
+    if location_enricher is None:
+        with _location_enricher_lock:
+            if location_enricher is None:
+                location_enricher = LocationEnricher(interval)
+    return location_enricher
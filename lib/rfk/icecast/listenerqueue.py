@@ -0,0 +1,441 @@
+'''
+Created on Oct 17, 2013
+
+Write-behind queue for the listener_add/listener_remove callbacks of icecast.
+
+After a relay restart icecast reports thousands of listeners within seconds.
+Instead of a transaction (and three statistic updates) per callback the
+backend only queues the event, a flusher thread stores everything queued
+within interval with one bulk INSERT and one bulk UPDATE and updates the
+statistics once per affected stream, relay and stream_relay.
+
+Events for the same (stream_relay, client) are applied in the order they
+arrived. A remove that finds no open listener is kept for a few flushes,
+its add may still sit in the queue of another worker process.
+
+With reconnect_grace set an add reopens the listener that was closed on the
+same stream no more than reconnect_grace seconds before, if it came from the
+same address with the same user agent, instead of inserting a new one.
+Mobile clients reconnecting every few seconds keep one row, their location
+is not looked up again. Unless addresses are stored, only listeners this
+process saw connecting can be reopened, their address is kept in memory.
+The connect of a reopened listener moves forward by the gap, so its
+session length is the time actually listened.
+'''
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import timedelta
+
+import netaddr
+
+from sqlalchemy import bindparam, select, and_
+from sqlalchemy.exc import SQLAlchemyError
+
+import rfk
+import rfk.database
+from rfk.database.streaming import StreamRelay, Listener, ShowListenerStats, commit_listener_changes, topology
+from rfk.icecast.enrichment import get_location_enricher
+from rfk.helper import now
+
+
+class ListenerQueue(object):
+
+    # how many flushes a remove is retried if there is no open listener for it
+    remove_retries = 20
+
+    def __init__(self, interval=0.25, batch_size=500, enricher=None, reconnect_grace=0):
+        """
+        Keyword arguments:
+        interval -- seconds between flushes, 0 stores every event right away
+        batch_size -- number of queued events that triggers a flush before the interval is over
+        enricher -- LocationEnricher that fills in country and city later,
+                    if None they are looked up before the listeners are stored
+        reconnect_grace -- seconds within which a reconnect reopens the closed listener, 0 disables
+        """
+        self.interval = interval
+        self.batch_size = batch_size
+        self.enricher = enricher
+        self.reconnect_grace = reconnect_grace
+        self.events = deque()
+        self.retry = []
+        self.condition = threading.Condition()
+        # flushes never overlap, events of one flush are stored before the next one takes any
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        # (stream_relay, client) -> [address, disconnect] of the listeners stored by this
+        # process, kept until reconnect_grace after the disconnect to match reconnects
+        self.addresses = {}
+        self.logger = logging.getLogger('ListenerQueue')
+        self.stats = {'flushes': 0, 'added': 0, 'removed': 0, 'stitched': 0, 'dropped': 0}
+
+    def put(self, event):
+        with self.condition:
+            self.events.append(event)
+            if len(self.events) >= self.batch_size:
+                self.condition.notify()
+
+    def add(self, server, port, mount, address, client, useragent, timestamp=None):
+        self.submit({'action': 'add', 'server': server, 'port': int(port), 'mount': mount,
+                     'address': address, 'client': int(client), 'useragent': useragent,
+                     'time': timestamp or now()})
+
+    def remove(self, server, port, mount, client, timestamp=None):
+        self.submit({'action': 'remove', 'server': server, 'port': int(port), 'mount': mount,
+                     'client': int(client), 'time': timestamp or now(), 'retries': 0})
+
+    def submit(self, event):
+        """queues an event, stores it right away if write-behind is disabled"""
+        self.put(event)
+        if self.interval <= 0:
+            self.flush()
+        else:
+            self._ensure_thread()
+
+    def backlog(self):
+        return len(self.events) + len(self.retry)
+
+    def _ensure_thread(self):
+        # started lazily so every (forked) worker process gets its own flusher
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.condition:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='ListenerQueue')
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if len(self.events) < self.batch_size:
+                    self.condition.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('could not store listener events, retrying')
+                time.sleep(self.interval)
+
+    def flush(self):
+        """stores all queued events, returns the number of events processed
+
+        when it returns everything queued before the call is stored, also if
+        the flusher thread was storing a batch meanwhile (removes still waiting
+        for their add aside). If storing fails the events are queued again.
+        """
+        with self.flush_lock:
+            with self.condition:
+                events = self.retry + list(self.events)
+                self.events.clear()
+                self.retry = []
+            if not events:
+                return 0
+            try:
+                try:
+                    retry, deltas, located, changes, counts = self._store(events)
+                    ShowListenerStats.record(changes)
+                    commit_listener_changes(deltas)
+                except Exception:
+                    rfk.database.session.rollback()
+                    with self.condition:
+                        # keep them in front of everything queued meanwhile
+                        self.events.extendleft(reversed(events))
+                    raise
+                try:
+                    self._update_statistics(deltas.keys())
+                    rfk.database.session.commit()
+                except SQLAlchemyError:
+                    rfk.database.session.rollback()
+                    self.logger.exception('could not update the listener statistics')
+            finally:
+                rfk.database.session.remove()
+            for listener, address in located:
+                self.enricher.submit(listener, address)
+            with self.condition:
+                self.retry = retry + self.retry
+                self.stats['flushes'] += 1
+                for name, count in counts.iteritems():
+                    self.stats[name] += count
+            return len(events)
+
+    def _store(self, events):
+        stream_relays = self._resolve(events)
+        inserts = []
+        removes = []
+        retry = []
+        open_rows = {}
+        deltas = {}
+        changes = []
+        addresses = []
+        seen = []
+        counts = {'added': 0, 'stitched': 0, 'removed': 0, 'dropped': 0}
+        for event in events:
+            stream_relay = stream_relays.get((event['server'], event['port'], event['mount']))
+            if stream_relay is None:
+                self.logger.warn('no stream for %s:%s%s' % (event['server'], event['port'], event['mount']))
+                counts['dropped'] += 1
+                continue
+            key = (stream_relay, event['client'])
+            if event['action'] == 'add':
+                row = {'connect': event['time'], 'disconnect': None,
+                       'client': event['client'], 'useragent': event['useragent'],
+                       'stream_relay': stream_relay}
+                row.update({'address': None, 'city': None, 'country': None})
+                try:
+                    row['address'] = Listener.get_address_column(event['address'])
+                    if self.enricher is None:
+                        row.update(Listener.get_location_columns(event['address']))
+                except Exception:
+                    self.logger.exception('could not look up %s' % (event['address'],))
+                inserts.append(row)
+                addresses.append(event['address'])
+                open_rows.setdefault(key, []).append(row)
+                seen.append((key, event['address'], None))
+                deltas[stream_relay] = deltas.get(stream_relay, 0) + 1
+            elif open_rows.get(key):
+                # added within this batch
+                open_rows[key].pop(0)['disconnect'] = event['time']
+                seen.append((key, None, event['time']))
+                deltas[stream_relay] -= 1
+                changes.append((stream_relay, event['time'], -1))
+            else:
+                removes.append((key, event))
+        closed = self._close_listeners(removes)
+        for index, (key, event) in enumerate(removes):
+            if index in closed:
+                continue
+            if event['retries'] < self.remove_retries:
+                # a copy, events are queued again unchanged if storing fails
+                retry.append(dict(event, retries=event['retries'] + 1))
+            else:
+                self.logger.warn('no listener %s on stream_relay %s to remove' % (key[1], key[0]))
+                counts['dropped'] += 1
+        for index in closed:
+            seen.append((removes[index][0], None, removes[index][1]['time']))
+        # taken before a reopen moves the row
+        added = [(id(row), row['stream_relay'], row['connect']) for row in inserts]
+        stitched = set()
+        if self.reconnect_grace > 0:
+            self._remember(seen)
+            if inserts:
+                inserts, addresses, stitched = self._stitch(inserts, addresses)
+        for row, stream_relay, connect in added:
+            # a reconnect is no new client for the show stats
+            changes.append((stream_relay, connect, 1, 0 if row in stitched else 1))
+        located = []
+        if inserts:
+            rfk.database.session.execute(Listener.__table__.insert(), inserts)
+            if self.enricher is not None:
+                located = self._locate(inserts, addresses)
+        for index in closed:
+            stream_relay = removes[index][0][0]
+            deltas[stream_relay] = deltas.get(stream_relay, 0) - 1
+            changes.append((stream_relay, removes[index][1]['time'], -1))
+        counts['added'] = len(inserts)
+        counts['stitched'] = len(stitched)
+        counts['removed'] = len(closed)
+        return retry, deltas, located, changes, counts
+
+    def _remember(self, seen):
+        """keeps the addresses of seen [((stream_relay, client), address or None, disconnect or None)]"""
+        for key, address, disconnect in seen:
+            if address is not None:
+                self.addresses[key] = [address, None]
+            elif key in self.addresses:
+                self.addresses[key][1] = disconnect
+        expired = now() - timedelta(seconds=self.reconnect_grace)
+        for key, (address, disconnect) in self.addresses.items():
+            if disconnect is not None and disconnect < expired:
+                del self.addresses[key]
+
+    def _get_address(self, stream_relay, client, column):
+        """returns the address of a closed listener, None if neither stored nor remembered"""
+        if column is not None:
+            return str(netaddr.IPAddress(column))
+        remembered = self.addresses.get((stream_relay, client))
+        return remembered[0] if remembered is not None else None
+
+    def _stitch(self, rows, addresses):
+        """reopens the listeners the rows reconnected to instead of inserting them
+
+        Candidates are the listeners closed on the same stream within
+        reconnect_grace before the connect, already closed ones as well as
+        rows of this batch. A reopened listener takes over client, stream_relay,
+        user agent and disconnect of the row. Returns the rows and addresses
+        left to insert and the ids (id()) of the rows that were stitched.
+        """
+        grace = timedelta(seconds=self.reconnect_grace)
+        table = Listener.__table__
+        srt = StreamRelay.__table__
+        wanted = set(row['stream_relay'] for row in rows)
+        streams = dict(rfk.database.session.execute(
+            select([srt.c.stream_relay, srt.c.stream])
+            .where(srt.c.stream.in_(select([srt.c.stream]).where(srt.c.stream_relay.in_(wanted))))).fetchall())
+        candidates = {}
+        result = rfk.database.session.execute(
+            select([table.c.listener, table.c.stream_relay, table.c.client, table.c.connect,
+                    table.c.disconnect, table.c.address, table.c.useragent])
+            .where(and_(table.c.stream_relay.in_(streams.keys()),
+                        table.c.disconnect != None,
+                        table.c.disconnect >= min(row['connect'] for row in rows) - grace,
+                        table.c.disconnect <= max(row['connect'] for row in rows))))
+        for listener, stream_relay, client, connect, disconnect, address, useragent in result:
+            candidates.setdefault(streams[stream_relay], []).append(
+                {'listener': listener, 'row': None, 'connect': connect, 'disconnect': disconnect,
+                 'address': self._get_address(stream_relay, client, address), 'useragent': useragent})
+        left = []
+        left_addresses = []
+        stitched = set()
+        for row, address in sorted(zip(rows, addresses), key=lambda item: item[0]['connect']):
+            stream = streams.get(row['stream_relay'])
+            candidate = self._find_candidate(candidates.get(stream, []), row, address, grace)
+            if candidate is not None:
+                candidates[stream].remove(candidate)
+                connect = self._reopen(candidate, row)
+                if connect is not None:
+                    stitched.add(id(row))
+                    if row['disconnect'] is not None:
+                        # left again within this batch, it may come back once more
+                        candidates[stream].append(dict(candidate, connect=connect, disconnect=row['disconnect'],
+                                                       useragent=row['useragent']))
+                    continue
+            left.append(row)
+            left_addresses.append(address)
+            if row['disconnect'] is not None:
+                candidates.setdefault(stream, []).append(
+                    {'listener': None, 'row': row, 'connect': row['connect'], 'disconnect': row['disconnect'],
+                     'address': address, 'useragent': row['useragent']})
+        return left, left_addresses, stitched
+
+    @staticmethod
+    def _find_candidate(candidates, row, address, grace):
+        """returns the candidate closed last before the row connected that matches it
+
+        address and user agent have to match, a listener whose address is
+        unknown is never reopened, another one behind the same NAT could
+        take it over
+        """
+        found = None
+        for candidate in candidates:
+            if not candidate['disconnect'] <= row['connect'] <= candidate['disconnect'] + grace:
+                continue
+            if candidate['address'] is None or candidate['address'] != address:
+                continue
+            if candidate['useragent'] != row['useragent']:
+                continue
+            if found is None or candidate['disconnect'] > found['disconnect']:
+                found = candidate
+        return found
+
+    @staticmethod
+    def _reopen(candidate, row):
+        """moves row onto the candidate, returns its new connect or None if another worker reopened it first"""
+        values = {'client': row['client'], 'stream_relay': row['stream_relay'],
+                  'useragent': row['useragent'], 'disconnect': row['disconnect'],
+                  'connect': candidate['connect'] + (row['connect'] - candidate['disconnect'])}
+        if candidate['row'] is not None:
+            candidate['row'].update(values)
+            return values['connect']
+        table = Listener.__table__
+        result = rfk.database.session.execute(table.update()
+                                                   .where(and_(table.c.listener == candidate['listener'],
+                                                               table.c.disconnect == candidate['disconnect']))
+                                                   .values(**values))
+        return values['connect'] if result.rowcount > 0 else None
+
+    def _locate(self, rows, addresses):
+        """returns (listener id, address) of the rows just inserted
+
+        connect can't identify them, the database may have dropped its
+        fractions of a second. The bulk insert numbered the rows in order,
+        so the newest listeners without a location of each (stream_relay,
+        client) are the ones inserted for it.
+        """
+        table = Listener.__table__
+        wanted = {}
+        for row, address in zip(rows, addresses):
+            wanted.setdefault((row['stream_relay'], row['client']), []).append(address)
+        result = rfk.database.session.execute(select([table.c.listener, table.c.stream_relay, table.c.client])
+                                              .where(and_(table.c.stream_relay.in_(set(row['stream_relay'] for row in rows)),
+                                                          table.c.client.in_(set(row['client'] for row in rows)),
+                                                          table.c.connect >= min(row['connect'] for row in rows) -
+                                                                             timedelta(seconds=1),
+                                                          table.c.city == None,
+                                                          table.c.country == None))
+                                              .order_by(table.c.listener))
+        found = {}
+        for listener, stream_relay, client in result:
+            if (stream_relay, client) in wanted:
+                found.setdefault((stream_relay, client), []).append(listener)
+        located = []
+        for key, listeners in found.iteritems():
+            located.extend(zip(listeners[-len(wanted[key]):], wanted[key]))
+        return located
+
+    def _resolve(self, events):
+        """maps (server, port, mount) of the events to stream_relay ids"""
+        stream_relays = {}
+        for key in set((event['server'], event['port'], event['mount']) for event in events):
+            stream_relay = topology.resolve(*key)[2]
+            if stream_relay is not None:
+                stream_relays[key] = stream_relay
+        return stream_relays
+
+    def _close_listeners(self, removes):
+        """disconnects the open listeners of removes, returns the indices of the removes that found one"""
+        if not removes:
+            return set()
+        wanted = set(key for key, event in removes)
+        rows = rfk.database.session.query(Listener.listener, Listener.stream_relay_id, Listener.client)\
+                                   .filter(Listener.disconnect == None,
+                                           Listener.stream_relay_id.in_(set(key[0] for key in wanted)),
+                                           Listener.client.in_(set(key[1] for key in wanted))).all()
+        found = {}
+        for listener, stream_relay, client in rows:
+            if (stream_relay, client) in wanted:
+                found.setdefault((stream_relay, client), []).append(listener)
+        updates = []
+        closed = set()
+        for index, (key, event) in enumerate(removes):
+            if found.get(key):
+                updates.append({'_listener': found[key].pop(0), '_disconnect': event['time']})
+                closed.add(index)
+        if updates:
+            table = Listener.__table__
+            rfk.database.session.execute(table.update()
+                                              .where(table.c.listener == bindparam('_listener'))
+                                              .values(disconnect=bindparam('_disconnect')),
+                                         updates)
+        return closed
+
+    def _update_statistics(self, stream_relay_ids):
+        """updates the statistics once per affected stream, relay and stream_relay"""
+        relays = set()
+        streams = set()
+        for stream_relay in StreamRelay.query.filter(StreamRelay.stream_relay.in_(stream_relay_ids)).all() \
+                if stream_relay_ids else []:
+            stream_relay.update_statistic()
+            relays.add(stream_relay.relay)
+            streams.add(stream_relay.stream)
+        for relay in relays:
+            relay.update_statistic()
+        for stream in streams:
+            stream.update_statistic()
+
+
+def get_listener_queue():
+    """returns a ListenerQueue configured from [icecast]"""
+    interval = 0.25
+    batch_size = 500
+    if rfk.CONFIG.has_option('icecast', 'writebehind-interval'):
+        interval = rfk.CONFIG.getint('icecast', 'writebehind-interval') / 1000.
+    if rfk.CONFIG.has_option('icecast', 'writebehind-batch'):
+        batch_size = rfk.CONFIG.getint('icecast', 'writebehind-batch')
+    reconnect_grace = 0
+    if rfk.CONFIG.has_option('icecast', 'reconnect-grace'):
+        reconnect_grace = rfk.CONFIG.getint('icecast', 'reconnect-grace')
+    return ListenerQueue(interval, batch_size, get_location_enricher(), reconnect_grace)
@@ -0,0 +1,128 @@
+'''
+Created on Oct 17, 2013
+
+Reconciliation of open listeners against the client lists of icecast.
+
+A lost listener_remove (e.g. during an app restart) leaves a listener open
+forever, a lost listener_add loses one. For every online mount of every
+relay the client list is fetched and diffed against the open listeners of
+the StreamRelay, stale ones are closed and missing ones created, each with
+a single statement per chunk of ids.
+
+Clients and listeners younger than the grace period are left alone, their
+callbacks may still sit in a write-behind queue.
+'''
+import socket
+import logging
+import urllib2
+from datetime import timedelta
+
+from sqlalchemy import select, and_
+from sqlalchemy.exc import SQLAlchemyError
+
+import rfk
+import rfk.database
+from rfk.database.streaming import Relay, StreamRelay, Listener, ShowListenerStats, commit_listener_changes
+from rfk.helper import now
+from rfk.icecast import Icecast
+
+logger = logging.getLogger('ListenerReconciliation')
+
+# ids per IN clause
+chunk_size = 500
+
+
+def get_reconcile_grace():
+    """seconds a client or listener has to exist before it is reconciled"""
+    if rfk.CONFIG.has_option('icecast', 'reconcile-grace'):
+        return rfk.CONFIG.getint('icecast', 'reconcile-grace')
+    return 60
+
+def reconcile_stream_relay(stream_relay, clients, timestamp=None, grace=None):
+    """makes the open listeners of stream_relay (an id) match clients as returned by Icecast.get_clients
+
+    returns the number of listeners (closed, created), the caller commits
+    """
+    if timestamp is None:
+        timestamp = now()
+    if grace is None:
+        grace = get_reconcile_grace()
+    settled = timestamp - timedelta(seconds=grace)
+    table = Listener.__table__
+    open_rows = rfk.database.session.execute(select([table.c.listener, table.c.client, table.c.connect])
+                                             .where(and_(table.c.stream_relay == stream_relay,
+                                                         table.c.disconnect == None))).fetchall()
+    live = dict((client['id'], client) for client in clients)
+    open_clients = set(client for listener, client, connect in open_rows)
+    stale = [listener for listener, client, connect in open_rows
+             if client not in live and (connect is None or connect < settled)]
+    for start in xrange(0, len(stale), chunk_size):
+        rfk.database.session.execute(table.update()
+                                          .where(table.c.listener.in_(stale[start:start + chunk_size]))
+                                          .values(disconnect=timestamp))
+    rows = []
+    for client in live.itervalues():
+        if client['id'] in open_clients or client['connected'] < grace:
+            continue
+        row = {'connect': timestamp - timedelta(seconds=client['connected']), 'disconnect': None,
+               'client': client['id'], 'useragent': (client['useragent'] or '')[:255],
+               'stream_relay': stream_relay, 'address': None, 'city': None, 'country': None}
+        try:
+            row['address'] = Listener.get_address_column(client['ip'])
+            row.update(Listener.get_location_columns(client['ip']))
+        except Exception:
+            logger.exception('could not look up %s' % (client['ip'],))
+        rows.append(row)
+    if rows:
+        rfk.database.session.execute(table.insert(), rows)
+    return len(stale), len(rows)
+
+def reconcile_relay(relay, timestamp=None, grace=None):
+    """reconciles all online mounts of relay, returns the number of listeners (closed, created)
+
+    raises urllib2.URLError if the relay can't be reached
+    """
+    icecast = Icecast(relay.address, relay.port, relay.admin_username, relay.admin_password)
+    total_closed = 0
+    total_created = 0
+    for stream_relay in relay.streams:
+        if stream_relay.status != StreamRelay.STATUS.ONLINE:
+            continue
+        try:
+            clients = icecast.get_clients(stream_relay.stream.mount)
+        except urllib2.HTTPError as e:
+            logger.warn('no client list for %s on %s:%s: %s' % (stream_relay.stream.mount,
+                                                                relay.address, relay.port, e))
+            continue
+        try:
+            closed, created = reconcile_stream_relay(stream_relay.stream_relay, clients, timestamp, grace)
+            ShowListenerStats.record([(stream_relay.stream_relay, timestamp or now(), -closed),
+                                      (stream_relay.stream_relay, timestamp or now(), created)])
+            commit_listener_changes({stream_relay.stream_relay: created - closed})
+        except SQLAlchemyError:
+            rfk.database.session.rollback()
+            raise
+        if closed or created:
+            logger.info('%s on %s:%s: closed %d, created %d listeners' % (stream_relay.stream.mount, relay.address,
+                                                                         relay.port, closed, created))
+            stream_relay.update_statistic()
+            stream_relay.stream.update_statistic()
+            relay.update_statistic()
+            rfk.database.session.commit()
+        total_closed += closed
+        total_created += created
+    return total_closed, total_created
+
+def reconcile_listeners(timestamp=None, grace=None):
+    """reconciles every relay that can be reached, returns the number of listeners (closed, created)"""
+    total_closed = 0
+    total_created = 0
+    for relay in Relay.query.all():
+        try:
+            closed, created = reconcile_relay(relay, timestamp, grace)
+        except (urllib2.URLError, socket.error) as e:
+            logger.warn('could not reconcile %s:%s: %s' % (relay.address, relay.port, e))
+            continue
+        total_closed += closed
+        total_created += created
+    return total_closed, total_created
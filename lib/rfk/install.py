@@ -4,6 +4,13 @@ from rfk.database.base import Permission, Setting, User
 import rfk.database
 
 
+def setup_schema():
+    old_version, new_version = rfk.database.migrate()
+    if old_version == new_version:
+        print "[schema] Version %d is current" % new_version
+    else:
+        print "[schema] Migrated from %s to version %d" % (old_version, new_version)
+
 def setup_settings():
     settings = []
     settings.append(Setting.add_setting('use_icy', 'Use ICY-Tags for unplanned Shows', Setting.TYPES.INT))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import telnetlib
+import socket
+import time
 import rfk
 import os
 from string import Template
@@ -14,9 +16,20 @@ class LiquidInterface(object):
     def __init__(self, host='127.0.0.1', port=1234):
         self.host = host
         self.port = port
+        self.deadline = None
         
-    def connect(self):
-        self.conn = telnetlib.Telnet(self.host, self.port)
+    def connect(self, timeout=None):
+        """connects to the telnet interface
+        
+        Keyword arguments:
+        timeout -- seconds everything until close() may take, commands
+                   raise socket.timeout once they are used up
+        """
+        if timeout is None:
+            self.conn = telnetlib.Telnet(self.host, self.port)
+        else:
+            self.deadline = time.time() + timeout
+            self.conn = telnetlib.Telnet(self.host, self.port, timeout)
 
     def close(self):
         self.conn.close()
@@ -66,8 +79,17 @@ class LiquidInterface(object):
     
     
     def _execute_command(self, command):
+        if self.deadline is None:
+            self.conn.write("%s\n" % command)
+            return self.conn.read_until('END', self.timeout)
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout('deadline exceeded before %s' % (command,))
+        self.conn.sock.settimeout(remaining)
         self.conn.write("%s\n" % command)
-        ret = self.conn.read_until('END', self.timeout)
+        ret = self.conn.read_until('END', remaining)
+        if not ret.endswith('END'):
+            raise socket.timeout('deadline exceeded during %s' % (command,))
         return ret
 
 class LiquidSink(object):
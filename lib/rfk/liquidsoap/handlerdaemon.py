@@ -0,0 +1,208 @@
+'''
+Created on Oct 17, 2013
+
+Long running counterpart of rfk-liquidsoaphandler.
+
+Liquidsoap calls the handler for every auth, connect, metadata, disconnect,
+playlist and listenercount event. Instead of paying for interpreter startup,
+rfk.init() and init_db() each time, the handler commands are executed here
+with warm database connections and caches. rfk.handlerclient talks to it.
+
+Background tasks (draining the spool, flushing metadata, prewarming shows)
+run in a thread of their own, a stalled database never holds up accepting
+the next callback.
+'''
+import os
+import socket
+import select
+import sys
+import time
+import threading
+import traceback
+import logging
+
+import rfk
+import rfk.liquidsoaphandler
+from rfk.handlerclient import read, write
+from rfk.liquidsoap.metadata import MetadataCoalescer
+from rfk.liquidsoap.handover import Handover
+from rfk.liquidsoap.spool import Spool
+from rfk.liquidsoap.prewarm import ShowPrewarmer
+from rfk.helper import get_path
+from rfk.database.track import Title
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class SocketExists(BaseException):
+    pass
+
+
+class HandlerDaemon(object):
+
+    commands = ('auth', 'meta', 'connect', 'disconnect', 'playlist', 'listenercount', 'status')
+    # seconds between checks for due background tasks
+    tick = 0.25
+    # seconds a client may take to send its request or receive the answer
+    request_timeout = 5.
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('LiquidsoapHandlerDaemon')
+        self.logger.setLevel(logging.INFO)
+        self.path = path
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise SocketExists()
+            except socket.error:
+                # nobody is listening, leftover from a crashed daemon
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(16)
+        self.quit = False
+        self.tasks = []
+        self.task_thread = None
+        self.metadata = None
+        settle = self._get_option('metadata-settle', 2.)
+        if settle > 0:
+            self.metadata = MetadataCoalescer(rfk.liquidsoaphandler.apply_metadata_for, settle)
+            rfk.liquidsoaphandler.metadata_coalescer = self.metadata
+            self.add_task(self.metadata.flush_due, self.tick)
+        self.handover = Handover(rfk.liquidsoaphandler.kick,
+                                 self._get_option('handover-deadline', 5.),
+                                 self._get_option('handover-reserve', 30.))
+        rfk.liquidsoaphandler.handover = self.handover
+        self.spool = None
+        if rfk.CONFIG.has_option('liquidsoap-handler', 'spool'):
+            fsync = True
+            if rfk.CONFIG.has_option('liquidsoap-handler', 'spool-fsync'):
+                fsync = rfk.CONFIG.getboolean('liquidsoap-handler', 'spool-fsync')
+            self.spool = Spool(get_path(rfk.CONFIG.get('liquidsoap-handler', 'spool')), fsync)
+            if self.spool.backlog():
+                self.logger.info('%d events left in the spool' % (self.spool.backlog(),))
+            rfk.liquidsoaphandler.spool = self.spool
+            self.add_task(self.drain_spool, self.tick)
+        self.prewarmer = None
+        lead = self._get_option('prewarm-lead', 300.)
+        if lead > 0:
+            self.prewarmer = ShowPrewarmer(lead)
+            rfk.liquidsoaphandler.show_prewarmer = self.prewarmer
+            # refreshed well within the lead time so no show begins unnoticed
+            self.add_task(self.prewarmer.refresh, min(lead / 4, 60.))
+        try:
+            rfk.liquidsoaphandler.run_task(Title.warm_cache)
+        except Exception:
+            self.logger.warn('could not warm the title cache')
+
+    def _get_option(self, option, default):
+        if rfk.CONFIG.has_option('liquidsoap-handler', option):
+            return rfk.CONFIG.getfloat('liquidsoap-handler', option)
+        return default
+
+    def add_task(self, func, interval):
+        """runs func every interval seconds in the task thread"""
+        self.tasks.append([func, interval, 0])
+
+    def drain_spool(self):
+        try:
+            self.spool.drain(rfk.liquidsoaphandler.apply_spooled)
+        except SQLAlchemyError, e:
+            self.logger.warn('could not drain the spool, %d events waiting: %s' % (self.spool.backlog(), e))
+
+    def run_tasks(self):
+        for task in self.tasks:
+            if task[2] <= time.time():
+                task[2] = time.time() + task[1]
+                try:
+                    rfk.liquidsoaphandler.run_task(task[0])
+                except Exception:
+                    pass # already logged by run_task
+
+    def _run_task_thread(self):
+        while not self.quit:
+            self.run_tasks()
+            time.sleep(self.tick)
+
+    def run(self):
+        self.task_thread = threading.Thread(target=self._run_task_thread, name='HandlerDaemonTasks')
+        self.task_thread.daemon = True
+        self.task_thread.start()
+        try:
+            while not self.quit:
+                ready_to_read, ready_to_write, in_err = \
+                    select.select([self.server], [], [], self.tick)
+                if self.server in ready_to_read:
+                    conn, addr = self.server.accept()
+                    try:
+                        self.handle_connection(conn)
+                    finally:
+                        conn.close()
+        except KeyboardInterrupt:
+            self.logger.info('SIGINT: shutting down...')
+        finally:
+            self.shutdown()
+
+    def handle_connection(self, conn):
+        """reads one request from conn and answers it
+
+        requests are handled one after another, liquidsoap serializes
+        its callbacks anyway and this keeps the database session simple,
+        a client that stalls is given up after request_timeout
+        """
+        conn.settimeout(self.request_timeout)
+        try:
+            request = read(conn)
+        except (EOFError, ValueError, socket.error):
+            return
+        response = self.execute(request.get('command'), request.get('args', []))
+        try:
+            write(conn, response)
+        except socket.error:
+            self.logger.warn('client went away before receiving %s' % (request.get('command'),))
+
+    def execute(self, command, args):
+        if command not in self.commands:
+            return {'output': '', 'error': 'unknown command %s' % (command,)}
+        try:
+            return {'output': rfk.liquidsoaphandler.handle(command, args)}
+        except Exception:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            error = ''.join(traceback.format_exception(exc_type, exc_value, exc_tb))
+            self.logger.error(error)
+            return {'output': '', 'error': error}
+
+    def shutdown(self):
+        self.quit = True
+        if self.task_thread is not None:
+            self.task_thread.join()
+        if self.spool is not None:
+            self.drain_spool()
+            rfk.liquidsoaphandler.spool = None
+            self.spool.close()
+        if rfk.liquidsoaphandler.metadata_coalescer is not None:
+            try:
+                rfk.liquidsoaphandler.run_task(self.metadata.flush_due, float('inf'))
+            except Exception:
+                pass
+            rfk.liquidsoaphandler.metadata_coalescer = None
+        rfk.liquidsoaphandler.handover = None
+        rfk.liquidsoaphandler.show_prewarmer = None
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def enable_stdout(self):
+        formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s - %(message)s')
+        ch = logging.StreamHandler()
+        ch.setLevel(self.logger.level)
+        ch.setFormatter(formatter)
+        self.logger.addHandler(ch)
+
+    def set_debug(self, debug):
+        if debug:
+            self.logger.setLevel(logging.DEBUG)
+        else:
+            self.logger.setLevel(logging.INFO)
@@ -0,0 +1,122 @@
+'''
+Created on Oct 17, 2013
+
+When the DJ of a planned show authenticates while someone else is streaming
+the current source client has to be kicked first. Kicking goes through the
+liquidsoap telnet interface and used to block the auth answer, the incoming
+DJ was refused anyway and had to retry.
+
+The Handover kicks in the background with a bounded deadline and reserves
+the slot for the planned DJ, so the retry is accepted right away and nobody
+else can sneak in between.
+'''
+import time
+import threading
+import logging
+
+
+class Handover(object):
+
+    def __init__(self, kick, deadline=5., reserve=30.):
+        """
+        Keyword arguments:
+        kick -- callable(timeout) that kicks the connected source client
+        deadline -- seconds the kick may take before the slot is handed over anyway
+        reserve -- seconds the slot is held for the planned DJ
+        """
+        self.kick = kick
+        self.deadline = deadline
+        self.reserve = reserve
+        self.reservation = None
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('LiquidsoapHandover')
+
+    def _current(self, timestamp):
+        if self.reservation is not None and self.reservation['expires'] <= timestamp:
+            self.logger.info('reservation for %s expired' % (self.reservation['userid'],))
+            self.reservation = None
+        return self.reservation
+
+    def reserved_for(self, timestamp=None):
+        """returns the userid the slot is reserved for or None"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            reservation = self._current(timestamp)
+            if reservation is not None:
+                return reservation['userid']
+            return None
+
+    def allows(self, userid, timestamp=None):
+        """returns False if the slot is reserved for somebody else"""
+        reserved = self.reserved_for(timestamp)
+        return reserved is None or reserved == userid
+
+    def request(self, userid, busy, timestamp=None):
+        """called when the DJ of a planned show authenticates
+
+        reserves the slot for userid and starts kicking the current source
+        client if the slot is busy. returns True if the DJ may connect now.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            reservation = self._current(timestamp)
+            if reservation is None or reservation['userid'] != userid:
+                reservation = {'userid': userid,
+                               'first': timestamp,
+                               'expires': timestamp + self.reserve,
+                               'kick_started': None,
+                               'kicked': not busy}
+                self.reservation = reservation
+            if reservation['kicked']:
+                return True
+            if reservation['kick_started'] is None:
+                reservation['kick_started'] = timestamp
+                thread = threading.Thread(target=self._kick, args=(reservation,))
+                thread.daemon = True
+                thread.start()
+                return False
+            if timestamp - reservation['kick_started'] > self.deadline:
+                self.logger.warn('kick for %s exceeded its deadline' % (userid,))
+                reservation['kicked'] = True
+                return True
+            return False
+
+    def _kick(self, reservation):
+        start = time.time()
+        try:
+            self.kick(self.deadline)
+        except Exception:
+            self.logger.exception('kick for %s failed' % (reservation['userid'],))
+        finally:
+            with self.lock:
+                reservation['kicked'] = True
+            self.logger.info('kick for %s took %.3fs' % (reservation['userid'], time.time() - start))
+
+    def wait(self, timeout=None):
+        """blocks until the pending kick is done, returns True if there is none left"""
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            with self.lock:
+                if self.reservation is None or self.reservation['kicked'] or \
+                   self.reservation['kick_started'] is None:
+                    return True
+            if end is not None and time.time() >= end:
+                return False
+            time.sleep(0.01)
+
+    def connected(self, userid, timestamp=None):
+        """releases the reservation of userid once the stream is live
+
+        returns the seconds since the first auth attempt or None if
+        userid had no reservation
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            reservation = self._current(timestamp)
+            if reservation is None or reservation['userid'] != userid:
+                return None
+            self.reservation = None
+            return timestamp - reservation['first']
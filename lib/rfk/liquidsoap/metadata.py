@@ -0,0 +1,104 @@
+'''
+Created on Oct 17, 2013
+
+Some streaming clients send a burst of metadata packets on every track change.
+The MetadataCoalescer holds updates back until they settled for a while and
+only hands over the last one, with the time the first one arrived.
+'''
+import time
+import threading
+
+
+class MetadataCoalescer(object):
+
+    def __init__(self, apply, settle=2., max_delay=None):
+        """
+        Keyword arguments:
+        apply -- callable(userid, artist, title, begin) that stores a track
+        settle -- seconds without a new packet before an update is applied
+        max_delay -- upper bound for holding back an update (defaults to 4 * settle)
+        """
+        self.apply = apply
+        self.settle = settle
+        self.max_delay = max_delay if max_delay is not None else settle * 4
+        self.pending = {}
+        self.last_applied = {}
+        self.lock = threading.Lock()
+        # held while an update of the user is applied, flush and forget wait for it
+        self.user_locks = {}
+
+    def _user_lock(self, userid):
+        with self.lock:
+            return self.user_locks.setdefault(userid, threading.Lock())
+
+    def submit(self, userid, artist, title, begin, timestamp=None):
+        """queues an update, returns False if it was dropped as duplicate"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if userid in self.pending:
+                entry = self.pending[userid]
+                entry['artist'] = artist
+                entry['title'] = title
+                entry['due'] = min(timestamp + self.settle, entry['first'] + self.max_delay)
+                return True
+            if self.last_applied.get(userid) == (artist, title):
+                return False
+            self.pending[userid] = {'artist': artist,
+                                    'title': title,
+                                    'begin': begin,
+                                    'first': timestamp,
+                                    'due': timestamp + self.settle}
+            return True
+
+    def flush_due(self, timestamp=None):
+        """applies all updates that have settled, returns the number applied"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            due = [userid for userid, entry in self.pending.iteritems() if entry['due'] <= timestamp]
+        applied = 0
+        for userid in due:
+            if self.flush(userid):
+                applied += 1
+        return applied
+
+    def flush(self, userid):
+        """applies the pending update for userid right away (e.g. before a disconnect)
+        
+        returns only after an update of userid another thread is applying
+        finished. if apply raises the update is pending again, unless a newer
+        one arrived meanwhile, that one keeps the begin of the failed one
+        """
+        with self._user_lock(userid):
+            with self.lock:
+                entry = self.pending.pop(userid, None)
+            if entry is None:
+                return False
+            if self.last_applied.get(userid) == (entry['artist'], entry['title']):
+                return False
+            try:
+                self.apply(userid, entry['artist'], entry['title'], entry['begin'])
+            except Exception:
+                with self.lock:
+                    newer = self.pending.get(userid)
+                    if newer is None:
+                        self.pending[userid] = entry
+                    else:
+                        newer['begin'] = entry['begin']
+                        newer['first'] = entry['first']
+                raise
+            with self.lock:
+                self.last_applied[userid] = (entry['artist'], entry['title'])
+            return True
+
+    def forget(self, userid):
+        """drops everything known about userid (the stream ended), waits for an update being applied"""
+        with self._user_lock(userid):
+            with self.lock:
+                self.pending.pop(userid, None)
+                self.last_applied.pop(userid, None)
+                self.user_locks.pop(userid, None)
+
+    def backlog(self):
+        return len(self.pending)
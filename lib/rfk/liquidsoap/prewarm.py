@@ -0,0 +1,80 @@
+'''
+Created on Oct 17, 2013
+
+Keeps what init_show needs for upcoming planned shows at hand.
+
+The handler daemon refreshes the ShowPrewarmer periodically. Every planned
+show that begins within the lead time (or is running) is remembered per
+host together with the ids of its UserShow and the DJ's settings, so a
+connect at show start does not have to search for the show first.
+'''
+import threading
+from datetime import timedelta
+
+import rfk.database
+from rfk.database.base import UserSetting, Setting
+from rfk.database.show import Show, UserShow
+from rfk.helper import now
+
+
+class ShowPrewarmer(object):
+
+    # settings read on the connect path
+    setting_codes = ('use_icy',)
+
+    def __init__(self, lead=300.):
+        """
+        Keyword arguments:
+        lead -- seconds before the begin of a show it is loaded
+        """
+        self.lead = timedelta(seconds=lead)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def refresh(self, timestamp=None):
+        """reloads all planned shows starting within the lead time, returns their number"""
+        if timestamp is None:
+            timestamp = now()
+        rows = rfk.database.session.query(UserShow.user_id, UserShow.userShow,
+                                          Show.show, Show.begin, Show.end)\
+                                   .join(Show, UserShow.show_id == Show.show)\
+                                   .filter(Show.flags == Show.FLAGS.PLANNED,
+                                           Show.begin <= timestamp + self.lead,
+                                           Show.end > timestamp)\
+                                   .order_by(Show.begin.asc()).all()
+        entries = {}
+        for userid, usershow, show, begin, end in rows:
+            if userid in entries:
+                continue
+            entries[userid] = {'show': show,
+                               'usershow': usershow,
+                               'begin': begin,
+                               'end': end,
+                               'settings': dict.fromkeys(self.setting_codes)}
+        if entries:
+            settings = rfk.database.session.query(UserSetting, Setting.code)\
+                                           .join(Setting, UserSetting.setting_id == Setting.setting)\
+                                           .filter(UserSetting.user_id.in_(entries.keys()),
+                                                   Setting.code.in_(self.setting_codes)).all()
+            for usersetting, code in settings:
+                entries[usersetting.user_id]['settings'][code] = usersetting.get_value()
+        with self.lock:
+            self.entries = entries
+        return len(entries)
+
+    def get(self, userid, timestamp=None):
+        """returns the prewarmed entry of userid if its show is running at timestamp"""
+        if timestamp is None:
+            timestamp = now()
+        with self.lock:
+            entry = self.entries.get(userid)
+        if entry is None or not (entry['begin'] <= timestamp < entry['end']):
+            return None
+        return entry
+
+    def forget(self, userid=None):
+        with self.lock:
+            if userid is None:
+                self.entries = {}
+            else:
+                self.entries.pop(userid, None)
@@ -0,0 +1,131 @@
+'''
+Created on Oct 17, 2013
+
+Durable journal for streaming events.
+
+connect, meta and disconnect are appended to a local, fsync'd journal and
+answered right away, the handler daemon applies them to the database in
+order afterwards. A stalled database then delays the bookkeeping but not
+liquidsoap.
+
+Every event gets a sequence number, the number of the last applied event
+is kept in a cursor file next to the journal. An event is only marked as
+applied after its transaction was committed, so after a crash at most the
+last event is applied a second time; the handlers are idempotent for that.
+'''
+import os
+import json
+import time
+import threading
+import logging
+
+
+class Spool(object):
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.cursor_path = path + '.cursor'
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('LiquidsoapSpool')
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.applied = self._read_cursor()
+        self.journal = open(self.path, 'a+b')
+        self._repair()
+        self.pending = self._load()
+        if self.pending:
+            self.seq = self.pending[-1]['seq']
+        else:
+            self.seq = self.applied
+
+    def _read_cursor(self):
+        try:
+            with open(self.cursor_path, 'rb') as f:
+                return int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def _write_cursor(self, seq):
+        tmp = self.cursor_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write('%d\n' % (seq,))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp, self.cursor_path)
+
+    def _repair(self):
+        """cuts off a partially written last line"""
+        self.journal.seek(0)
+        data = self.journal.read()
+        if data and not data.endswith('\n'):
+            self.logger.warn('dropping partially written event from %s' % (self.path,))
+            self.journal.truncate(data.rfind('\n') + 1)
+            self._sync()
+
+    def _load(self):
+        pending = []
+        self.journal.seek(0)
+        for line in self.journal:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                self.logger.error('skipping unreadable event %r' % (line,))
+                continue
+            if event['seq'] > self.applied:
+                pending.append(event)
+        return pending
+
+    def _sync(self):
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+
+    def append(self, command, args, timestamp=None):
+        """writes an event to the journal, returns its sequence number once it is on disk"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self.seq += 1
+            event = {'seq': self.seq, 'time': timestamp, 'command': command, 'args': args}
+            self.journal.seek(0, os.SEEK_END)
+            self.journal.write(json.dumps(event) + '\n')
+            self._sync()
+            self.pending.append(event)
+            return self.seq
+
+    def backlog(self):
+        """number of events not yet applied to the database"""
+        return len(self.pending)
+
+    def following(self, seq):
+        """the pending events journaled after seq"""
+        with self.lock:
+            return [event for event in self.pending if event['seq'] > seq]
+
+    def drain(self, apply, limit=None):
+        """applies pending events in order, returns the number applied
+
+        apply -- callable(event) that stores the event and commits.
+                 if it raises the event stays in the journal and draining stops,
+                 the next call starts over with the same event.
+        """
+        applied = 0
+        while self.pending and (limit is None or applied < limit):
+            event = self.pending[0]
+            apply(event)
+            with self.lock:
+                self.pending.pop(0)
+                self.applied = event['seq']
+                self._write_cursor(self.applied)
+                if not self.pending:
+                    # everything is in the database, start over with an empty journal
+                    self.journal.truncate(0)
+                    self._sync()
+            applied += 1
+        return applied
+
+    def close(self):
+        self.journal.close()
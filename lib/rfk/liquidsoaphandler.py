@@ -10,12 +10,17 @@ Disconnect: streamingclient disconnects
 
 '''
 
-import argparse
 import json
 import os
 import sys
+import time
 import base64
+import threading
+import traceback
+from contextlib import contextmanager
+from StringIO import StringIO
 from datetime import datetime
+import pytz
 basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(os.path.join(basedir,'lib'))
 
@@ -23,29 +28,69 @@ import rfk
 import rfk.database 
 from rfk.database.base import User, Log, Loop
 from rfk.database.show import Show, Tag, UserShow
-from rfk.database.track import Track
-from rfk.database.streaming import Listener
+from rfk.database.track import Track, Title
+from rfk.database.streaming import Listener, ShowListenerStats
+from rfk.database.stats import Statistic
 from rfk.liquidsoap import LiquidInterface
 from rfk import exc as rexc
-from rfk.helper import get_path
+from sqlalchemy.orm import exc
+from sqlalchemy.exc import SQLAlchemyError
+from rfk.helper import get_path, now
+from rfk.helper.recorder import get_recorder
+from rfk.handlerclient import get_parser, get_command_args
 from rfk.log import init_db_logging
 
 username_delimiter = '|'
 logger = init_db_logging('liquidsoaphandler')
 
-def kick():
+# set by the handler daemon, without it metadata is stored right away
+metadata_coalescer = None
+# set by the handler daemon, without it doAuth kicks synchronously
+handover = None
+# set by the handler daemon, journals streaming events instead of storing them right away
+spool = None
+spooled_commands = ('connect', 'meta', 'disconnect')
+# set by the handler daemon, knows the planned shows about to start
+show_prewarmer = None
+
+_output = threading.local()
+
+def output(text):
+    """writes the answer for liquidsoap, to the buffer of captured_output if there is one"""
+    buf = getattr(_output, 'buffer', None)
+    if buf is None:
+        buf = sys.stdout
+    buf.write(text)
+
+@contextmanager
+def captured_output():
+    """collects everything output() writes within this thread in a StringIO"""
+    previous = getattr(_output, 'buffer', None)
+    _output.buffer = StringIO()
+    try:
+        yield _output.buffer
+    finally:
+        _output.buffer = previous
+
+def kick(timeout=None):
     """shorthand method for kicking the currently connected user
     
     returns True if someone was kicked  
+    
+    Keyword arguments:
+    timeout -- seconds the whole kick may take, socket.timeout is raised after that
+    
     """
     liquidsoap = LiquidInterface()
-    liquidsoap.connect()
+    liquidsoap.connect(timeout)
     kicked = False
-    for source in liquidsoap.get_sources():
-        if source.status() != 'no source client connected':
-            source.kick()
-            kicked = True
-    liquidsoap.close()
+    try:
+        for source in liquidsoap.get_sources():
+            if source.status() != 'no source client connected':
+                source.kick()
+                kicked = True
+    finally:
+        liquidsoap.close()
     return kicked
     
 def init_show(user):
@@ -56,6 +101,10 @@ def init_show(user):
     """
     logger.info("init_show: entering")
     logger.info("init_show: user {}".format(str(user)))
+    show = init_prewarmed_show(user)
+    if show is not None:
+        logger.info("init_show: prewarmed")
+        return show
     show = Show.get_current_show(user)
     if show is None:
         logger.info("init_show: None")
@@ -78,6 +127,7 @@ def init_show(user):
             logger.info("init_show: found planned")
             show = s        
     us = show.get_usershow(user)
+    started = us.status != UserShow.STATUS.STREAMING
     us.status = UserShow.STATUS.STREAMING
     rfk.database.session.flush()
     unfinished_shows = UserShow.query.filter(UserShow.status == UserShow.STATUS.STREAMING,
@@ -85,11 +135,70 @@ def init_show(user):
     for us in unfinished_shows:
         if us.show.flags & Show.FLAGS.UNPLANNED:
             us.show.end_show()
+        else:
+            ShowListenerStats.finalize(us.show)
         if us.status == UserShow.STATUS.STREAMING:
            us.status = UserShow.STATUS.STREAMED
         rfk.database.session.flush() 
+    if started:
+        ShowListenerStats.start(show)
     return show
         
+def get_prewarmed_show(user):
+    """returns (show, usershow) of the prewarmed planned show of user running now
+    
+    the entry is checked against the database, (None, None) if nothing
+    usable was prewarmed
+    
+    """
+    if show_prewarmer is None:
+        return (None, None)
+    entry = show_prewarmer.get(user.user)
+    if entry is None:
+        return (None, None)
+    show = Show.query.get(entry['show'])
+    us = UserShow.query.get(entry['usershow'])
+    if show is None or us is None or us.show_id != show.show or us.user_id != user.user or \
+       not (show.flags & Show.FLAGS.PLANNED) or not show.contains(now()):
+        # changed since it was prewarmed
+        show_prewarmer.forget(user.user)
+        return (None, None)
+    return (show, us)
+
+def init_prewarmed_show(user):
+    """starts the prewarmed planned show of user
+    
+    does the same as init_show for a planned show but without searching for it,
+    returns None if nothing usable was prewarmed
+    
+    """
+    show, us = get_prewarmed_show(user)
+    if show is None:
+        return None
+    with rfk.database.session.no_autoflush:
+        unfinished_shows = UserShow.query.filter(UserShow.status == UserShow.STATUS.STREAMING,
+                                                 UserShow.show != show).all()
+    started = us.status != UserShow.STATUS.STREAMING
+    us.status = UserShow.STATUS.STREAMING
+    for other in unfinished_shows:
+        if other.show.flags & Show.FLAGS.UNPLANNED:
+            other.show.end_show(flush=False)
+        else:
+            ShowListenerStats.finalize(other.show)
+        other.status = UserShow.STATUS.STREAMED
+    rfk.database.session.flush()
+    if started:
+        ShowListenerStats.start(show)
+    return show
+
+def get_connect_setting(user, code):
+    """reads a setting of a connecting user, prewarmed if possible"""
+    if show_prewarmer is not None:
+        entry = show_prewarmer.get(user.user)
+        if entry is not None and code in entry['settings']:
+            return entry['settings'][code]
+    return user.get_setting(code=code)
+
 def doAuth(username, password):
     """authenticates the user
     this function will also disconnect the current user
@@ -97,6 +206,8 @@ def doAuth(username, password):
     if that happened this function will print false to the
     user since we need a graceperiod to actually disconnect
     the other user.
+    inside the handler daemon the kick runs in the background
+    and the slot is reserved for the user until the retry.
     
     Keyword arguments:
     username
@@ -107,30 +218,57 @@ def doAuth(username, password):
         username, password = password.split(username_delimiter)
     try:
         user = User.authenticate(username, password)
-        show = Show.get_current_show(user)
-        if show is not None and show.flags & Show.FLAGS.PLANNED:
-            if kick():
+        if handover is not None and not handover.allows(user.user):
+            logger.info('rejected auth for %s (reserved for a planned show)' % (username,))
+            output('false')
+            return
+        show = get_prewarmed_show(user)[0]
+        if show is None:
+            show = Show.get_current_show(user)
+        planned = show is not None and show.flags & Show.FLAGS.PLANNED
+        if planned:
+            if handover is not None:
+                if not handover.request(user.user, is_someone_else_streaming(user)):
+                    logger.info('kicking user')
+                    output('false')
+                    return
+            elif kick():
                 logger.info('kicking user')
-                sys.stdout.write('false')
+                output('false')
                 return
         logger.info('accepted auth for %s' %(username,))
-        sys.stdout.write('true')
+        output('true')
     except rexc.base.InvalidPasswordException:
         logger.info('rejected auth for %s (invalid password)' %(username,))
-        sys.stdout.write('false')
+        output('false')
     except rexc.base.UserNotFoundException:
         logger.info('rejected auth for %s (invalid user)' %(username,))
-        sys.stdout.write('false')
+        output('false')
     rfk.database.session.commit()
 
-def doMetaData(data):
+def is_someone_else_streaming(user):
+    return UserShow.query.filter(UserShow.status == UserShow.STATUS.STREAMING,
+                                 UserShow.user != user).count() > 0
+
+def record_handover(seconds):
+    """stores the time from the first auth attempt of a planned DJ until the stream was live"""
+    try:
+        stat = Statistic.query.filter(Statistic.identifier == 'handover').one()
+    except exc.NoResultFound:
+        stat = Statistic(name='Handover time (ms)', identifier='handover')
+        rfk.database.session.add(stat)
+        rfk.database.session.flush()
+    stat.set(now(), int(seconds * 1000))
+    logger.info('handover took %.3fs' % (seconds,))
+
+def doMetaData(data, begin=None, coalesce=True):
     logger.debug('meta %s' % (json.dumps(data),))
     if 'userid' not in data or data['userid'] == 'none':
-        print 'no userid'
+        output('no userid\n')
         return
     user = User.get_user(id=data['userid'])
     if user == None:
-        print 'user not found'
+        output('user not found\n')
         return
     artist = data['artist'] or ''
     title = data['title'] or ''
@@ -140,28 +278,56 @@ def doMetaData(data):
             artist = song[0]
         if ('title' not in data) or (len(data['title'].strip()) == 0):
             title = song[1]
-    show = init_show(user)
-    track = Track.new_track(show, artist, title)
+    if begin is None:
+        begin = now()
+    if coalesce and metadata_coalescer is not None:
+        metadata_coalescer.submit(user.user, artist, title, begin)
+    else:
+        apply_metadata(user, artist, title, begin)
     rfk.database.session.commit()
 
-def doConnect(data):
+def apply_metadata(user, artist, title, begin=None):
+    """stores a new track for the users show
+    a repetition of the currently playing artist/title is ignored
+    
+    Keyword arguments:
+    user -- streaming user
+    artist, title -- metadata
+    begin -- when the track started, defaults to now
+    
+    """
+    show = init_show(user)
+    if begin is None:
+        begin = now()
+    current_track = Track.current_track()
+    if current_track is not None:
+        if current_track.show == show and\
+           current_track.title_id == Title.get_title_id(artist, title):
+            return
+        current_track.end_track(begin)
+    Track.new_track(show, artist, title, begin=begin)
+
+def apply_metadata_for(userid, artist, title, begin):
+    """callback for the MetadataCoalescer"""
+    try:
+        apply_metadata(User.get_user(id=userid), artist, title, begin)
+    except rexc.base.UserNotFoundException:
+        logger.warn('dropped metadata for unknown userid %s' % (userid,))
+
+def doConnect(data, kick_rejected=True):
     """handles a connect from liquidsoap
     
     Keyword arguments:
     data -- list of headers
+    kick_rejected -- kick the source client if the credentials are rejected,
+                     a replayed connect must not kick whoever streams by then
     
     """
     logger.info('connect request %s' % (json.dumps(data),))
     try:
-        auth = data['Authorization'].strip().split(' ')
-        if auth[0].lower() == 'basic':
-            username, password = base64.b64decode(auth[1]).split(':', 1)
-            if username == 'source':
-                username, password = password.split(username_delimiter, 1)
-        else:
-            raise ValueError
+        username, password = parse_authorization(data)
         user = User.authenticate(username, password)
-        if user.get_setting(code='use_icy'):
+        if get_connect_setting(user, 'use_icy'):
             if 'ice-genre' in data:
                 user.set_setting(data['ice-genre'],code='icy_show_genre')
             if 'ice-name' in data:
@@ -169,21 +335,40 @@ def doConnect(data):
             if 'ice-description' in data:
                 user.set_setting(data['ice-description'],code='icy_show_description')
         show = init_show(user)
+        if handover is not None:
+            elapsed = handover.connected(user.user)
+            if elapsed is not None:
+                record_handover(elapsed)
         rfk.database.session.commit()
         logger.info('accepted connect for %s' %(user.username,))
-        print user.user
+        output('%s\n' % (user.user,))
     except (rexc.base.UserNotFoundException, rexc.base.InvalidPasswordException, KeyError):
         logger.info('rejected connect')
-        kick()
+        if kick_rejected:
+            kick()
             
 
 
-def doDisconnect(userid):
+def parse_authorization(data):
+    """returns username and password from the headers of a connect"""
+    auth = data['Authorization'].strip().split(' ')
+    if auth[0].lower() == 'basic':
+        username, password = base64.b64decode(auth[1]).split(':', 1)
+        if username == 'source':
+            username, password = password.split(username_delimiter, 1)
+        return username, password
+    else:
+        raise ValueError
+
+def doDisconnect(userid, end=None):
     logger.info('diconnect for userid %s' % (userid,))
     if userid == "none" or userid == '':
-        print "Whooops no userid?"
+        output("Whooops no userid?\n")
         logger.warn('no userid supplied!')
         return
+    if metadata_coalescer is not None:
+        metadata_coalescer.flush(int(userid))
+        metadata_coalescer.forget(int(userid))
     rfk.database.session.commit()
     user = User.get_user(id=int(userid))
     if user:
@@ -193,43 +378,202 @@ def doDisconnect(userid):
             usershow.status = UserShow.STATUS.STREAMED
             if usershow.show.flags & Show.FLAGS.UNPLANNED:
                 usershow.show.end_show()
+            else:
+                ShowListenerStats.finalize(usershow.show, end)
         rfk.database.session.commit()
         track = Track.current_track()
         if track:
-            track.end_track()
+            track.end_track(end)
         rfk.database.session.commit()
     else:
-        print "no user found"
+        output("no user found\n")
 
 def doPlaylist():
     loop = Loop.get_current_loop()
-    print os.path.join(get_path(rfk.CONFIG.get('liquidsoap', 'looppath')), loop.filename)
+    output('%s\n' % (os.path.join(get_path(rfk.CONFIG.get('liquidsoap', 'looppath')), loop.filename),))
+
+def doSpool(command, args):
+    """appends a streaming event to the journal, the handler daemon applies it later
+    
+    a connect still has to answer with the userid, that only works without the
+    database if the credentials were verified by the preceding auth. Otherwise
+    they are checked against the database, the connect is journaled anyway so
+    it is applied after the events before it
+    
+    """
+    if command == 'connect':
+        try:
+            credentials = parse_authorization(json.loads(args[0]))
+        except (KeyError, ValueError, TypeError):
+            credentials = None
+        userid = None
+        if credentials is not None:
+            userid = User.get_cached_userid(*credentials)
+            if userid is None:
+                try:
+                    userid = User.authenticate(*credentials).user
+                except (rexc.base.UserNotFoundException, rexc.base.InvalidPasswordException):
+                    pass
+        if userid is None:
+            logger.info('rejected connect')
+            kick()
+            return
+        spool.append(command, args)
+        output('%s\n' % (userid,))
+    else:
+        spool.append(command, args)
+
+def apply_spooled(event):
+    """applies a journaled event in its own transaction
+    
+    database errors are reraised so the drainer retries the event later,
+    events that fail for any other reason are logged and dropped
+    
+    """
+    with captured_output():
+        _apply_spooled(event)
+
+def _superseded(event):
+    """checks whether a spooled metadata update is followed by another one of the
+    same user within the settle time, the later one then takes over its begin
+    
+    the coalescer only lives in memory, with the spool the journal holds the
+    updates back instead until they are stored
+    
+    """
+    if metadata_coalescer is None or spool is None:
+        return False
+    userid = json.loads(event['args'][0]).get('userid')
+    begin = event.get('begin', event['time'])
+    for later in spool.following(event['seq']):
+        if later['command'] != 'meta':
+            return False
+        if json.loads(later['args'][0]).get('userid') != userid:
+            continue
+        if later['time'] - event['time'] > metadata_coalescer.settle or\
+           later['time'] - begin > metadata_coalescer.max_delay:
+            return False
+        later['begin'] = begin
+        return True
+    return False
+
+def _apply_spooled(event):
+    try:
+        timestamp = datetime.fromtimestamp(event.get('begin', event['time']), pytz.utc)
+        args = event['args']
+        if event['command'] == 'connect':
+            doConnect(json.loads(args[0]), kick_rejected=False)
+        elif event['command'] == 'meta':
+            if not _superseded(event):
+                # stored before the drain moves past it, a crash must not lose it
+                doMetaData(json.loads(args[0]), begin=timestamp, coalesce=False)
+        elif event['command'] == 'disconnect':
+            doDisconnect(json.loads(args[0]), end=timestamp)
+        rfk.database.session.commit()
+    except SQLAlchemyError:
+        rfk.database.session.rollback()
+        raise
+    except Exception:
+        rfk.database.session.rollback()
+        logger.error('dropped spooled event %s\n%s' % (json.dumps(event), traceback.format_exc()))
+        rfk.database.session.commit()
+    finally:
+        rfk.database.session.remove()
+
+def doStatus():
+    """prints the backlogs of the handler daemon as json"""
+    status = {'spool': None, 'metadata': None}
+    if spool is not None:
+        status['spool'] = spool.backlog()
+    if metadata_coalescer is not None:
+        status['metadata'] = metadata_coalescer.backlog()
+    output(json.dumps(status))
 
 def doListenerCount():
     lc = Listener.get_total_listener()
-    sys.stdout.write("<icestats><source mount=\"/live.ogg\"><listeners>%d</listeners><Listeners>%d</Listeners></source></icestats>" % (lc,lc,))
+    output("<icestats><source mount=\"/live.ogg\"><listeners>%d</listeners><Listeners>%d</Listeners></source></icestats>" % (lc,lc,))
 
 
-def main():
-    parser = argparse.ArgumentParser(description='PyRfK Interface for liquidsoap',
-                                     epilog='Anyways this should normally not called manually')
-    parser.add_argument('--debug', action='store_true')
-    subparsers = parser.add_subparsers(dest='command', help='sub-command help')
-    
-    authparser = subparsers.add_parser('auth', help='a help')
-    authparser.add_argument('username')
-    authparser.add_argument('password')
+def handle(command, args):
+    """executes a single handler command and returns everything it printed
     
-    metadataparser = subparsers.add_parser('meta', help='a help')
-    metadataparser.add_argument('data', metavar='data', help='mostly some json encoded string from liquidsoap')
-    connectparser = subparsers.add_parser('connect', help='a help')
-    connectparser.add_argument('data', metavar='data', help='mostly some json encoded string from liquidsoap')
-    disconnectparser = subparsers.add_parser('disconnect', help='a help')
-    disconnectparser.add_argument('data', metavar='data', help='mostly some json encoded string from liquidsoap')
-    playlistparser = subparsers.add_parser('playlist', help='a help')
-    listenerparser = subparsers.add_parser('listenercount', help='prints total listenercount')
+    Keyword arguments:
+    command -- name of the subcommand (auth, meta, connect, disconnect, playlist, listenercount)
+    args -- list of raw string arguments as passed on the commandline
     
-    args = parser.parse_args()
+    """
+    recorder = get_recorder('liquidsoap-handler')
+    start = time.time()
+    error = True
+    with captured_output() as captured:
+        try:
+            run_task(_dispatch, command, args)
+            error = False
+        finally:
+            if recorder is not None:
+                recordable, username = get_recordable_args(command, args)
+                recorder.record_handler(start, time.time() - start, command, recordable, username,
+                                        captured.getvalue(), error)
+    return captured.getvalue()
+
+def get_recordable_args(command, args):
+    """returns args without credentials and the username they contained (or None)"""
+    try:
+        if command == 'auth':
+            return [args[0], None], args[0]
+        if command == 'connect':
+            data = json.loads(args[0])
+            username = parse_authorization(data)[0]
+            data['Authorization'] = None
+            return [json.dumps(data)], username
+    except (IndexError, KeyError, ValueError, TypeError):
+        return [], None
+    return args, None
+
+def _dispatch(command, args):
+    if spool is not None and command in spooled_commands:
+        # no database logging either, this has to work while the database is stalled
+        doSpool(command, args)
+        return
+    logger.info(command)
+    if command == 'auth':
+        doAuth(*args)
+    elif command == 'meta':
+        doMetaData(json.loads(args[0]))
+    elif command == 'connect':
+        doConnect(json.loads(args[0]))
+    elif command == 'disconnect':
+        doDisconnect(json.loads(args[0]))
+    elif command == 'playlist':
+        doPlaylist()
+    elif command == 'listenercount':
+        doListenerCount()
+    elif command == 'status':
+        doStatus()
+    else:
+        raise ValueError('unknown command %s' % (command,))
+
+def run_task(func, *args):
+    """runs func inside its own database session, errors are logged and reraised"""
+    try:
+        rfk.database.session.commit()
+        ret = func(*args)
+        rfk.database.session.commit()
+        return ret
+    except Exception:
+        rfk.database.session.rollback()
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        logger.error(''.join(traceback.format_exception(exc_type, exc_value, exc_tb)))
+        rfk.database.session.commit()
+        raise
+    finally:
+        rfk.database.session.remove()
+
+
+def main(args=None):
+    """runs a command in this process, see rfk.handlerclient for the usual entry point"""
+    if args is None:
+        args = get_parser().parse_args()
     
     rfk.init()
     rfk.database.init_db("%s://%s:%s@%s/%s" % (rfk.CONFIG.get('database', 'engine'),
@@ -237,32 +581,7 @@ def main():
                                                               rfk.CONFIG.get('database', 'password'),
                                                               rfk.CONFIG.get('database', 'host'),
                                                               rfk.CONFIG.get('database', 'database')))
-    logger.info(args.command)
-    rfk.database.session.commit()
-    if args.command == 'auth':
-        doAuth(args.username, args.password)
-    elif args.command == 'meta':
-        data = json.loads(args.data);
-        doMetaData(data)
-    elif args.command == 'connect':
-        data = json.loads(args.data);
-        doConnect(data)
-    elif args.command == 'disconnect':
-        data = json.loads(args.data);
-        doDisconnect(data)
-    elif args.command == 'playlist':
-        doPlaylist()
-    elif args.command == 'listenercount':
-        doListenerCount()
-    rfk.database.session.remove()
+    sys.stdout.write(handle(args.command, get_command_args(args)))
 
 if __name__ == '__main__':
-    try:
-        sys.exit(main())
-    except Exception as e:
-        rfk.database.session.rollback()
-        exc_type, exc_value, exc_tb = sys.exc_info()
-        import traceback
-        logger.error(''.join(traceback.format_exception(exc_type, exc_value, exc_tb)))
-        rfk.database.session.commit()
-        raise e
\ No newline at end of file
+    sys.exit(main())
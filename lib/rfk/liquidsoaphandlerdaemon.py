@@ -0,0 +1,40 @@
+#!/usr/bin/python2.7
+import rfk
+import sys
+import argparse
+
+import rfk.database
+from rfk.helper import get_path
+import rfk.helper.daemonize
+from rfk.liquidsoap.handlerdaemon import HandlerDaemon, SocketExists
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyRfK Daemon answering liquidsoaps handler calls',
+                                     epilog='Anyways this should normally not called manually')
+    parser.add_argument('--foreground', action='store_true')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    if not args.foreground:
+        rfk.helper.daemonize.createDaemon(get_path())
+
+    rfk.init()
+
+    rfk.database.init_db("%s://%s:%s@%s/%s" % (rfk.CONFIG.get('database', 'engine'),
+                                                            rfk.CONFIG.get('database', 'username'),
+                                                            rfk.CONFIG.get('database', 'password'),
+                                                            rfk.CONFIG.get('database', 'host'),
+                                                            rfk.CONFIG.get('database', 'database')))
+    try:
+        daemon = HandlerDaemon(get_path(rfk.CONFIG.get('liquidsoap-handler', 'socket')))
+        if args.debug:
+            daemon.set_debug(args.debug)
+        if args.foreground:
+            daemon.enable_stdout()
+        daemon.run()
+    except SocketExists:
+        print 'Socket is already there, maybe another instance running?'
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
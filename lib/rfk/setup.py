@@ -12,14 +12,20 @@ init_db("%s://%s:%s@%s/%s" % (rfk.CONFIG.get('database', 'engine'),
                               rfk.CONFIG.get('database', 'username'),
                               rfk.CONFIG.get('database', 'password'),
                               rfk.CONFIG.get('database', 'host'),
-                              rfk.CONFIG.get('database', 'database')))
+                              rfk.CONFIG.get('database', 'database')),
+        check_schema=False)
 import rfk.install
 
 def main():
+    rfk.install.setup_schema()
     rfk.install.setup_permissions()
     rfk.install.setup_settings()
     rfk.install.setup_default_user('admin', 'admin')
     rfk.database.session.commit()
 
+def migrate():
+    """creates missing tables and upgrades the schema, nothing else"""
+    rfk.install.setup_schema()
+
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
@@ -11,7 +11,7 @@ from rfk.site.forms.relay import new_relay
 from flask.ext.login import login_required, current_user
 
 import rfk.database
-from rfk.database.base import User, Loop
+from rfk.database.base import User, Loop, loop_schedule
 from rfk.database.streaming import Stream, Relay
 from rfk.exc.streaming import CodeTakenException, InvalidCodeException, MountpointTakenException, MountpointTakenException,\
     AddressTakenException
@@ -35,12 +35,14 @@ def loop_list():
             loop = Loop(begin=begin, end=end, filename=request.form.get('filename'))
             rfk.database.session.add(loop)
             rfk.database.session.commit()
+            loop_schedule.invalidate()
 #            except Exception as e:
 #                flash('error while inserting Loop')
         elif request.form.get('action') == 'delete':
             try:
                 rfk.database.session.delete(Loop.query.get(request.form.get('loopid')))
                 rfk.database.session.commit()
+                loop_schedule.invalidate()
             except Exception as e:
                 flash('error while deleting Loop')
     page = int(request.args.get('page') or 0)
@@ -12,7 +12,7 @@ from flask.ext.login import login_required, current_user
 
 import rfk.database
 from rfk.database.base import User, Loop
-from rfk.database.streaming import Stream, Relay
+from rfk.database.streaming import Stream, Relay, topology
 from rfk.exc.streaming import CodeTakenException, InvalidCodeException, MountpointTakenException, MountpointTakenException,\
     AddressTakenException
 from flask.helpers import flash
@@ -45,6 +45,7 @@ def relay_add():
                                     form.auth_username.data,form.auth_password.data,
                                     form.relay_username.data, form.relay_password.data, form.type.data)
             rfk.database.session.commit()
+            topology.invalidate()
         except AddressTakenException:
             form.address.errors.append('Address already in Database')
             form.port.errors.append('Address already in Database')
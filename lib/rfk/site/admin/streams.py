@@ -12,7 +12,7 @@ from flask.ext.login import login_required, current_user
 
 import rfk.database
 from rfk.database.base import User, Loop
-from rfk.database.streaming import Stream, Relay
+from rfk.database.streaming import Stream, Relay, topology
 from rfk.exc.streaming import CodeTakenException, InvalidCodeException, MountpointTakenException, MountpointTakenException,\
     AddressTakenException
 from flask.helpers import flash
@@ -41,6 +41,7 @@ def stream_add():
             if form.type.data != 0:
                 Stream.add_stream(form.code.data, form.name.data, form.mount.data, form.type.data, form.quality.data)
                 rfk.database.session.commit()
+                topology.invalidate()
                 return redirect(url_for('.stream_list'))
             else:
                 form.type.errors.append('Invalid type')
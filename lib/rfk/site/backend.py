@@ -4,23 +4,43 @@ Created on Aug 11, 2012
 @author: teddydestodes
 '''
 
-from flask import Blueprint, request, make_response
-from rfk.database.streaming import Relay, Stream, StreamRelay, Listener
+import time
+
+from flask import Blueprint, request, make_response, g
+from rfk.database.streaming import Relay, Stream, StreamRelay, Listener, ShowListenerStats
+from rfk.database.streaming import commit_listener_changes, topology
+from rfk.helper import now
+from rfk.helper.recorder import get_recorder
 from rfk.database import session
+from rfk.icecast.listenerqueue import get_listener_queue
 from rfk.log import init_db_logging
 
 backend = Blueprint('icecast',__name__)
 logger = init_db_logging('IcecastBackend')
+listener_queue = get_listener_queue()
+recorder = get_recorder('icecast')
+
+@backend.before_request
+def start_recording():
+    if recorder is not None:
+        g.record_start = time.time()
+
+@backend.after_request
+def record_request(response):
+    if recorder is not None:
+        recorder.record_icecast(g.record_start, time.time() - g.record_start, request.path,
+                                request.form.to_dict(), response.status_code)
+    return response
 
 @backend.route('/icecast/auth', methods=['POST'])
 def icecast_auth():
     logger.info('icecast_auth {}'.format(request.form))
     if request.form['action'] != 'stream_auth':
         return make_response('you just went full retard', 405)
-    relay = Relay.get_relay(address=request.form['server'],
-                            port=request.form['port'])
-    if relay.auth_password == request.form['pass'] and\
-       relay.auth_username == request.form['user']:
+    relay = topology.get_relay(request.form['server'], request.form['port'])
+    if relay is not None and\
+       relay['auth_password'] == request.form['pass'] and\
+       relay['auth_username'] == request.form['user']:
         return make_response('ok', 200, {'icecast-auth-user': '1'})
     else:
         return make_response('authentication failed', 401)
@@ -30,14 +50,21 @@ def icecast_add_mount():
     logger.info('add_mount {}'.format(request.form))
     if request.form['action'] != 'mount_add':
         return make_response('you just went full retard', 405)
-    relay = Relay.get_relay(address=request.form['server'],
-                            port=request.form['port'])
-    stream = Stream.get_stream(mount=request.form['mount'])
+    relay, stream, stream_relay = topology.lookup(request.form['server'], request.form['port'],
+                                                  request.form['mount'])
     if relay and stream:
-        stream.add_relay(relay)
-        relay.get_stream_relay(stream).status = StreamRelay.STATUS.ONLINE
+        relay = Relay.query.get(relay)
+        if stream_relay is None:
+            Stream.query.get(stream).add_relay(relay)
+            session.flush()
+            stream_relay = StreamRelay.query.filter(StreamRelay.relay_id == relay.relay,
+                                                    StreamRelay.stream_id == stream).one()
+        else:
+            stream_relay = StreamRelay.query.get(stream_relay)
+        stream_relay.status = StreamRelay.STATUS.ONLINE
         relay.status = Relay.STATUS.ONLINE
         session.commit()
+        topology.invalidate()
         return make_response('ok', 200, {'icecast-auth-user': '1'})
     else:
         return make_response('something strange happened', 500)
@@ -47,18 +74,28 @@ def icecast_remove_mount():
     logger.info('remove_mount {}'.format(request.form))
     if request.form['action'] != 'mount_remove':
         return make_response('you just went full retard', 405)
-    relay = Relay.get_relay(address=request.form['server'],
-                            port=request.form['port'])
-    stream = Stream.get_stream(mount=request.form['mount'])
+    relay, stream, stream_relay = topology.resolve(request.form['server'], request.form['port'],
+                                                   request.form['mount'])
     if relay and stream:
-        stream.add_relay(relay)
-        stream_relay = relay.get_stream_relay(stream)
-        stream_relay.set_offline()
-        session.flush()
-        relay.update_statistic()
-        stream.update_statistic()
-        relay.get_stream_relay(stream).update_statistic()
+        # queued listener events of the mount have to be stored first, an add
+        # stored afterwards would stay open and a remove would find nothing
+        listener_queue.flush()
+        if stream_relay is None:
+            # never came online, there is nobody to disconnect
+            Stream.query.get(stream).add_relay(Relay.query.get(relay))
+            session.flush()
+            stream_relay = StreamRelay.query.filter(StreamRelay.relay_id == relay,
+                                                    StreamRelay.stream_id == stream).one()
+        else:
+            stream_relay = StreamRelay.query.get(stream_relay)
+        disconnected = stream_relay.set_offline()
+        ShowListenerStats.record([(stream_relay.stream_relay, now(), -disconnected)])
+        commit_listener_changes({stream_relay.stream_relay: -disconnected})
+        stream_relay.relay.update_statistic(-disconnected)
+        stream_relay.stream.update_statistic(-disconnected)
+        stream_relay.update_statistic(-disconnected)
         session.commit()
+        topology.invalidate()
         return make_response('ok', 200, {'icecast-auth-user': '1'})
     else:
         return make_response('something strange happened', 500)
@@ -68,16 +105,10 @@ def icecast_remove_listener():
     #logger.info('remove_listener {}'.format(request.form))
     if request.form['action'] != 'listener_remove':
         return make_response('you just went full retard', 405)
-    relay = Relay.get_relay(address=request.form['server'],
-                            port=request.form['port'])
-    stream = Stream.get_stream(mount=request.form['mount'])
-    listener = Listener.get_listener(relay.get_stream_relay(stream), int(request.form['client']))
-    listener.set_disconnected()
-    session.flush()
-    relay.update_statistic()
-    stream.update_statistic()
-    relay.get_stream_relay(stream).update_statistic()
-    session.commit()
+    if topology.resolve(request.form['server'], request.form['port'], request.form['mount'])[2] is None:
+        return make_response('something strange happened', 500)
+    listener_queue.remove(request.form['server'], request.form['port'],
+                          request.form['mount'], request.form['client'])
     return make_response('ok', 200, {'icecast-auth-user': '1'})
 
 @backend.route('/icecast/listeneradd', methods=['POST'])
@@ -85,14 +116,8 @@ def icecast_add_listener():
     #logger.info('add_listener {}'.format(request.form))
     if request.form['action'] != 'listener_add':
         return make_response('you just went full retard', 405)
-    relay = Relay.get_relay(address=request.form['server'],
-                            port=request.form['port'])
-    stream = Stream.get_stream(mount=request.form['mount'])
-    listener = Listener.create(request.form['ip'], request.form['client'], request.form['agent'], relay.get_stream_relay(stream))
-    session.add(listener)
-    session.flush()
-    relay.update_statistic()
-    stream.update_statistic()
-    relay.get_stream_relay(stream).update_statistic()
-    session.commit()
+    if topology.resolve(request.form['server'], request.form['port'], request.form['mount'])[2] is None:
+        return make_response('something strange happened', 500)
+    listener_queue.add(request.form['server'], request.form['port'], request.form['mount'],
+                       request.form['ip'], request.form['client'], request.form['agent'])
     return make_response('ok', 200, {'icecast-auth-user': '1'})
@@ -6,6 +6,7 @@ Created on Feb 16, 2013
 from collections import deque
 from itertools import count, izip
 from collections import OrderedDict, Set
+import threading
 
 class RingBuffer(deque):
     """
@@ -34,6 +35,51 @@ class RingBuffer(deque):
         return list(self)
 
 
+class LRUCache(object):
+    """
+    bounded mapping that drops the least recently used
+    entry when size is reached, safe to share between threads
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+    
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+    
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+    
+    def __contains__(self, key):
+        return key in self.data
+    
+    def __len__(self):
+        return len(self.data)
+
+
 class SET(Set):
     def __init__(self, iterable = ()):
         self.num = count()
@@ -20,9 +20,12 @@ setup(
     zip_safe=False,
     entry_points={'console_scripts': ['rfk-werkzeug = rfk.app:main',
                                       'rfk-collectstats = rfk.collectstats:main',
-                                      'rfk-liquidsoaphandler = rfk.liquidsoaphandler:main',
+                                      'rfk-liquidsoaphandler = rfk.handlerclient:main',
+                                      'rfk-liquidsoaphandlerdaemon = rfk.liquidsoaphandlerdaemon:main',
                                       'rfk-liquidsoap = rfk.liquidsoapdaemon:main',
-                                      'rfk-setup = rfk.setup:main']},
+                                      'rfk-setup = rfk.setup:main',
+                                      'rfk-migrate = rfk.setup:migrate',
+                                      'rfk-benchmark = rfk.benchmark:main']},
     install_requires=['Flask', 'Flask-Login', 'Flask-Babel',
                       'wtforms',
                       'pytz',
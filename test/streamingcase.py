@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+import rfk
+import rfk.database
+import rfk.database.streaming
+from rfk.database.streaming import Stream, Relay, StreamRelay, topology
+from rfk.helper.counters import SharedCounters
+from rfk.helper import now
+
+
+class StreamingTestCase(unittest.TestCase):
+    """an in-memory database with one relay carrying streams, shared listener
+    counters in a temporary file and GeoIP lookups answered without a database"""
+
+    # (code, mount) of the streams on the relay
+    mounts = (('ogg', '/live.ogg'),)
+
+    def setUp(self):
+        rfk.init()
+        rfk.database.init_db('sqlite://', migrate_schema=True)
+        self.get_location = rfk.database.streaming.get_location
+        rfk.database.streaming.get_location = lambda address: {'country_code': 'DE', 'city': 'Berlin'}
+        relay = Relay.add_relay('127.0.0.1', 8000, 1000, 'admin', 'admin', 'source', 'source',
+                                'relay', 'relay', Relay.TYPE.MASTER)
+        stream_relays = []
+        for code, mount in self.mounts:
+            stream = Stream.add_stream(code, code, mount, Stream.TYPES.OGG, 4)
+            stream_relays.append(StreamRelay(relay=relay, stream=stream))
+            rfk.database.session.add(stream_relays[-1])
+        rfk.database.session.flush()
+        self.relay = relay.relay
+        self.stream_ids = [stream_relay.stream_id for stream_relay in stream_relays]
+        self.stream_relay_ids = [stream_relay.stream_relay for stream_relay in stream_relays]
+        # the first stream, most tests need no other
+        self.stream = self.stream_ids[0]
+        self.stream_relay = self.stream_relay_ids[0]
+        self.time = now()
+        self.populate()
+        rfk.database.session.commit()
+        topology.invalidate()
+        fd, self.counters_path = tempfile.mkstemp()
+        os.close(fd)
+        self.counters = SharedCounters(self.counters_path, slots=64)
+        rfk.database.streaming.listener_counters = self.counters
+        rfk.database.streaming.reconcile_listener_counters(self.counters, force=True)
+
+    def populate(self):
+        """adds the rows a test case needs before the counters are reconciled"""
+        pass
+
+    def tearDown(self):
+        rfk.database.streaming.get_location = self.get_location
+        rfk.database.streaming.listener_counters = None
+        self.counters.close()
+        os.unlink(self.counters_path)
+        rfk.database.session.remove()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import rfk
+import rfk.database
+from rfk.benchmark import percentile, summarize, parse_budget, check_budget
+from rfk.benchmark.icecast import Traffic
+from rfk.benchmark.handler import seed, run_child, start_daemon, LOCAL_MODULES, CLIENT_MODULES
+
+
+class Test(unittest.TestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 51)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(summarize([])['count'], 0)
+
+    def test_budget(self):
+        budgets = parse_budget('auth=50, meta=100,200')
+        self.assertEqual(budgets, {'auth': 50., 'meta': 100., None: 200.})
+        self.assertEqual(check_budget(budgets, 'auth', 60.), 50.)
+        self.assertIsNone(check_budget(budgets, 'meta', 60.))
+        self.assertEqual(check_budget(budgets, 'playlist', 250.), 200.)
+        self.assertIsNone(check_budget({}, 'auth', 1e6))
+
+    def test_handler_child(self):
+        rfk.init()
+        workdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(workdir, 'loops'))
+            db_uri = 'sqlite:///%s' % (os.path.join(workdir, 'benchmark.db'),)
+            seed(db_uri, os.path.join(workdir, 'loops'), 0)
+            timings = run_child('cold', db_uri, workdir, 'playlist', [])
+        finally:
+            rfk.database.session.remove()
+            shutil.rmtree(workdir)
+        self.assertEqual([module for module, seconds in timings['imports']], LOCAL_MODULES)
+        # the child imported nothing before its clock started
+        imports = dict(timings['imports'])
+        self.assertTrue(imports['flask'] > 0 and imports['rfk'] > 0)
+        self.assertTrue(timings['output'].strip().endswith('loop.ogg'))
+
+    def test_daemon_child(self):
+        rfk.init()
+        workdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(workdir, 'loops'))
+            db_uri = 'sqlite:///%s' % (os.path.join(workdir, 'benchmark.db'),)
+            seed(db_uri, os.path.join(workdir, 'loops'), 0)
+            daemon, thread = start_daemon(db_uri, workdir)
+            try:
+                timings = run_child('daemon', db_uri, workdir, 'playlist', [])
+            finally:
+                daemon.quit = True
+                thread.join()
+        finally:
+            rfk.database.session.remove()
+            shutil.rmtree(workdir)
+        self.assertEqual([module for module, seconds in timings['imports']], CLIENT_MODULES)
+        self.assertTrue(timings['output'].strip().endswith('loop.ogg'))
+        # answered by the daemon, the client never loaded the heavy parts
+        for package in ('flask', 'sqlalchemy', 'pygeoip'):
+            self.assertNotIn(package, timings['packages'])
+
+    def test_traffic(self):
+        phases = Traffic(2, 2).phases(200, churn=1., mount_churn=2)
+        self.assertEqual([name for name, ordered, events in phases],
+                         ['start', 'connect', 'churn', 'mount cycle', 'churn', 'mount cycle', 'churn',
+                          'disconnect', 'stop'])
+        online = set()
+        listeners = set()
+        for name, ordered, events in phases:
+            # within a phase every remove refers to a listener of an earlier phase
+            before = set(listeners)
+            for event in events:
+                mount = (event['server'], event['port'], event['mount'])
+                if event['action'] == 'mount_add':
+                    online.add(mount)
+                elif event['action'] == 'mount_remove':
+                    online.remove(mount)
+                    listeners = set(listener for listener in listeners if listener[0] != mount)
+                elif event['action'] == 'listener_add':
+                    self.assertIn(mount, online)
+                    listeners.add((mount, event['client']))
+                elif event['action'] == 'listener_remove':
+                    self.assertIn((mount, event['client']), before)
+                    listeners.remove((mount, event['client']))
+            if name == 'connect':
+                self.assertEqual(len(listeners), 200)
+        self.assertEqual(listeners, set())
+        self.assertEqual(online, set())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+import rfk
+import rfk.helper
+from rfk.helper import LocationCache, load_geoip, geoip_stats
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.looked_up = []
+
+    def lookup(self, address):
+        self.looked_up.append(address)
+        return {'country_code': 'DE', 'city': u'K\xf6ln'}
+
+    def test_address(self):
+        cache = LocationCache(2)
+        for address in ('1.2.3.4', '1.2.3.4', '5.6.7.8', '1.2.3.4', '9.9.9.9', '5.6.7.8'):
+            self.assertEqual(cache.get(address, self.lookup)['city'], u'K\xf6ln')
+        # 5.6.7.8 was the least recently used one when 9.9.9.9 came in
+        self.assertEqual(self.looked_up, ['1.2.3.4', '5.6.7.8', '9.9.9.9', '5.6.7.8'])
+        self.assertEqual(cache.stats(), {'hits': 2, 'prefix_hits': 0, 'misses': 4, 'size': 2})
+
+    def test_prefix(self):
+        cache = LocationCache(10, 10)
+        cache.get('1.2.3.4', self.lookup)
+        cache.get('1.2.3.200', self.lookup)
+        cache.get('1.2.4.1', self.lookup)
+        cache.get('::1', self.lookup)
+        cache.get('1.2.3.200', self.lookup)
+        self.assertEqual(self.looked_up, ['1.2.3.4', '1.2.4.1', '::1'])
+        self.assertEqual(cache.stats(), {'hits': 2, 'prefix_hits': 1, 'misses': 3, 'size': 4})
+
+    def test_missing_record(self):
+        cache = LocationCache(10)
+        lookup = lambda address: self.looked_up.append(address)
+        self.assertEqual(cache.get('10.0.0.1', lookup), None)
+        self.assertEqual(cache.get('10.0.0.1', lookup), None)
+        self.assertEqual(self.looked_up, ['10.0.0.1'])
+
+    def test_load_geoip(self):
+        rfk.init()
+        fd, path = tempfile.mkstemp()
+        os.write(fd, 'x' * 1024)
+        os.close(fd)
+        rfk.CONFIG.set('site', 'geoipdb', path)
+        rfk.CONFIG.remove_option('site', 'geoipmode')
+        opened = []
+        GeoIP = rfk.helper.pygeoip.GeoIP
+        rfk.helper.pygeoip.GeoIP = lambda filename, flags: opened.append((filename, flags)) or 'geoip'
+        try:
+            self.assertEqual(load_geoip(), 'geoip')
+            self.assertEqual(load_geoip('memory'), 'geoip')
+        finally:
+            rfk.helper.pygeoip.GeoIP = GeoIP
+            os.unlink(path)
+        # mmap unless configured otherwise, like the shipped configs
+        self.assertEqual(opened, [(path, rfk.helper.pygeoip.MMAP_CACHE),
+                                  (path, rfk.helper.pygeoip.MEMORY_CACHE)])
+        self.assertEqual(geoip_stats['mode'], 'memory')
+        self.assertEqual(geoip_stats['file_size'], 1024)
+        self.assertTrue(geoip_stats['resident_growth'] is None or
+                        isinstance(geoip_stats['resident_growth'], (int, long)))
+
+if __name__ == "__main__":
+    unittest.main()
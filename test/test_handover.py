@@ -0,0 +1,96 @@
+import time
+import socket
+import threading
+import unittest
+
+from rfk.liquidsoap import LiquidInterface
+from rfk.liquidsoap.handover import Handover
+
+
+class SlowLiquidsoap(threading.Thread):
+    """telnet interface that answers every command after delay seconds"""
+
+    answers = {'list': 'a : input.harbor\nb : input.harbor\nc : input.harbor\nEND\r\n'}
+
+    def __init__(self, delay):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.delay = delay
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+    def run(self):
+        conn, addr = self.server.accept()
+        f = conn.makefile('rb')
+        try:
+            for line in iter(f.readline, ''):
+                time.sleep(self.delay)
+                conn.sendall(self.answers.get(line.strip(), 'source connected\nEND\r\n'))
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+            self.server.close()
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.kicks = []
+        self.release = threading.Event()
+        self.handover = Handover(self.kick, deadline=5., reserve=30.)
+
+    def kick(self, timeout):
+        self.kicks.append(timeout)
+        self.release.wait(1)
+
+    def test_free_slot_is_accepted(self):
+        self.assertTrue(self.handover.request(1, False, timestamp=100.))
+        self.assertEqual(self.kicks, [])
+        self.assertEqual(self.handover.connected(1, timestamp=101.5), 1.5)
+        self.assertIsNone(self.handover.reserved_for(timestamp=102.))
+
+    def test_busy_slot_is_kicked_in_background(self):
+        self.assertFalse(self.handover.request(1, True, timestamp=100.))
+        self.assertFalse(self.handover.allows(2, timestamp=101.))
+        self.assertFalse(self.handover.request(1, True, timestamp=101.))
+        self.release.set()
+        self.assertTrue(self.handover.wait(1))
+        self.assertEqual(self.kicks, [5.])
+        self.assertTrue(self.handover.request(1, True, timestamp=102.))
+        self.assertEqual(self.handover.connected(1, timestamp=103.), 3.)
+        self.assertTrue(self.handover.allows(2, timestamp=104.))
+
+    def test_deadline(self):
+        self.assertFalse(self.handover.request(1, True, timestamp=100.))
+        self.assertTrue(self.handover.request(1, True, timestamp=106.))
+        self.release.set()
+
+    def test_kick_deadline_covers_all_steps(self):
+        liquidsoap = SlowLiquidsoap(0.1)
+        liquidsoap.start()
+        interface = LiquidInterface(port=liquidsoap.port)
+        start = time.time()
+        interface.connect(0.35)
+        def kick():
+            # list, then status and kick per source, each step alone is well within the timeout
+            for source in interface.get_sources():
+                source.status()
+                source.kick()
+        try:
+            self.assertRaises(socket.timeout, kick)
+        finally:
+            interface.close()
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_reservation_expires(self):
+        self.release.set()
+        self.handover.request(1, True, timestamp=100.)
+        self.assertEqual(self.handover.reserved_for(timestamp=129.), 1)
+        self.assertTrue(self.handover.allows(2, timestamp=131.))
+        self.assertIsNone(self.handover.connected(1, timestamp=132.))
+
+if __name__ == "__main__":
+    unittest.main()
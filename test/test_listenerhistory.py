@@ -0,0 +1,41 @@
+import unittest
+from datetime import timedelta
+
+import rfk
+import rfk.database
+import rfk.database.streaming
+from rfk.database.streaming import Listener, ListenerHistory
+from rfk.database.streaming import archive_listeners
+from streamingcase import StreamingTestCase
+
+
+class Test(StreamingTestCase):
+
+    def populate(self):
+        # client: hours since the disconnect, None for connected listeners
+        for client, hours in ((1, 5), (2, 3), (3, None), (4, 2), (5, 0), (6, 4)):
+            listener = Listener(client=client, connect=self.time - timedelta(hours=6),
+                                stream_relay_id=self.stream_relay, useragent='test')
+            if hours is not None:
+                listener.disconnect = self.time - timedelta(hours=hours)
+            rfk.database.session.add(listener)
+
+    def clients(self, model):
+        return sorted(row.client for row in model.query.all())
+
+    def test_archive(self):
+        self.assertEqual(archive_listeners(self.time - timedelta(hours=1), batch_size=2), 3)
+        self.assertEqual(self.clients(Listener), [3, 5, 6])
+        self.assertEqual(self.clients(ListenerHistory), [1, 2, 4])
+        self.assertEqual(ListenerHistory.query.filter(ListenerHistory.client == 1).one().useragent, 'test')
+        self.assertEqual(Listener.get_total_listener(), 1)
+        # the newest listener stays even though it is due
+        self.assertEqual(archive_listeners(self.time + timedelta(hours=1)), 1)
+        self.assertEqual(self.clients(Listener), [3, 6])
+
+    def test_limit(self):
+        self.assertEqual(archive_listeners(self.time - timedelta(hours=1), batch_size=1, limit=2), 2)
+        self.assertEqual(self.clients(ListenerHistory), [1, 2])
+
+if __name__ == "__main__":
+    unittest.main()
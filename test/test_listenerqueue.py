@@ -0,0 +1,277 @@
+import time
+import threading
+import unittest
+from datetime import timedelta
+
+import rfk
+import rfk.database
+import rfk.database.streaming
+from rfk.database.streaming import Stream, Relay, StreamRelay, Listener, topology
+from rfk.database.streaming import COUNTER_TOTAL, COUNTER_STREAM, COUNTER_RELAY, COUNTER_STREAM_RELAY
+from rfk.helper.counters import SharedCounters
+from rfk.icecast.listenerqueue import ListenerQueue
+from rfk.icecast.enrichment import LocationEnricher
+from streamingcase import StreamingTestCase
+
+
+class Test(StreamingTestCase):
+
+    def setUp(self):
+        StreamingTestCase.setUp(self)
+        self.queue = ListenerQueue(interval=1, batch_size=100)
+
+    def add(self, client, seconds=0, useragent='test', address='127.0.0.1'):
+        self.queue.put({'action': 'add', 'server': '127.0.0.1', 'port': 8000, 'mount': '/live.ogg',
+                        'address': address, 'client': client, 'useragent': useragent,
+                        'time': self.time + timedelta(seconds=seconds)})
+
+    def remove(self, client, seconds=0):
+        self.queue.put({'action': 'remove', 'server': '127.0.0.1', 'port': 8000, 'mount': '/live.ogg',
+                        'client': client, 'time': self.time + timedelta(seconds=seconds), 'retries': 0})
+
+    def listeners(self, client):
+        return Listener.query.filter(Listener.client == client).order_by(Listener.listener).all()
+
+    def test_batch(self):
+        for client in xrange(10):
+            self.add(client)
+        self.assertEqual(Listener.query.count(), 0)
+        self.assertEqual(self.queue.flush(), 10)
+        self.assertEqual(Listener.get_total_listener(), 10)
+        self.assertEqual(self.listeners(3)[0].country, 'DE')
+        for client in xrange(5):
+            self.remove(client, 10)
+        self.queue.flush()
+        self.assertEqual(Listener.get_total_listener(), 5)
+        statistic = StreamRelay.query.get(self.stream_relay).statistic
+        self.assertEqual(list(statistic.get(num=1, reverse=True))[0].value, 5)
+
+    def test_order_within_batch(self):
+        self.add(1)
+        self.remove(1, 5)
+        self.add(2)
+        self.queue.flush()
+        listener = self.listeners(1)[0]
+        self.assertEqual(listener.disconnect - listener.connect, timedelta(seconds=5))
+        self.assertIsNone(self.listeners(2)[0].disconnect)
+
+    def test_early_remove_is_retried(self):
+        """the add was queued in another worker"""
+        self.remove(1, 5)
+        self.queue.flush()
+        self.assertEqual(self.queue.backlog(), 1)
+        other = ListenerQueue()
+        other.put({'action': 'add', 'server': '127.0.0.1', 'port': 8000, 'mount': '/live.ogg',
+                   'address': '127.0.0.1', 'client': 1, 'useragent': 'test', 'time': self.time})
+        other.flush()
+        self.queue.flush()
+        self.assertEqual(self.queue.backlog(), 0)
+        self.assertIsNotNone(self.listeners(1)[0].disconnect)
+
+    def test_unknown_mount_is_dropped(self):
+        self.queue.put({'action': 'remove', 'server': '127.0.0.1', 'port': 8000, 'mount': '/nope',
+                        'client': 1, 'time': self.time, 'retries': 0})
+        self.queue.flush()
+        self.assertEqual(self.queue.backlog(), 0)
+        self.assertEqual(self.queue.stats['dropped'], 1)
+
+    def test_failed_flush_is_requeued(self):
+        self.add(1)
+        self.remove(2)
+        locate = self.queue._locate
+        def fail(rows, addresses):
+            raise ValueError('lookup failed')
+        self.queue.enricher = LocationEnricher()
+        self.queue.enricher._ensure_thread = lambda: None
+        self.queue._locate = fail
+        self.assertRaises(ValueError, self.queue.flush)
+        self.assertEqual(self.queue.backlog(), 2)
+        self.assertEqual((self.queue.stats['added'], self.queue.stats['flushes']), (0, 0))
+        self.assertEqual(Listener.query.count(), 0)
+        self.queue._locate = locate
+        self.queue.flush()
+        self.assertEqual(len(self.listeners(1)), 1)
+        self.assertEqual(self.queue.stats['added'], 1)
+        # the remove was not counted as a retry by the failed flush
+        self.assertEqual(self.queue.retry[0]['retries'], 1)
+
+    def test_counters(self):
+        for client in xrange(4):
+            self.add(client)
+        self.remove(3)
+        self.queue.flush()
+        self.remove(0)
+        self.queue.flush()
+        for kind, id in ((COUNTER_TOTAL, 0), (COUNTER_STREAM, self.stream),
+                         (COUNTER_RELAY, self.relay), (COUNTER_STREAM_RELAY, self.stream_relay)):
+            self.assertEqual(self.counters.get(kind, id), 2)
+        self.assertEqual(Listener.get_total_listener(), 2)
+        # changes behind the back of the counters are picked up by the next reconcile
+        Listener.query.filter(Listener.client == 1).one().set_disconnected()
+        rfk.database.session.commit()
+        self.assertEqual(Listener.get_total_listener(), 2)
+        self.counters.set_reconciled(0.)
+        self.assertEqual(Listener.get_total_listener(), 1)
+        self.assertEqual(Stream.query.get(self.stream).get_current_listeners(), 1)
+
+    def test_counters_are_shared(self):
+        self.add(1)
+        self.queue.flush()
+        other = SharedCounters(self.counters_path, slots=64)
+        self.assertEqual(other.get(COUNTER_STREAM_RELAY, self.stream_relay), 1)
+        with other.locked():
+            other.add(COUNTER_STREAM_RELAY, self.stream_relay, 2)
+        self.assertEqual(self.counters.get(COUNTER_STREAM_RELAY, self.stream_relay), 3)
+        other.close()
+
+    def test_readers_wait_for_replace(self):
+        other = SharedCounters(self.counters_path, slots=64)
+        read = []
+        reader = threading.Thread(target=lambda: read.append(other.get(COUNTER_TOTAL, 0)))
+        with self.counters.locked():
+            self.counters.replace({})
+            reader.start()
+            time.sleep(0.1)
+            # nested within locked(), reading keeps the exclusive lock
+            self.assertEqual(self.counters.get(COUNTER_TOTAL, 0), 0)
+            self.assertEqual(read, [])
+            self.counters.replace({(COUNTER_TOTAL, 0): 5})
+        reader.join()
+        self.assertEqual(read, [5])
+        other.close()
+
+    def test_topology(self):
+        self.assertEqual(topology.lookup('127.0.0.1', '8000', '/live.ogg'),
+                         (self.relay, self.stream, self.stream_relay))
+        self.assertEqual(topology.get_relay('127.0.0.1', 8000)['auth_password'], 'source')
+        self.assertEqual(topology.lookup('127.0.0.1', 8000, '/other.ogg'), (self.relay, None, None))
+        # added by another worker, a miss looks again right away
+        stream = Stream.add_stream('mp3', 'Mp3', '/other.ogg', Stream.TYPES.MP3, 4)
+        rfk.database.session.commit()
+        self.assertEqual(topology.lookup('127.0.0.1', 8000, '/other.ogg'), (self.relay, stream.stream, None))
+        stream_relay = StreamRelay(relay=Relay.query.get(self.relay), stream=stream)
+        rfk.database.session.add(stream_relay)
+        rfk.database.session.commit()
+        self.assertEqual(topology.lookup('127.0.0.1', 8000, '/other.ogg'),
+                         (self.relay, stream.stream, stream_relay.stream_relay))
+
+    def test_topology_resolve(self):
+        stream = Stream.add_stream('mp3', 'Mp3', '/other.ogg', Stream.TYPES.MP3, 4)
+        rfk.database.session.commit()
+        self.assertEqual(topology.lookup('127.0.0.1', 8000, '/other.ogg'), (self.relay, stream.stream, None))
+        stream_relay = StreamRelay(relay=Relay.query.get(self.relay), stream=stream)
+        rfk.database.session.add(stream_relay)
+        rfk.database.session.commit()
+        # a change the signature does not catch
+        topology._check = lambda force=False: None
+        try:
+            self.assertEqual(topology.lookup('127.0.0.1', 8000, '/other.ogg'), (self.relay, stream.stream, None))
+            self.assertEqual(topology.resolve('127.0.0.1', '8000', '/other.ogg'),
+                             (self.relay, stream.stream, stream_relay.stream_relay))
+        finally:
+            del topology._check
+        self.assertEqual(topology.resolve('127.0.0.1', 8000, '/nope.ogg'), (self.relay, None, None))
+
+    def test_enrichment(self):
+        enricher = LocationEnricher()
+        enricher._ensure_thread = lambda: None
+        self.queue.enricher = enricher
+        self.add(1)
+        self.add(2)
+        self.queue.flush()
+        self.assertEqual([listener.country for listener in Listener.query.all()], [None, None])
+        self.assertEqual(enricher.backlog(), 2)
+        # not committed yet or gone
+        enricher.put(1000, '127.0.0.1')
+        self.assertEqual(enricher.flush(), 3)
+        self.assertEqual([(listener.country, listener.city) for listener in Listener.query.all()],
+                         [('DE', 'Berlin'), ('DE', 'Berlin')])
+        self.assertEqual(enricher.backlog(), 1)
+        self.assertEqual(enricher.stats['enriched'], 2)
+
+    def test_enrichment_whole_seconds(self):
+        # like mysql DATETIME columns, the database drops fractions of a second
+        rfk.database.engine.execute("CREATE TRIGGER truncate_connect AFTER INSERT ON listeners BEGIN "
+                                    "UPDATE listeners SET connect = substr(connect, 1, 19) "
+                                    "WHERE listener = NEW.listener; END")
+        self.time = self.time.replace(microsecond=500000)
+        enricher = LocationEnricher()
+        enricher._ensure_thread = lambda: None
+        self.queue.enricher = enricher
+        self.add(1)
+        self.remove(1, 1)
+        self.add(1, 2)
+        self.add(2, 2)
+        self.queue.flush()
+        self.assertEqual(Listener.query.first().connect, self.time.replace(microsecond=0))
+        self.assertEqual(enricher.backlog(), 3)
+        enricher.flush()
+        self.assertEqual([listener.city for listener in Listener.query.all()], ['Berlin'] * 3)
+
+    def test_reconnect(self):
+        self.queue.reconnect_grace = 10
+        self.add(1)
+        self.remove(1, 60)
+        self.queue.flush()
+        listener_id = self.listeners(1)[0].listener
+        # back within the grace, reopens the listener
+        self.add(2, 65)
+        self.queue.flush()
+        self.assertEqual(self.listeners(2)[0].listener, listener_id)
+        self.assertEqual(self.listeners(2)[0].disconnect, None)
+        self.assertEqual(Listener.query.count(), 1)
+        # twice within one batch, then too late and from another player
+        self.remove(2, 70)
+        self.add(3, 72)
+        self.remove(3, 80)
+        self.add(4, 85)
+        self.remove(4, 90)
+        self.add(5, 120)
+        self.add(6, 91, useragent='other')
+        self.queue.flush()
+        self.assertEqual(self.listeners(4)[0].listener, listener_id)
+        self.assertEqual(self.listeners(4)[0].disconnect, self.time + timedelta(seconds=90))
+        self.assertEqual(Listener.query.count(), 3)
+        self.assertEqual(self.queue.stats['stitched'], 3)
+        self.assertEqual(self.counters.get(COUNTER_TOTAL, 0), 2)
+
+    def test_reconnect_within_batch(self):
+        self.queue.reconnect_grace = 10
+        self.add(1)
+        self.remove(1, 5)
+        self.add(2, 10)
+        self.queue.flush()
+        self.assertEqual(Listener.query.count(), 1)
+        listener = self.listeners(2)[0]
+        # the gap is no listening time
+        self.assertEqual((listener.connect, listener.disconnect), (self.time + timedelta(seconds=5), None))
+
+    def test_reconnect_needs_address(self):
+        self.queue.reconnect_grace = 10
+        self.add(1)
+        self.remove(1, 60)
+        self.queue.flush()
+        # same player, another listener
+        self.add(2, 62, address='127.0.0.2')
+        self.queue.flush()
+        self.assertEqual(Listener.query.count(), 2)
+        self.remove(2, 70)
+        self.queue.flush()
+        listener_id = self.listeners(2)[0].listener
+        # addresses are not stored, another process has no idea where client 2 came from
+        queue = ListenerQueue(interval=1, batch_size=100, reconnect_grace=10)
+        queue.put({'action': 'add', 'server': '127.0.0.1', 'port': 8000, 'mount': '/live.ogg',
+                   'address': '127.0.0.2', 'client': 3, 'useragent': 'test',
+                   'time': self.time + timedelta(seconds=72)})
+        queue.flush()
+        self.assertEqual(Listener.query.count(), 3)
+        # this one does
+        self.add(4, 74, address='127.0.0.2')
+        self.queue.flush()
+        self.assertEqual(Listener.query.count(), 3)
+        listener = self.listeners(4)[0]
+        self.assertEqual(listener.listener, listener_id)
+        self.assertEqual(listener.connect, self.time + timedelta(seconds=66))
+
+if __name__ == "__main__":
+    unittest.main()
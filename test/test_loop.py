@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import rfk
+import rfk.database
+from rfk.database.base import Loop, LoopSchedule, loop_schedule
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        rfk.init()
+        rfk.database.init_db('sqlite://', migrate_schema=True)
+        self.looppath = tempfile.mkdtemp()
+        self.old_looppath = rfk.CONFIG.get('liquidsoap', 'looppath')
+        rfk.CONFIG.set('liquidsoap', 'looppath', self.looppath)
+        loop_schedule.invalidate()
+        for begin, end, filename in ((0, 2400, 'all.ogg'),
+                                     (600, 1200, 'morning.ogg'),
+                                     (2200, 200, 'night.ogg'),
+                                     (1300, 1400, 'missing.ogg')):
+            rfk.database.session.add(Loop(begin=begin, end=end, filename=filename))
+        rfk.database.session.commit()
+        for filename in ('all.ogg', 'morning.ogg', 'night.ogg'):
+            open(os.path.join(self.looppath, filename), 'w').close()
+
+    def tearDown(self):
+        rfk.CONFIG.set('liquidsoap', 'looppath', self.old_looppath)
+        shutil.rmtree(self.looppath)
+        loop_schedule.invalidate()
+        rfk.database.session.remove()
+
+    def filename_at(self, minute):
+        return Loop.query.get(loop_schedule.get_loop(minute)).filename
+
+    def test_schedule_matches_query(self):
+        for minute in xrange(0, 1440, 7):
+            point = LoopSchedule.minute_to_point(minute)
+            expected = [loop for loop in Loop.query.filter(Loop.contains(point)).order_by(Loop.length.asc(), Loop.loop.asc())
+                        if loop.file_exists]
+            self.assertEqual(loop_schedule.get_loop(minute), expected[0].loop)
+        self.assertEqual(self.filename_at(9 * 60), 'morning.ogg')
+        self.assertEqual(self.filename_at(23 * 60), 'night.ogg')
+        self.assertEqual(self.filename_at(13 * 60 + 30), 'all.ogg')
+
+    def test_file_appears(self):
+        self.assertEqual(self.filename_at(13 * 60 + 30), 'all.ogg')
+        os.utime(self.looppath, (0, 0))
+        open(os.path.join(self.looppath, 'missing.ogg'), 'w').close()
+        self.assertEqual(self.filename_at(13 * 60 + 30), 'missing.ogg')
+
+    def test_fallback_and_invalidate(self):
+        rfk.database.session.delete(Loop.query.filter(Loop.filename == 'all.ogg').one())
+        rfk.database.session.commit()
+        loop_schedule.invalidate()
+        self.assertEqual(self.filename_at(15 * 60), 'night.ogg')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+from rfk.liquidsoap.metadata import MetadataCoalescer
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.applied = []
+        self.coalescer = MetadataCoalescer(lambda *args: self.applied.append(args), settle=2.)
+
+    def test_burst_is_coalesced(self):
+        self.coalescer.submit(1, 'a', 't1', 'begin1', timestamp=100.)
+        self.coalescer.submit(1, 'a', 't2', 'begin2', timestamp=100.5)
+        self.coalescer.submit(1, 'b', 't3', 'begin3', timestamp=101.)
+        self.assertEqual(self.coalescer.flush_due(102.), 0)
+        self.assertEqual(self.coalescer.flush_due(103.), 1)
+        self.assertEqual(self.applied, [(1, 'b', 't3', 'begin1')])
+
+    def test_duplicate_is_dropped(self):
+        self.coalescer.submit(1, 'a', 't', 'begin1', timestamp=100.)
+        self.coalescer.flush_due(110.)
+        self.assertFalse(self.coalescer.submit(1, 'a', 't', 'begin2', timestamp=111.))
+        self.assertEqual(self.coalescer.backlog(), 0)
+        self.assertEqual(len(self.applied), 1)
+
+    def test_max_delay(self):
+        for i in range(20):
+            self.coalescer.submit(1, 'a', 't%d' % i, i, timestamp=100. + i)
+        self.assertEqual(self.applied, [])
+        self.coalescer.flush_due(108.)
+        self.assertEqual(len(self.applied), 1)
+
+    def test_users_are_independent(self):
+        self.coalescer.submit(1, 'a', 't', 'b1', timestamp=100.)
+        self.coalescer.submit(2, 'a', 't', 'b2', timestamp=100.)
+        self.coalescer.flush(2)
+        self.assertEqual(self.applied, [(2, 'a', 't', 'b2')])
+        self.assertEqual(self.coalescer.backlog(), 1)
+
+    def test_failed_apply_is_kept(self):
+        def apply(*args):
+            if not self.applied:
+                self.applied.append(None)
+                # another packet arrives while the first one is stored
+                self.coalescer.submit(1, 'b', 't2', 'begin2', timestamp=101.)
+                raise IOError('database gone')
+            self.applied.append(args)
+        self.coalescer.apply = apply
+        self.coalescer.submit(1, 'a', 't1', 'begin1', timestamp=100.)
+        self.assertRaises(IOError, self.coalescer.flush_due, 110.)
+        self.assertEqual(self.coalescer.backlog(), 1)
+        self.assertEqual(self.coalescer.flush_due(110.), 1)
+        self.assertEqual(self.applied, [None, (1, 'b', 't2', 'begin1')])
+
+    def test_failed_apply_is_retried(self):
+        def apply(*args):
+            raise IOError('database gone')
+        self.coalescer.apply = apply
+        self.coalescer.submit(1, 'a', 't1', 'begin1', timestamp=100.)
+        self.assertRaises(IOError, self.coalescer.flush, 1)
+        self.assertEqual(self.coalescer.pending[1]['begin'], 'begin1')
+
+    def test_flush_waits_for_apply(self):
+        started = threading.Event()
+        release = threading.Event()
+        def apply(*args):
+            started.set()
+            release.wait(5)
+            self.applied.append(args)
+        self.coalescer.apply = apply
+        self.coalescer.submit(1, 'a', 't1', 'begin1', timestamp=100.)
+        thread = threading.Thread(target=self.coalescer.flush_due, args=(110.,))
+        thread.start()
+        started.wait(5)
+        # a disconnect while the task thread stores the track
+        disconnect = threading.Thread(target=lambda: (self.coalescer.flush(1), self.coalescer.forget(1),
+                                                      self.applied.append('disconnect')))
+        disconnect.start()
+        disconnect.join(0.2)
+        self.assertTrue(disconnect.is_alive())
+        release.set()
+        thread.join(5)
+        disconnect.join(5)
+        self.assertEqual(self.applied, [(1, 'a', 't1', 'begin1'), 'disconnect'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+import xml.etree.ElementTree as ET
+from datetime import timedelta
+
+import rfk
+import rfk.database
+import rfk.database.streaming
+import rfk.icecast
+from rfk.database.streaming import StreamRelay, Listener
+from rfk.icecast import Icecast
+from rfk.icecast.reconcile import reconcile_stream_relay, reconcile_listeners
+from streamingcase import StreamingTestCase
+
+
+LISTCLIENTS = '''<?xml version="1.0"?>
+<icestats><source mount="/live.ogg"><Listeners>2</Listeners>
+<listener><IP>127.0.0.1</IP><UserAgent>test</UserAgent><Connected>300</Connected><ID>3</ID></listener>
+<listener><IP>127.0.0.2</IP><UserAgent>test</UserAgent><Connected>5</Connected><ID>7</ID></listener>
+</source></icestats>'''
+
+
+class Test(StreamingTestCase):
+
+    def setUp(self):
+        self.get_clients = Icecast.get_clients
+        StreamingTestCase.setUp(self)
+
+    def populate(self):
+        StreamRelay.query.get(self.stream_relay).status = StreamRelay.STATUS.ONLINE
+        # client 1 is gone, client 2 is gone but just connected, client 3 is still there
+        for client, minutes in ((1, 10), (2, 0), (3, 10)):
+            rfk.database.session.add(Listener(client=client, connect=self.time - timedelta(minutes=minutes),
+                                              stream_relay_id=self.stream_relay))
+
+    def tearDown(self):
+        Icecast.get_clients = self.get_clients
+        StreamingTestCase.tearDown(self)
+
+    def open_clients(self):
+        return sorted(listener.client for listener in Listener.query.filter(Listener.disconnect == None))
+
+    def test_parse_clients(self):
+        clients = Icecast.parse_clients(ET.fromstring(LISTCLIENTS))
+        self.assertEqual(clients, [{'id': 3, 'ip': '127.0.0.1', 'useragent': 'test', 'connected': 300},
+                                   {'id': 7, 'ip': '127.0.0.2', 'useragent': 'test', 'connected': 5}])
+
+    def test_reconcile_stream_relay(self):
+        clients = [{'id': 3, 'ip': '127.0.0.1', 'useragent': 'test', 'connected': 600},
+                   {'id': 4, 'ip': '127.0.0.1', 'useragent': 'test', 'connected': 120},
+                   {'id': 5, 'ip': '127.0.0.1', 'useragent': 'test', 'connected': 10}]
+        self.assertEqual(reconcile_stream_relay(self.stream_relay, clients, self.time, grace=60), (1, 1))
+        rfk.database.session.commit()
+        self.assertEqual(self.open_clients(), [2, 3, 4])
+        created = Listener.query.filter(Listener.client == 4).one()
+        self.assertEqual(created.connect, self.time - timedelta(seconds=120))
+        self.assertEqual(created.country, 'DE')
+        # nothing left to do
+        self.assertEqual(reconcile_stream_relay(self.stream_relay, clients, self.time, grace=60), (0, 0))
+
+    def test_reconcile_listeners(self):
+        Icecast.get_clients = lambda icecast, mount, timeout=10: Icecast.parse_clients(ET.fromstring(LISTCLIENTS))
+        self.assertEqual(reconcile_listeners(grace=60), (1, 0))
+        self.assertEqual(self.open_clients(), [2, 3])
+        self.assertEqual(Listener.get_total_listener(), 2)
+
+    def test_unreachable_relay(self):
+        def get_clients(icecast, mount, timeout=10):
+            raise rfk.icecast.urllib2.URLError('refused')
+        Icecast.get_clients = get_clients
+        self.assertEqual(reconcile_listeners(grace=60), (0, 0))
+        self.assertEqual(self.open_clients(), [1, 2, 3])
+
+    def test_set_offline(self):
+        stream_relay = StreamRelay.query.get(self.stream_relay)
+        stream_relay.update_statistic()
+        self.assertEqual(stream_relay.set_offline(), 3)
+        rfk.database.streaming.commit_listener_changes({self.stream_relay: -3})
+        self.assertEqual(self.open_clients(), [])
+        self.assertEqual(stream_relay.status, StreamRelay.STATUS.OFFLINE)
+        self.assertEqual(Listener.get_total_listener(), 0)
+        self.assertEqual(stream_relay.set_offline(), 0)
+
+    def test_commit_outside_counters_lock(self):
+        stream_relay = StreamRelay.query.get(self.stream_relay)
+        self.assertEqual(stream_relay.set_offline(), 3)
+        commit = rfk.database.session.commit
+        depths = []
+        def reconciling_commit():
+            depths.append(self.counters.depth)
+            commit()
+            # another process reconciles right after the commit, before the deltas are applied
+            rfk.database.streaming.reconcile_listener_counters(self.counters, force=True)
+        rfk.database.session.commit = reconciling_commit
+        try:
+            rfk.database.streaming.commit_listener_changes({self.stream_relay: -3})
+        finally:
+            del rfk.database.session.commit
+        self.assertEqual(depths, [0])
+        # the reconcile already saw the disconnects, they are not subtracted twice
+        self.assertEqual(self.counters.get_reconciled(), 0.)
+        self.assertEqual(Listener.get_total_listener(), 0)
+
+    def test_counters_keep_open_transaction(self):
+        rfk.database.session.add(Listener(client=4, connect=self.time, stream_relay_id=self.stream_relay))
+        rfk.database.session.flush()
+        rfk.database.streaming.reconcile_listener_counters(self.counters, force=True)
+        rfk.database.session.commit()
+        self.assertEqual(self.open_clients(), [1, 2, 3, 4])
+
+    def test_update_statistic_without_counters(self):
+        rfk.CONFIG.remove_option('icecast', 'counters')
+        rfk.database.streaming.listener_counters = None
+        stream_relay = StreamRelay.query.get(self.stream_relay)
+        stream_relay.update_statistic()
+        rfk.database.session.commit()
+        self.assertEqual(stream_relay.get_statistic().current_value().value, 3)
+        disconnected = stream_relay.set_offline()
+        # a listener the update did not see, the stored value is adjusted instead of recounting
+        rfk.database.session.add(Listener(client=4, connect=self.time, stream_relay_id=self.stream_relay))
+        rfk.database.session.commit()
+        stream_relay.update_statistic(-disconnected)
+        rfk.database.session.commit()
+        self.assertEqual(stream_relay.get_statistic().current_value().value, 0)
+        stream_relay.update_statistic()
+        rfk.database.session.commit()
+        self.assertEqual(stream_relay.get_statistic().current_value().value, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import json
+import base64
+import tempfile
+import unittest
+
+from rfk.helper.recorder import TrafficRecorder, read_records
+from rfk.liquidsoaphandler import get_recordable_args
+from rfk.benchmark.replay import get_expected_listeners, get_handler_args, PASSWORD
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_icecast(self):
+        recorder = TrafficRecorder(self.path)
+        recorder.record_icecast(2., 0.001, '/backend/icecast/auth',
+                                {'action': 'stream_auth', 'user': 'source', 'pass': 'secret'}, 200)
+        for client, address in ((1, '192.0.2.1'), (2, '192.0.2.2'), (3, '198.51.100.1')):
+            recorder.record_icecast(1., 0.001, '/backend/icecast/listeneradd',
+                                    {'action': 'listener_add', 'client': str(client), 'ip': address}, 200)
+        recorder.close()
+        with open(self.path, 'a') as f:
+            f.write('{"t": 3, "k": "ice')
+        records = read_records([self.path])
+        self.assertEqual([record['t'] for record in records], [1., 1., 1., 2.])
+        self.assertEqual(records[3]['f'], {'action': 'stream_auth', 'user': 'source', 'pass': None})
+        addresses = [record['f']['ip'] for record in records[:3]]
+        self.assertNotIn('192.0.2.1', addresses)
+        # the /24 stays recognizable
+        self.assertEqual(addresses[0].rsplit('.', 1)[0], addresses[1].rsplit('.', 1)[0])
+        self.assertNotEqual(addresses[0], addresses[1])
+        self.assertTrue(all(address.startswith('10.') for address in addresses))
+        self.assertEqual(TrafficRecorder(self.path, pseudonymize=False).pseudonym('192.0.2.1'), '192.0.2.1')
+
+    def test_handler_credentials(self):
+        self.assertEqual(get_recordable_args('auth', ['dj', 'secret']), (['dj', None], 'dj'))
+        data = {'Authorization': 'Basic %s' % (base64.b64encode('source:dj|secret'),), 'ice-name': 'Show'}
+        args, username = get_recordable_args('connect', [json.dumps(data)])
+        self.assertEqual(username, 'dj')
+        self.assertEqual(json.loads(args[0]), {'Authorization': None, 'ice-name': 'Show'})
+        self.assertEqual(get_recordable_args('connect', ['{}']), ([], None))
+        self.assertEqual(get_recordable_args('meta', ['{"userid": "1"}']), (['{"userid": "1"}'], None))
+
+    def test_replay_args(self):
+        userids = {'42': 7}
+        args = get_handler_args({'c': 'connect', 'a': ['{"Authorization": null}'], 'u': 'dj'}, userids)
+        self.assertEqual(json.loads(args[0])['Authorization'],
+                         'Basic %s' % (base64.b64encode('dj:%s' % (PASSWORD,)),))
+        self.assertEqual(get_handler_args({'c': 'auth', 'a': ['dj', None], 'u': 'dj'}, userids), ['dj', PASSWORD])
+        self.assertEqual(json.loads(get_handler_args({'c': 'meta', 'a': ['{"userid": "42"}']}, userids)[0]),
+                         {'userid': 7})
+        self.assertEqual(get_handler_args({'c': 'disconnect', 'a': ['"42"']}, userids), ['7'])
+        self.assertIsNone(get_handler_args({'c': 'connect', 'a': ['{}'], 'u': None}, userids))
+
+    def test_expected_listeners(self):
+        def record(action, client=None, mount='/a', status=200):
+            form = {'action': action, 'server': 'relay', 'port': '8000', 'mount': mount}
+            if client is not None:
+                form['client'] = str(client)
+            return {'k': 'icecast', 'f': form, 's': status}
+        records = [record('listener_add', 1), record('listener_add', 2), record('listener_add', 3, '/b'),
+                   record('listener_remove', 1), record('listener_add', 4, status=500),
+                   record('listener_add', 5, '/c'), record('mount_remove', mount='/c')]
+        self.assertEqual(get_expected_listeners(records), {'/a': 1, '/b': 1})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+import rfk.database
+from rfk.database.base import SchemaVersion
+from rfk.exc.base import SchemaOutdatedException
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        rfk.database.init_db('sqlite://', migrate_schema=True)
+
+    def tearDown(self):
+        rfk.database.session.remove()
+
+    def test_init_db_stamps_schema(self):
+        self.assertEqual(rfk.database.get_schema_version(), rfk.database.SCHEMA_VERSION)
+        self.assertTrue(rfk.database.schema_is_current())
+
+    def test_migrate_is_idempotent(self):
+        self.assertEqual(rfk.database.migrate(), (rfk.database.SCHEMA_VERSION, rfk.database.SCHEMA_VERSION))
+        self.assertEqual(SchemaVersion.query.count(), 1)
+
+    def test_unstamped_database(self):
+        rfk.database.engine.execute(SchemaVersion.__table__.delete())
+        self.assertFalse(rfk.database.schema_is_current())
+        self.assertEqual(rfk.database.get_schema_version(), None)
+
+    def test_runtime_only_checks(self):
+        # a fresh database, nothing is created outside of rfk-migrate
+        self.assertRaises(SchemaOutdatedException, rfk.database.init_db, 'sqlite://')
+        self.assertEqual(rfk.database.get_schema_version(), None)
+        rfk.database.init_db('sqlite://', check_schema=False)
+        self.assertEqual(rfk.database.migrate(), (None, rfk.database.SCHEMA_VERSION))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+from datetime import timedelta
+
+import rfk
+import rfk.database
+import rfk.database.streaming
+from rfk.database.show import Show
+from rfk.database.streaming import Listener, ShowListenerStats
+from rfk.icecast.listenerqueue import ListenerQueue
+from streamingcase import StreamingTestCase
+
+
+class Test(StreamingTestCase):
+
+    mounts = (('ogg', '/live.ogg'), ('mp3', '/live.mp3'))
+
+    def setUp(self):
+        StreamingTestCase.setUp(self)
+        self.queue = ListenerQueue(interval=1, batch_size=100)
+
+    def populate(self):
+        show = Show(name='test', description='test', flags=Show.FLAGS.UNPLANNED)
+        rfk.database.session.add(show)
+        rfk.database.session.flush()
+        self.show_id = show.show
+        self.time = self.time.replace(microsecond=0)
+
+    def add(self, client, seconds, mount='/live.ogg'):
+        self.queue.add('127.0.0.1', 8000, mount, '127.0.0.1', client, 'test',
+                       self.time + timedelta(seconds=seconds))
+
+    def remove(self, client, seconds, mount='/live.ogg'):
+        self.queue.remove('127.0.0.1', 8000, mount, client, self.time + timedelta(seconds=seconds))
+
+    def show(self):
+        return Show.query.get(self.show_id)
+
+    def stats(self, stream=None):
+        return ShowListenerStats.get(self.show(), stream)
+
+    def test_show(self):
+        # one listener is there before the show starts
+        self.add(1, -60)
+        self.queue.flush()
+        ShowListenerStats.start(self.show(), self.time)
+        rfk.database.session.commit()
+        self.add(2, 60)
+        self.add(3, 60, '/live.mp3')
+        self.remove(2, 120)
+        self.add(4, 180)
+        self.queue.flush()
+        self.remove(1, 240)
+        self.queue.flush()
+        self.assertEqual(self.stats().get_listener_seconds(self.time + timedelta(seconds=300)),
+                         240 + 60 + 240 + 120)
+        ShowListenerStats.finalize(self.show(), self.time + timedelta(seconds=300))
+        rfk.database.session.commit()
+        # after the show nothing changes
+        self.remove(4, 360)
+        self.queue.flush()
+        total = self.stats()
+        self.assertFalse(total.running)
+        self.assertEqual(total.listener_seconds, 660)
+        self.assertEqual(total.listener_minutes, 11)
+        self.assertEqual(total.peak, 3)
+        self.assertEqual(total.clients, 4)
+        ogg = self.stats(self.stream_ids[0])
+        self.assertEqual((ogg.listener_seconds, ogg.peak, ogg.clients), (420, 2, 3))
+        mp3 = self.stats(self.stream_ids[1])
+        self.assertEqual((mp3.listener_seconds, mp3.peak, mp3.clients), (240, 1, 1))
+
+    def test_peak_within_a_batch(self):
+        ShowListenerStats.start(self.show(), self.time)
+        for client in xrange(1, 6):
+            self.add(client, client)
+        for client in xrange(1, 6):
+            self.remove(client, 10 + client)
+        self.queue.flush()
+        total = self.stats()
+        self.assertEqual((total.listeners, total.peak, total.clients), (0, 5, 5))
+
+    def test_resume(self):
+        ShowListenerStats.start(self.show(), self.time)
+        self.add(1, 0)
+        self.queue.flush()
+        ShowListenerStats.finalize(self.show(), self.time + timedelta(seconds=60))
+        rfk.database.session.commit()
+        ShowListenerStats.start(self.show(), self.time + timedelta(seconds=120))
+        rfk.database.session.commit()
+        ShowListenerStats.finalize(self.show(), self.time + timedelta(seconds=180))
+        rfk.database.session.commit()
+        total = self.stats()
+        self.assertEqual((total.listener_seconds, total.clients), (120, 1))
+
+    def test_queued_before_start(self):
+        self.add(1, -120)
+        self.queue.flush()
+        # stored after the show started
+        self.remove(1, -60)
+        self.add(2, -30)
+        ShowListenerStats.start(self.show(), self.time)
+        rfk.database.session.commit()
+        self.queue.flush()
+        total = self.stats()
+        self.assertEqual((total.listeners, total.clients), (1, 2))
+        self.assertEqual(total.get_listener_seconds(self.time + timedelta(seconds=60)), 60)
+
+    def test_resume_counts_new_clients(self):
+        ShowListenerStats.start(self.show(), self.time)
+        self.add(1, 0)
+        self.add(2, 0)
+        self.queue.flush()
+        ShowListenerStats.finalize(self.show(), self.time + timedelta(seconds=60))
+        rfk.database.session.commit()
+        # one leaves and another one joins in between
+        self.remove(1, 90)
+        self.add(3, 100)
+        self.queue.flush()
+        ShowListenerStats.start(self.show(), self.time + timedelta(seconds=120))
+        rfk.database.session.commit()
+        total = self.stats()
+        self.assertEqual((total.listeners, total.clients), (2, 3))
+
+    def test_reconnect(self):
+        self.queue.reconnect_grace = 10
+        ShowListenerStats.start(self.show(), self.time)
+        self.add(1, 0)
+        self.remove(1, 60)
+        self.add(2, 65)
+        self.queue.flush()
+        total = self.stats()
+        self.assertEqual((total.listeners, total.peak, total.clients), (1, 1, 1))
+        self.assertEqual(total.get_listener_seconds(self.time + timedelta(seconds=120)), 115)
+
+    def test_end_show(self):
+        ShowListenerStats.start(self.show(), self.time)
+        rfk.database.session.commit()
+        self.show().end_show()
+        rfk.database.session.commit()
+        self.assertFalse(self.stats().running)
+
+if __name__ == "__main__":
+    unittest.main()
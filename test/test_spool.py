@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from rfk.liquidsoap.spool import Spool
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spool', 'journal')
+        self.applied = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def apply(self, event):
+        if event['args'] == ['fail']:
+            raise IOError('database is gone')
+        self.applied.append(event['seq'])
+
+    def test_drain_in_order(self):
+        spool = Spool(self.path, fsync=False)
+        for i in xrange(3):
+            spool.append('meta', [str(i)], timestamp=i)
+        self.assertEqual(spool.backlog(), 3)
+        self.assertEqual(spool.drain(self.apply), 3)
+        self.assertEqual(self.applied, [1, 2, 3])
+        self.assertEqual(spool.backlog(), 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(spool.append('meta', ['4']), 4)
+
+    def test_failed_event_is_retried(self):
+        spool = Spool(self.path, fsync=False)
+        spool.append('meta', ['1'])
+        spool.append('meta', ['fail'])
+        spool.append('meta', ['3'])
+        self.assertRaises(IOError, spool.drain, self.apply)
+        self.assertEqual(self.applied, [1])
+        self.assertEqual(spool.backlog(), 2)
+        spool.pending[0]['args'] = ['2']
+        spool.drain(self.apply)
+        self.assertEqual(self.applied, [1, 2, 3])
+
+    def test_replay_after_restart(self):
+        spool = Spool(self.path)
+        for i in xrange(3):
+            spool.append('meta', [str(i)])
+        spool.drain(self.apply, limit=1)
+        spool.close()
+        with open(self.path, 'ab') as f:
+            f.write('{"seq": 4, "tim')
+        spool = Spool(self.path)
+        self.assertEqual(spool.backlog(), 2)
+        self.assertEqual(spool.append('meta', ['x']), 4)
+        spool.drain(self.apply)
+        self.assertEqual(self.applied, [1, 2, 3, 4])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+import unittest
+from datetime import datetime, timedelta
+
+import pytz
+
+import rfk
+import rfk.database
+from rfk.database.base import SchemaVersion
+from rfk.database.stats import Statistic, StatsistcsData, StatisticsRollup, get_bucket, statisticsdata_idx
+from rfk.database.stats import get_resolution, rollup_statistics, prune_statistics
+import rfk.database.stats
+from rfk.helper import now
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        rfk.init()
+        rfk.database.init_db('sqlite://', migrate_schema=True)
+        self.statistic = Statistic(name='Test', identifier='test')
+        rfk.database.session.add(self.statistic)
+        rfk.database.session.commit()
+        self.time = datetime(2013, 10, 17, 20, 0, 3, 5000, tzinfo=pytz.utc)
+        for name in ('raw', 'minute', 'hour', 'day'):
+            rfk.CONFIG.set('database', 'statistic-retention-%s' % (name,), '0')
+
+    def tearDown(self):
+        rfk.database.session.remove()
+
+    def rollups(self, resolution):
+        return [(rollup.timestamp, rollup.min, rollup.max, rollup.avg, rollup.last, rollup.count)
+                for rollup in StatisticsRollup.query.filter(StatisticsRollup.resolution == resolution)
+                                                    .order_by(StatisticsRollup.timestamp)]
+
+    def values(self):
+        return [(data.timestamp, data.value) for data in self.statistic.get()]
+
+    def test_get_bucket(self):
+        self.assertEqual(get_bucket(self.time, 10), self.time.replace(second=0, microsecond=0))
+        self.assertEqual(get_bucket(self.time + timedelta(seconds=9), 10), self.time.replace(second=10, microsecond=0))
+        self.assertEqual(get_bucket(self.time, 0), self.time)
+
+    def test_set_replaces_within_bucket(self):
+        self.statistic.set(self.time, 1, resolution=10)
+        self.statistic.set(self.time + timedelta(seconds=2), 2, resolution=10)
+        self.statistic.set(self.time + timedelta(seconds=7), 3, resolution=10)
+        rfk.database.session.commit()
+        self.assertEqual(self.values(), [(self.time.replace(second=0, microsecond=0), 2),
+                                         (self.time.replace(second=10, microsecond=0), 3)])
+
+    def test_set_without_resolution(self):
+        self.statistic.set(self.time, 1, resolution=0)
+        self.statistic.set(self.time + timedelta(seconds=1), 2, resolution=0)
+        self.statistic.set(self.time + timedelta(seconds=1), 3, resolution=0)
+        rfk.database.session.commit()
+        self.assertEqual(self.values(), [(self.time, 1), (self.time + timedelta(seconds=1), 3)])
+
+    def test_migration_merges_duplicates(self):
+        statisticsdata_idx.drop(rfk.database.engine)
+        for value in (1, 2):
+            rfk.database.session.add(StatsistcsData(statistic=self.statistic, timestamp=self.time, value=value))
+        rfk.database.session.commit()
+        rfk.database.engine.execute(SchemaVersion.__table__.update().values(version=1))
+        rfk.database.migrate()
+        self.assertEqual(self.values(), [(self.time, 2)])
+        self.statistic.set(self.time, 4, resolution=0)
+        rfk.database.session.commit()
+        self.assertEqual(self.values(), [(self.time, 4)])
+
+    def test_rollup(self):
+        start = self.time.replace(second=0, microsecond=0)
+        for seconds, value in ((0, 4), (10, 2), (50, 6), (60, 10), (3600, 1)):
+            self.statistic.set(start + timedelta(seconds=seconds), value, resolution=0)
+        rfk.database.session.commit()
+        # only completed buckets
+        self.assertEqual(rollup_statistics(start + timedelta(seconds=90)), 1)
+        self.assertEqual(self.rollups(60), [(start, 2, 6, 4., 6, 3)])
+        self.assertEqual(rollup_statistics(start + timedelta(days=1)), 1 + 1 + 2 + 1)
+        self.assertEqual(self.rollups(60)[1:], [(start + timedelta(seconds=60), 10, 10, 10., 10, 1),
+                                                (start + timedelta(seconds=3600), 1, 1, 1., 1, 1)])
+        self.assertEqual(self.rollups(3600), [(start, 2, 10, 5.5, 10, 4),
+                                              (start + timedelta(seconds=3600), 1, 1, 1., 1, 1)])
+        self.assertEqual(self.rollups(86400), [(start.replace(hour=0), 1, 10, 4.6, 1, 5)])
+        self.assertEqual(rollup_statistics(start + timedelta(days=1)), 0)
+        rfk.database.session.commit()
+        self.assertEqual([data.value for data in self.statistic.get(start, start + timedelta(hours=2), points=5)],
+                         [5.5, 1.])
+
+    def test_rollup_late_points(self):
+        start = self.time.replace(second=0, microsecond=0)
+        for seconds, value in ((0, 4), (3600, 1)):
+            self.statistic.set(start + timedelta(seconds=seconds), value, resolution=0)
+        rfk.database.session.commit()
+        self.assertEqual(rollup_statistics(start + timedelta(days=1)), 2 + 2 + 1)
+        # a spooled point lands in buckets that are already rolled up
+        self.statistic.set(start + timedelta(seconds=30), 2, resolution=0)
+        rfk.database.session.commit()
+        rfk.CONFIG.set('database', 'statistic-retention-raw', '1')
+        self.assertEqual(prune_statistics(start + timedelta(days=2)), 2)
+        self.assertEqual(self.rollups(60)[0], (start, 4, 4, 4., 4, 1))
+        self.assertEqual(rollup_statistics(start + timedelta(days=1)), 1 + 1 + 1)
+        # merged into the pruned bucket, the last value stays the one rolled up before
+        self.assertEqual(self.rollups(60)[0], (start, 2, 4, 3., 4, 2))
+        self.assertEqual(self.rollups(3600)[0], (start, 2, 4, 3., 4, 2))
+        self.assertEqual(self.rollups(86400), [(start.replace(hour=0), 1, 4, 7 / 3., 1, 3)])
+        self.assertEqual(prune_statistics(start + timedelta(days=2)), 1)
+
+    def test_rollup_replaced_point(self):
+        start = self.time.replace(second=0, microsecond=0)
+        self.statistic.set(start, 4, resolution=0)
+        self.statistic.set(start + timedelta(seconds=10), 2, resolution=0)
+        rfk.database.session.commit()
+        rollup_statistics(start + timedelta(days=1))
+        self.statistic.set(start + timedelta(seconds=10), 6, resolution=0)
+        rfk.database.session.commit()
+        self.assertEqual(rollup_statistics(start + timedelta(days=1)), 3)
+        self.assertEqual(self.rollups(60), [(start, 4, 6, 5., 6, 2)])
+
+    def test_rollup_chunks(self):
+        start = self.time.replace(second=0, microsecond=0)
+        for seconds in range(0, 600, 20):
+            self.statistic.set(start + timedelta(seconds=seconds), seconds / 20, resolution=0)
+        rfk.database.session.commit()
+        chunk = rfk.database.stats.ROLLUP_CHUNK
+        rfk.database.stats.ROLLUP_CHUNK = 4
+        try:
+            self.assertEqual(rollup_statistics(start + timedelta(days=1)), 10 + 1 + 1)
+        finally:
+            rfk.database.stats.ROLLUP_CHUNK = chunk
+        self.assertEqual(self.rollups(60)[:2], [(start, 0, 2, 1., 2, 3), (start + timedelta(seconds=60), 3, 5, 4., 5, 3)])
+        self.assertEqual(self.rollups(3600), [(start, 0, 29, 14.5, 29, 30)])
+
+    def test_get_resolution(self):
+        stop = now()
+        self.assertEqual(get_resolution(stop - timedelta(days=30), stop), None)
+        self.assertEqual(get_resolution(stop - timedelta(days=30), stop, points=1000), 3600)
+        self.assertEqual(get_resolution(stop - timedelta(hours=1), stop, points=1000), None)
+        rfk.CONFIG.set('database', 'statistic-retention-raw', '14')
+        self.assertEqual(get_resolution(stop - timedelta(days=30), stop), 60)
+        self.assertEqual(get_resolution(None, stop - timedelta(days=30)), 60)
+
+    def test_prune(self):
+        old = now() - timedelta(days=20)
+        self.statistic.set(old, 1, resolution=0)
+        self.statistic.set(now(), 2, resolution=0)
+        rfk.database.session.commit()
+        rfk.CONFIG.set('database', 'statistic-retention-raw', '14')
+        # nothing is rolled up yet
+        self.assertEqual(prune_statistics(), 0)
+        rollup_statistics()
+        self.assertEqual(prune_statistics(), 1)
+        rfk.database.session.commit()
+        self.assertEqual([data.value for data in self.statistic.get()], [2])
+        self.assertEqual([data.value for data in self.statistic.get(start=old - timedelta(minutes=1))], [1.])
+
+    def test_migration_marks_rolled_up(self):
+        start = self.time.replace(second=0, microsecond=0)
+        for seconds, value in ((0, 4), (3600, 1)):
+            self.statistic.set(start + timedelta(seconds=seconds), value, resolution=0)
+        rfk.database.session.commit()
+        rollup_statistics(start + timedelta(seconds=3600))
+        rfk.database.session.commit()
+        rfk.database.engine.execute(StatsistcsData.__table__.update().values(rolled=False))
+        rfk.database.engine.execute(StatisticsRollup.__table__.update().values(rolled=False))
+        rfk.database.engine.execute(SchemaVersion.__table__.update().values(version=5))
+        rfk.database.migrate()
+        self.assertEqual([data.rolled for data in StatsistcsData.query.order_by(StatsistcsData.timestamp)],
+                         [True, False])
+        self.assertEqual(rollup_statistics(start + timedelta(days=1)), 1 + 1 + 1)
+        self.assertEqual(self.rollups(3600), [(start, 4, 4, 4., 4, 1), (start + timedelta(seconds=3600), 1, 1, 1., 1, 1)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,7 +6,7 @@ from rfk.database.show import Tag
 class Test(unittest.TestCase):
 
     def setUp(self):
-        rfk.database.init_db('sqlite://', False)
+        rfk.database.init_db('sqlite://', migrate_schema=True)
 
     def tearDown(self):
         pass
@@ -0,0 +1,45 @@
+import unittest
+
+import rfk.database
+from rfk.database.track import Title, Track, title_cache, _title_key
+from rfk.database.show import Show
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        rfk.database.init_db('sqlite://', migrate_schema=True)
+        title_cache.clear()
+
+    def tearDown(self):
+        rfk.database.session.remove()
+
+    def test_title_is_cached_after_commit(self):
+        title_id = Title.get_title_id('artist', 'title')
+        self.assertNotIn(_title_key('artist', 'title'), title_cache)
+        rfk.database.session.commit()
+        self.assertIn(_title_key('artist', 'title'), title_cache)
+        self.assertEqual(Title.get_title_id('artist', 'title'), title_id)
+        self.assertEqual(Title.get_title_id(u'artist', u'title'), title_id)
+
+    def test_rolled_back_title_is_not_cached(self):
+        Title.get_title_id('artist', 'gone')
+        rfk.database.session.rollback()
+        self.assertNotIn(_title_key('artist', 'gone'), title_cache)
+        self.assertEqual(Title.query.count(), 0)
+
+    def test_same_title_resolves_to_same_id(self):
+        self.assertEqual(Title.add_title('artist', 'title'), Title.add_title('artist', 'title'))
+        self.assertNotEqual(Title.get_title_id('artist', 'title'), Title.get_title_id('artist', 'other'))
+
+    def test_warm_cache(self):
+        show = Show(name='show', flags=Show.FLAGS.UNPLANNED)
+        rfk.database.session.add(show)
+        Track.new_track(show, 'artist', 'title')
+        rfk.database.session.commit()
+        title_cache.clear()
+        Title.warm_cache()
+        self.assertIn(_title_key('artist', 'title'), title_cache)
+
+if __name__ == "__main__":
+    unittest.main()
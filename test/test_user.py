@@ -0,0 +1,47 @@
+import unittest
+
+import rfk
+import rfk.database
+from rfk.database.base import User
+from rfk import exc as rexc
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        rfk.init()
+        rfk.database.init_db('sqlite://', migrate_schema=True)
+        User.clear_auth_cache()
+        self.user = User.add_user('cached', 'secret')
+        rfk.database.session.commit()
+
+    def tearDown(self):
+        rfk.database.session.remove()
+
+    def test_authenticate_caches_success(self):
+        User.authenticate('cached', 'secret')
+        self.assertTrue(self.user._check_auth_cache('secret'))
+        self.assertFalse(self.user._check_auth_cache('wrong'))
+        self.assertIs(User.authenticate('cached', 'secret'), self.user)
+
+    def test_failed_authentication_is_not_cached(self):
+        self.assertRaises(rexc.base.InvalidPasswordException, User.authenticate, 'cached', 'wrong')
+        self.assertFalse(self.user._check_auth_cache('wrong'))
+
+    def test_password_change_invalidates_cache(self):
+        User.authenticate('cached', 'secret')
+        self.user.password = User.make_password('other')
+        rfk.database.session.commit()
+        self.assertRaises(rexc.base.InvalidPasswordException, User.authenticate, 'cached', 'secret')
+        self.assertIs(User.authenticate('cached', 'other'), self.user)
+
+    def test_changed_hash_invalidates_cache(self):
+        """a password changed by another process only shows up as a different hash"""
+        User.authenticate('cached', 'secret')
+        digest, password_hash, expires = User._auth_cache[self.user.user]
+        User._auth_cache[self.user.user] = (digest, 'hash-before-change', expires)
+        self.assertFalse(self.user._check_auth_cache('secret'))
+        self.assertNotIn(self.user.user, User._auth_cache)
+
+if __name__ == "__main__":
+    unittest.main()